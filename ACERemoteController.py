@@ -36,10 +36,13 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import clr
 import sys
-# Import relevant objects from the ACE remote client DLL
-# This MUST be done after importing CLR
+from Timing import span
+
+# Last value written to each bitfield, per client, used to skip redundant
+# writes. Bitfields staged by an open batch, per client.
+_shadow = {}
+_staged = {}
 
 
 def establish_connection(board, chip, ace_path):
@@ -60,8 +63,12 @@ def establish_connection(board, chip, ace_path):
         Reference to the connection to the ACE Application.
     """
 
+    # CLR is only loaded once a real ACE session is needed
+    import clr
     # Set your ACE installation directory.
     sys.path.append(ace_path + r'\Client')
+    # Import relevant objects from the ACE remote client DLL
+    # This MUST be done after importing CLR
     clr.AddReference('AnalogDevices.Csa.Remoting.Clients')
     import AnalogDevices.Csa.Remoting.Clients as __adrc
     # Create connection to ACE. Remember to enable the server
@@ -91,8 +98,98 @@ def write_to_bitfield(client, bitfieldname, val):
         Integer value of data to be written.
     """
 
-    client.SetBitfield(bitfieldname, val)
-    client.Run('@ApplySettings')
+    if getattr(client, 'remote_shadow', False):
+        # A DACService keeps the shadow shared by all its clients
+        shadow = {}
+    else:
+        shadow = _shadow.setdefault(id(client), {})
+    if shadow.get(bitfieldname) == val:
+        # The device already holds this value, skip the round-trip
+        return
+    with span('ace.SetBitfield'):
+        client.SetBitfield(bitfieldname, val)
+    shadow[bitfieldname] = val
+    staged = _staged.get(id(client))
+    if staged is not None:
+        # Inside a batch the settings are applied once on exit
+        staged.add(bitfieldname)
+    else:
+        with span('ace.ApplySettings'):
+            client.Run('@ApplySettings')
+    return
+
+
+class BitfieldBatch:
+    """Stages bitfield writes and applies them with a single @ApplySettings.
+
+    Used as a context manager, every ``write_to_bitfield`` on the client
+    inside the block only stages its value; the block applies them all at
+    once on exit. Batches may be nested, the outermost one applies. If the
+    block raises, the settings are not applied and the staged bitfields are
+    dropped from the register shadow, so they are written again next time.
+
+    Parameters
+    ----------
+    client
+        Reference to the connection to the ACE Application.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._outer = False
+
+    def __enter__(self):
+        if id(self.client) not in _staged:
+            _staged[id(self.client)] = set()
+            self._outer = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self._outer:
+            return False
+        staged = _staged.pop(id(self.client))
+        if exc_type is not None:
+            shadow = _shadow.get(id(self.client), {})
+            for bitfieldname in staged:
+                shadow.pop(bitfieldname, None)
+        elif staged:
+            with span('ace.ApplySettings'):
+                self.client.Run('@ApplySettings')
+        return False
+
+    def write(self, bitfieldname, val):
+        """Stages a bitfield value, see ``write_to_bitfield``."""
+        write_to_bitfield(self.client, bitfieldname, val)
+        return
+
+
+def batch(client):
+    """Opens a batch of bitfield writes on the client.
+
+    Parameters
+    ----------
+    client
+        Reference to the connection to the ACE Application.
+
+    Returns
+    -------
+    BitfieldBatch
+        Context manager applying the staged writes on exit.
+    """
+
+    return BitfieldBatch(client)
+
+
+def invalidate_shadow(client):
+    """Forgets the cached register values so the next writes are all sent.
+
+    Parameters
+    ----------
+    client
+        Reference to the connection to the ACE Application.
+    """
+
+    _shadow.pop(id(client), None)
     return
 
 
@@ -105,7 +202,9 @@ def reset(client):
         Reference to the connection to the ACE Application.
     """
 
-    client.Run('@Reset')
+    with span('ace.Reset'):
+        client.Run('@Reset')
+    invalidate_shadow(client)
     # write_to_bitfield(client, "OPGND", 0)
     return
 
@@ -120,4 +219,5 @@ def close_connection(client):
     """
 
     client.CloseSession()
+    invalidate_shadow(client)
     return
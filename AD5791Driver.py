@@ -0,0 +1,429 @@
+import time
+from Timing import span
+
+# Register addresses, bits 22:20 of a frame
+REG_NOP = 0
+REG_DAC = 1
+REG_CONTROL = 2
+REG_CLEARCODE = 3
+REG_SOFTWARE = 4
+READ = 1 << 23  # R/W bit of a frame, set to read the register back
+
+# Bitfields of the control register as named in the ACE memory map:
+# (shift, width)
+CONTROL_BITFIELDS = {
+    'RBUF': (1, 1),
+    'OPGND': (2, 1),
+    'DACTRI': (3, 1),
+    'BIN_2sC': (4, 1),
+    'SDODIS': (5, 1),
+    'LIN_COMP': (6, 4)
+}
+POWER_ON_CONTROL = 0b1110  # RBUF, OPGND and DACTRI set
+# Bits of the software control register
+SOFTWARE_LDAC = 1 << 0
+SOFTWARE_CLR = 1 << 1
+SOFTWARE_RESET = 1 << 2
+
+LDAC_MODES = ('sync', 'software', 'pin')
+
+
+def frame(register, data=0, read=False):
+    '''24-bit SPI frame of a register write (or read), MSB first'''
+    word = (register & 0x7) << 20 | (data & 0xFFFFF)
+    if read:
+        word |= READ
+    return word.to_bytes(3, 'big')
+
+
+def decode_frames(data):
+    """Splits an SPI byte stream into its frames.
+
+    Returns
+    -------
+    list of tuple
+        ``(read, register, data)`` of every 24-bit frame.
+    """
+    if len(data) % 3:
+        raise ValueError(f'{len(data)} bytes are not a whole number of '
+                         '24-bit frames')
+    frames = []
+    for k in range(0, len(data), 3):
+        word = int.from_bytes(data[k:k + 3], 'big')
+        frames.append((bool(word & READ), (word >> 20) & 0x7, word & 0xFFFFF))
+    return frames
+
+
+class AD5791Direct:
+    """AD5791 driven with SPI frames instead of through ACE.
+
+    The object has the interface of the ACE remote client used by
+    ``ACERemoteController`` (``SetBitfield``, ``Run('@ApplySettings')``,
+    ``Run('@Reset')``, ``CloseSession``), so ``DACFunctions``, the
+    acquisition engine and ``DACService`` use it in place of the client
+    returned by ``establish_connection``. The bitfields staged by
+    ``SetBitfield`` are turned into register writes when applied: the DAC
+    register first, then LDAC, then the control register, so releasing the
+    output clamp with a new code releases it at that code. All frames of
+    one apply go to the transport in one write.
+
+    ``DAC_Register_Data`` is the register value, straight binary is turned
+    into 2's complement by ``write_dac_code`` with the same XOR as for ACE,
+    and ``BIN_2sC`` selects the coding of the register like in ACE.
+
+    Parameters
+    ----------
+    transport
+        Byte-level SPI link with ``write(data)``; ``transfer(data)``
+        returning the bytes read back, ``pulse_ldac()`` and ``close()``
+        are used if present. See ``LoopbackSPI`` and ``StreamTransport``.
+    ldac : str
+        ``'sync'`` if LDAC is tied low and every DAC write updates the
+        output, ``'software'`` to follow every DAC write with the LDAC bit
+        of the software control register, ``'pin'`` to pulse LDAC through
+        the transport, which then needs an LDAC line (``can_pulse_ldac``).
+    rbuf : bool
+        RBUF bit written by a reset, set when the output amplifier is
+        configured for unity gain as on the evaluation board.
+    """
+
+    def __init__(self, transport, ldac='sync', rbuf=True):
+        if ldac not in LDAC_MODES:
+            raise ValueError(f'unknown LDAC mode {ldac!r}, expected one of '
+                             f'{LDAC_MODES}')
+        if ldac == 'pin' and not getattr(transport, 'can_pulse_ldac',
+                                         hasattr(transport, 'pulse_ldac')):
+            raise ValueError(f"LDAC mode 'pin' needs an LDAC line, "
+                             f'{type(transport).__name__} has none; wire '
+                             "one (SPI_LDAC_LINE) or use 'software'")
+        self.transport = transport
+        self.ldac = ldac
+        self.rbuf = rbuf
+        self.staged = {}
+        self.control = POWER_ON_CONTROL
+        self.frames = 0  # frames sent
+        self.closed = False
+
+    # Interface of the ACE remote client used by ACERemoteController
+
+    def AddHardwarePlugin(self, board):
+        return
+
+    def set_ContextPath(self, path):
+        return
+
+    def SetBitfield(self, bitfieldname, val):
+        if bitfieldname not in CONTROL_BITFIELDS and bitfieldname not in (
+                'DAC_Register_Data', 'Clearcode_Register_Data'):
+            raise ValueError(f'unknown AD5791 bitfield {bitfieldname!r}')
+        self.staged[bitfieldname] = int(val)
+        return
+
+    def Run(self, script):
+        if script == '@ApplySettings':
+            staged, self.staged = self.staged, {}
+            data = b''
+            if 'DAC_Register_Data' in staged:
+                data += self._dac_frames(staged.pop('DAC_Register_Data'))
+            if 'Clearcode_Register_Data' in staged:
+                data += frame(REG_CLEARCODE,
+                              staged.pop('Clearcode_Register_Data'))
+            if staged:
+                for name, val in staged.items():
+                    shift, width = CONTROL_BITFIELDS[name]
+                    mask = ((1 << width) - 1) << shift
+                    self.control = (self.control & ~mask) | (
+                        (val << shift) & mask)
+                data += frame(REG_CONTROL, self.control)
+            self._send(data)
+        elif script == '@Reset':
+            # Registers to their power-on values, then the output buffer
+            # enabled with the output still clamped to ground
+            self.staged = {}
+            self.control = (self.rbuf << 1) | (1 << 2)
+            self._send(
+                frame(REG_SOFTWARE, SOFTWARE_RESET) +
+                frame(REG_CONTROL, self.control))
+        else:
+            raise ValueError(f'{script} is not supported by the SPI driver')
+        return
+
+    def CloseSession(self):
+        self.closed = True
+        if hasattr(self.transport, 'close'):
+            self.transport.close()
+        return
+
+    # Register-level access
+
+    def write_codes(self, values):
+        """Writes several DAC register values back to back in one transfer.
+
+        Parameters
+        ----------
+        values : iterable of int
+            ``DAC_Register_Data`` values, in the coding selected by
+            ``BIN_2sC``.
+        """
+        if self.ldac == 'pin':
+            # One LDAC pulse per code
+            for val in values:
+                self._send(self._dac_frames(val))
+            return
+        self._send(b''.join(self._dac_frames(val) for val in values))
+        return
+
+    @property
+    def can_read(self):
+        '''whether the transport returns the bytes read over SDO'''
+        return hasattr(self.transport, 'transfer')
+
+    def read_register(self, register):
+        '''value of a register read back over SDO, see can_read'''
+        if not self.can_read:
+            raise TypeError(f'{type(self.transport).__name__} cannot read '
+                            'back, it has no transfer method')
+        # The register comes out during the frame after the read request
+        reply = self.transport.transfer(
+            frame(register, read=True) + frame(REG_NOP))
+        self.frames += 2
+        return decode_frames(reply[3:])[0][2]
+
+    def _dac_frames(self, val):
+        data = frame(REG_DAC, val)
+        if self.ldac == 'software':
+            data += frame(REG_SOFTWARE, SOFTWARE_LDAC)
+        # With 'pin' the pulse follows the whole write, see _send
+        return data
+
+    def _send(self, data):
+        if not data:
+            return
+        with span('spi.write'):
+            self.transport.write(data)
+            if self.ldac == 'pin':
+                self.transport.pulse_ldac()
+        self.frames += len(data) // 3
+        return
+
+
+class StreamTransport:
+    """SPI transport over a byte stream, e.g. a USB-SPI bridge.
+
+    The bridge is expected to clock every byte written out on MOSI and to
+    return the bytes read on MISO in the same order. LDAC can be wired to
+    a modem control line of the bridge, asserted (low on the pin) and
+    released again by ``pulse_ldac`` once the frames are read back.
+
+    Parameters
+    ----------
+    stream
+        File-like object with ``write``, ``flush`` and ``read``, such as a
+        ``serial.Serial``.
+    ldac_line : str, optional
+        ``'rts'`` or ``'dtr'``, the attribute of the stream driving LDAC.
+    """
+
+    def __init__(self, stream, ldac_line=None):
+        if ldac_line not in (None, 'rts', 'dtr'):
+            raise ValueError(f'unknown LDAC line {ldac_line!r}, expected '
+                             "'rts' or 'dtr'")
+        self.stream = stream
+        self.ldac_line = ldac_line
+        if ldac_line is not None:
+            setattr(stream, ldac_line, False)
+
+    @property
+    def can_pulse_ldac(self):
+        '''whether LDAC is wired to a line of the bridge'''
+        return self.ldac_line is not None
+
+    def write(self, data):
+        self.transfer(data)
+        return
+
+    def transfer(self, data):
+        self.stream.write(data)
+        self.stream.flush()
+        reply = self.stream.read(len(data))
+        if len(reply) < len(data):
+            raise TimeoutError(f'the bridge returned {len(reply)} of '
+                               f'{len(data)} bytes')
+        return reply
+
+    def pulse_ldac(self):
+        '''loads the DAC register by pulsing the LDAC line'''
+        if self.ldac_line is None:
+            raise TypeError('LDAC is not wired to the bridge, see ldac_line')
+        setattr(self.stream, self.ldac_line, True)
+        setattr(self.stream, self.ldac_line, False)
+        return
+
+    def close(self):
+        self.stream.close()
+        return
+
+
+def serial_transport(port, baudrate=3000000, timeout=1.0, ldac_line=None):
+    '''StreamTransport over a serial port, needs pyserial'''
+    # pyserial is only loaded when a bridge is used
+    import serial
+    return StreamTransport(serial.Serial(port, baudrate, timeout=timeout),
+                           ldac_line)
+
+
+class LoopbackStream:
+    """Byte stream of a USB-SPI bridge in front of a ``LoopbackSPI``.
+
+    Lets ``StreamTransport`` run without hardware: every write is clocked
+    through the loopback and its reply is read back, and releasing the
+    asserted ``rts`` or ``dtr`` line pulses LDAC.
+
+    Parameters
+    ----------
+    spi : LoopbackSPI
+        Device behind the bridge.
+    """
+
+    def __init__(self, spi):
+        self.spi = spi
+        self.reply = b''
+        self.lines = {'rts': False, 'dtr': False}
+
+    def write(self, data):
+        self.reply += self.spi.transfer(data)
+        return len(data)
+
+    def flush(self):
+        return
+
+    def read(self, size):
+        data, self.reply = self.reply[:size], self.reply[size:]
+        return data
+
+    def close(self):
+        self.spi.close()
+        return
+
+    def __getattr__(self, name):
+        if name in ('rts', 'dtr'):
+            return self.lines[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in ('rts', 'dtr'):
+            if self.lines[name] and not value:
+                self.spi.pulse_ldac()
+            self.lines[name] = bool(value)
+            return
+        super().__setattr__(name, value)
+
+
+class LoopbackSPI:
+    """In-process stand-in of the SPI link and the AD5791 behind it.
+
+    Decodes the frames into the registers of the device: input and DAC
+    register, control, clearcode and software control register, with LDAC
+    tied low or driven by the software LDAC bit or ``pulse_ldac``. Every
+    update of the output is applied to the twin, if given.
+
+    Parameters
+    ----------
+    twin : ResonatorTwin, optional
+        Resonator biased by the DAC output.
+    ldac_tied_low : bool
+        Whether a DAC write updates the output at once.
+    clock : float, optional
+        SPI clock in Hz; every write then takes as long as its bits.
+    """
+
+    def __init__(self, twin=None, ldac_tied_low=True, clock=None):
+        self.twin = twin
+        self.ldac_tied_low = ldac_tied_low
+        self.clock = clock
+        self.log = []  # decoded frames, (read, register, data)
+        self.writes = 0  # transport writes
+        self.closed = False
+        self.reset()
+
+    def reset(self):
+        '''power-on state of the registers'''
+        self.input = 0
+        self.dac = 0
+        self.control = POWER_ON_CONTROL
+        self.clearcode = 0
+        self._sdo = 0
+        self._update()
+        return
+
+    def bitfields(self):
+        '''register contents by ACE bitfield name'''
+        fields = {'DAC_Register_Data': self.dac,
+                  'Clearcode_Register_Data': self.clearcode}
+        for name, (shift, width) in CONTROL_BITFIELDS.items():
+            fields[name] = (self.control >> shift) & ((1 << width) - 1)
+        return fields
+
+    def write(self, data):
+        self.transfer(data)
+        return
+
+    def transfer(self, data):
+        if self.closed:
+            raise ConnectionError('the SPI link is closed')
+        if self.clock:
+            time.sleep(len(data) * 8 / self.clock)
+        self.writes += 1
+        reply = b''
+        for read, register, value in decode_frames(bytes(data)):
+            self.log.append((read, register, value))
+            reply += self._sdo.to_bytes(3, 'big')
+            self._sdo = 0
+            if read:
+                self._sdo = (READ | register << 20
+                             | self._register(register))
+            elif register == REG_DAC:
+                self.input = value
+                if self.ldac_tied_low:
+                    self.dac = value
+                    self._update()
+            elif register == REG_CONTROL:
+                self.control = value
+                self._update()
+            elif register == REG_CLEARCODE:
+                self.clearcode = value
+            elif register == REG_SOFTWARE:
+                if value & SOFTWARE_RESET:
+                    self.reset()
+                elif value & SOFTWARE_CLR:
+                    self.dac = self.input = self.clearcode
+                    self._update()
+                elif value & SOFTWARE_LDAC:
+                    self.pulse_ldac()
+        return reply
+
+    def pulse_ldac(self):
+        '''loads the input register into the DAC register'''
+        self.dac = self.input
+        self._update()
+        return
+
+    def close(self):
+        self.closed = True
+        return
+
+    def _register(self, register):
+        return {
+            REG_DAC: self.dac,
+            REG_CONTROL: self.control,
+            REG_CLEARCODE: self.clearcode
+        }.get(register, 0)
+
+    def _update(self):
+        if self.twin is not None:
+            fields = self.bitfields()
+            self.twin.apply({
+                name: fields[name]
+                for name in ('DAC_Register_Data', 'OPGND', 'BIN_2sC')
+            })
+        return
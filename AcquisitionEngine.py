@@ -0,0 +1,493 @@
+import queue
+import threading
+import time
+import numpy as np
+import DACFunctions as dacfunc
+from E4990AFunctions import (startBasicSweep, fetchBasicSweep,
+                              triggerBasicSweep, listSweepChunks,
+                              startListSweep, fetchListSweep)
+from Settling import as_model, sweep_order
+
+_STOP = object()  # end of stream marker passed between the stages
+
+
+class AcquisitionEngine:
+    """Pipelined DAC / E4990A acquisition of one sweep pass.
+
+    The pass is split into four stages connected by bounded queues, the
+    first three in their own threads and the processing in the calling
+    one::
+
+        plan -> DAC -> E4990A sweep + transfer -> processing
+
+    The E4990A stage triggers the sweep and then fetches its binary block.
+    The DAC stage may only move to the next code once the sweep has
+    completed (``TRIG:SING;*OPC?`` returned), before the fetch, so the ACE
+    round-trip of point k + 1 runs while point k is transferred, and the
+    averaging of point k - 1 overlaps both. The sweep of point k + 1 waits
+    for the transfer of point k, both go through the one VISA session.
+
+    Parameters
+    ----------
+    inst_E
+        E4990A VISA resource.
+    inst_AD
+        Reference to the connection to the ACE Application.
+    resolution : int
+        Resolution of the DAC.
+    isencoding2scomplement : bool
+        Whether 2s complement data is written to the DAC.
+    settle : float or SettlingModel
+        Wait after every DAC write before the sweep is triggered, in s, or
+        the model of the wait from the size of the code step.
+    queue_size : int
+        Depth of the queues between the stages.
+    """
+
+    def __init__(self,
+                 inst_E,
+                 inst_AD,
+                 resolution=20,
+                 isencoding2scomplement=True,
+                 settle=0.0,
+                 queue_size=4):
+        self.inst_E = inst_E
+        self.inst_AD = inst_AD
+        self.resolution = resolution
+        self.isencoding2scomplement = isencoding2scomplement
+        self.settling = as_model(settle)
+        self.queue_size = queue_size
+        self.last_code = None  # code left on the DAC by the last pass
+        self.last_stats = {}
+        self.last_counts = np.zeros(0, dtype=int)
+
+    def run(self, freqs, codes, repeat=15, order=None):
+        """Measures a pass with the stages overlapped.
+
+        Parameters
+        ----------
+        freqs : array_like
+            Frequencies to measure.
+        codes : array_like
+            DAC code applied for each frequency.
+        repeat : int
+            Number of points of the zero-span sweep at each frequency.
+        order : array_like, optional
+            Indices of the frequencies in order of measurement, see
+            ``Settling.sweep_order``; the rows stay in the order of
+            ``freqs``.
+
+        Returns
+        -------
+        numpy.ndarray
+            ``F2I`` rows ``[freq, mean phase, code] + phase``.
+        """
+        freqs, codes = self._check_plan(freqs, codes)
+        if order is None:
+            order = range(len(freqs))
+        items = [(kk, freqs[kk:kk + 1], int(codes[kk]), 0, repeat)
+                 for kk in order]
+        result = np.empty((len(freqs), 3 + repeat))
+        t1 = time.perf_counter()
+        waited = self._pipeline(items, result, False)
+        self.last_stats = self._stats('pipelined', len(freqs), t1,
+                                      time.perf_counter())
+        self.last_stats['settle'] = waited
+        return result
+
+    def run_until(self, freqs, codes, detector, repeat=15):
+        """Measures a pass until the expected dips are confirmed.
+
+        Every averaged point is pushed to the detector as it comes out of
+        the pipeline; once ``detector.done`` the pass stops, the points
+        already in the pipeline are dropped.
+
+        Parameters
+        ----------
+        freqs : array_like
+            Ascending frequencies to measure.
+        codes : array_like
+            DAC code applied for each frequency.
+        detector : DipDetector
+            Detector of the pass, with its ``expected`` number of dips.
+        repeat : int
+            Number of points of the zero-span sweep at each frequency.
+
+        Returns
+        -------
+        numpy.ndarray
+            ``F2I`` rows of the frequencies measured, the first ones of
+            ``freqs``.
+        """
+        freqs, codes = self._check_plan(freqs, codes)
+        items = [(kk, freqs[kk:kk + 1], int(codes[kk]), 0, repeat)
+                 for kk in range(len(freqs))]
+        result = np.empty((len(freqs), 3 + repeat))
+        measured = [0]
+
+        def on_rows(kk, rows):
+            measured[0] = kk + len(rows)
+            detector.push(rows[:, 0], rows[:, 1])
+            return detector.done
+
+        t1 = time.perf_counter()
+        waited = self._pipeline(items, result, False, on_rows)
+        if not detector.done:
+            detector.finish()
+        self.last_stats = self._stats('until', measured[0], t1,
+                                      time.perf_counter())
+        self.last_stats.update({'settle': waited,
+                                'skipped': len(freqs) - measured[0]})
+        return result[:measured[0]]
+
+    def run_adaptive(self, freqs, codes, targets, cap=15, batch=5,
+                     max_rounds=4, order=None):
+        """Measures a pass with as many samples as each point needs.
+
+        Every point first gets ``batch`` samples. From their spread the
+        samples needed for the standard error of the mean phase to reach
+        the point's target are estimated, and the point is measured again
+        while its code is still applied, until it reaches its target or
+        ``cap`` samples. The DAC only moves on once the point is done, so
+        the pass settles once per point as in ``run``.
+
+        Parameters
+        ----------
+        freqs : array_like
+            Frequencies to measure.
+        codes : array_like
+            DAC code applied for each frequency.
+        targets : float or array_like
+            Standard error of the mean phase to reach at each frequency, in
+            degree, see ``dip_targets``.
+        cap : int
+            Maximum number of samples per frequency.
+        batch : int
+            Samples of the first batch, at least 2 for a spread.
+        max_rounds : int
+            Maximum number of batches per frequency.
+        order : array_like, optional
+            Indices of the frequencies in order of measurement, see
+            ``Settling.sweep_order``.
+
+        Returns
+        -------
+        numpy.ndarray
+            ``F2I`` rows ``[freq, mean phase, code] + phase``, the unused
+            sample slots up to ``cap`` are NaN. The number of samples of
+            each row is kept in ``last_counts``.
+        """
+        if batch < 2:
+            raise ValueError(f'batch = {batch}, the spread of the samples '
+                             'needs at least 2 per point')
+        freqs, codes = self._check_plan(freqs, codes)
+        targets = np.broadcast_to(np.asarray(targets, dtype=float),
+                                  freqs.shape)
+        if order is None:
+            order = range(len(freqs))
+        result = np.full((len(freqs), 3 + cap), np.nan)
+        counts = np.zeros(len(freqs), dtype=int)
+        batches = np.zeros(len(freqs), dtype=int)
+        first = min(batch, cap)
+
+        def extend(kk, count):
+            counts[kk] = count
+            batches[kk] += 1
+            if batches[kk] >= max_rounds or count >= cap:
+                return 0, True
+            # Samples for std / sqrt(n) <= target, a few more than estimated
+            std = np.std(result[kk, 3:3 + count], ddof=1)
+            required = np.ceil(1.2 * (std / targets[kk])**2)
+            # Without a finite spread (NaN data) the point is measured up
+            # to the cap
+            if not np.isfinite(required):
+                required = cap
+            if required <= count:
+                return 0, True
+            more = int(min(max(required - count, first), cap - count))
+            return more, (count + more >= cap
+                          or batches[kk] + 1 >= max_rounds)
+
+        items = [(kk, freqs[kk:kk + 1], int(codes[kk]), 0, first)
+                 for kk in order]
+        t1 = time.perf_counter()
+        waited = self._pipeline(items, result, False, extend=extend)
+        self.last_counts = counts
+        self.last_stats = self._stats('adaptive', len(freqs), t1,
+                                      time.perf_counter())
+        self.last_stats.update({'samples': int(counts.sum()),
+                                'batches': int(batches.max(initial=0)),
+                                'settle': waited})
+        return result
+
+    def run_list(self, groups, repeat=15):
+        """Measures a pass with one segment sweep per DAC code.
+
+        Parameters
+        ----------
+        groups : list of tuple
+            ``(code, freqs)`` groups, see ``CodeMap.groups_for``.
+        repeat : int
+            Number of points measured at each frequency.
+
+        Returns
+        -------
+        numpy.ndarray
+            ``F2I`` rows ``[freq, mean phase, code] + phase``.
+        """
+        items = []
+        kk = 0
+        for code, freqs in groups:
+            for chunk in listSweepChunks(np.asarray(freqs, dtype=float),
+                                         repeat):
+                items.append((kk, chunk, int(code), 0, repeat))
+                kk += len(chunk)
+        result = np.empty((kk, 3 + repeat))
+        t1 = time.perf_counter()
+        waited = self._pipeline(items, result, True)
+        self.last_stats = self._stats('list', kk, t1, time.perf_counter())
+        self.last_stats['settle'] = waited
+        return result
+
+    def _pipeline(self, items, result, list_mode, on_rows=None,
+                  extend=None):
+        '''run (first row, freqs, code, first sample, samples) items through
+        the stages, into the rows of result; returns the time waited for the
+        DAC to settle. on_rows(first row, rows) is called with every
+        processed item and stops the pass by returning True. extend(row,
+        samples so far) is called after every sweep of a single frequency
+        and returns the samples to add while the code is held, 0 when the
+        point is done, and whether that batch is known to be the last'''
+        stop = threading.Event()
+        errors = []
+        waited = [0.0]
+        dac_q = queue.Queue(self.queue_size)
+        sweep_q = queue.Queue(1)
+        proc_q = queue.Queue(self.queue_size)
+        # Released by the sweep stage once the analyzer no longer needs the
+        # current code, acquired by the DAC stage before applying the next.
+        sweep_done = threading.Semaphore(1)
+
+        def plan_stage():
+            for item in items:
+                if not self._put(dac_q, item, stop):
+                    return
+            self._put(dac_q, _STOP, stop)
+
+        def dac_stage():
+            while True:
+                item = self._get(dac_q, stop)
+                if item is _STOP or item is None:
+                    self._put(sweep_q, _STOP, stop)
+                    return
+                while not sweep_done.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                dacfunc.write_dac_code(self.inst_AD, item[2], self.resolution,
+                                       self.isencoding2scomplement)
+                waited[0] += self._settle(item[2])
+                if not self._put(sweep_q, item, stop):
+                    return
+
+        def sweep_stage():
+            while True:
+                item = self._get(sweep_q, stop)
+                if item is _STOP or item is None:
+                    self._put(proc_q, _STOP, stop)
+                    return
+                kk, freqs, _, col, n = item
+                # Transferred straight into the rows of the result
+                samples = result[kk:kk + len(freqs), 3 + col:3 + col + n]
+                if list_mode:
+                    startListSweep(self.inst_E, freqs, n)
+                    sweep_done.release()
+                    fetchListSweep(self.inst_E, freqs, n, samples)
+                elif extend is None:
+                    startBasicSweep(self.inst_E, freqs[0], freqs[0], n)
+                    sweep_done.release()
+                    fetchBasicSweep(self.inst_E, freqs[0], freqs[0], n,
+                                    samples[0])
+                else:
+                    # The next code waits until the point needs no more
+                    # samples; only the transfer of a batch known to be the
+                    # last one overlaps it
+                    last = False
+                    while n:
+                        startBasicSweep(self.inst_E, freqs[0], freqs[0], n)
+                        if last:
+                            sweep_done.release()
+                        fetchBasicSweep(self.inst_E, freqs[0], freqs[0], n,
+                                        result[kk, 3 + col:3 + col + n])
+                        col += n
+                        released = last
+                        n, last = extend(kk, col)
+                    if not released:
+                        sweep_done.release()
+                    item = (kk, freqs, item[2], 0, col)
+                if not self._put(proc_q, item, stop):
+                    return
+
+        def process_stage():
+            while True:
+                item = self._get(proc_q, stop)
+                if item is _STOP or item is None:
+                    return
+                kk, freqs, code, col, n = item
+                rows = result[kk:kk + len(freqs)]
+                rows[:, 0] = freqs
+                # Mean of all the samples of the row so far
+                rows[:, 1] = np.average(rows[:, 3:3 + col + n], axis=1)
+                rows[:, 2] = code
+                if on_rows is not None and on_rows(kk, rows):
+                    return
+
+        def guarded(stage):
+            def target():
+                try:
+                    stage()
+                except Exception as ex:
+                    errors.append(ex)
+                    stop.set()
+
+            return target
+
+        threads = [
+            threading.Thread(target=guarded(stage), daemon=True)
+            for stage in (plan_stage, dac_stage, sweep_stage)
+        ]
+        for th in threads:
+            th.start()
+        guarded(process_stage)()
+        stop.set()
+        for th in threads:
+            th.join()
+        if errors:
+            raise errors[0]
+        return waited[0]
+
+    def run_serial(self, freqs, codes, repeat=15, order=None):
+        '''the pass measured point by point as in the original loop'''
+        freqs, codes = self._check_plan(freqs, codes)
+        Freq2Imp = []
+        waited = 0.0
+        t1 = time.perf_counter()
+        if order is not None:
+            freqs, codes = freqs[order], codes[order]
+        for sweepFreq, rootCode in zip(freqs, codes):
+            dacfunc.write_dac_code(self.inst_AD, int(rootCode),
+                                   self.resolution,
+                                   self.isencoding2scomplement)
+            waited += self._settle(int(rootCode))
+            phase, _ = triggerBasicSweep(self.inst_E, sweepFreq, sweepFreq,
+                                         repeat)
+            tPhase = np.average(phase)
+            Freq2Imp.append([sweepFreq, tPhase, int(rootCode)] + list(phase))
+        t2 = time.perf_counter()
+        self.last_stats = self._stats('serial', len(freqs), t1, t2)
+        self.last_stats['settle'] = waited
+        F2I_np = np.array(Freq2Imp).reshape(-1, 3 + repeat)
+        if order is not None:
+            F2I_np[np.asarray(order)] = F2I_np.copy()
+        return F2I_np
+
+    def run_ordered(self, freqs, codes, repeat=15, order='serpentine',
+                    pass_index=0):
+        '''a pipelined pass in one of the orders of Settling.sweep_order,
+        freqs and codes ascending'''
+        return self.run(freqs, codes, repeat,
+                        sweep_order(len(freqs), order, pass_index))
+
+    def _settle(self, code):
+        '''waits for the step from the code before, returns the wait'''
+        wait = self.settling.wait(
+            None if self.last_code is None else code - self.last_code)
+        self.last_code = code
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def compare(self, freqs, codes, repeat=15):
+        """Times the serial loop and the pipelined engine on the same plan.
+
+        Returns
+        -------
+        dict
+            Points per second of both modes and the speed-up.
+        """
+        self.run_serial(freqs, codes, repeat)
+        serial = self.last_stats
+        self.run(freqs, codes, repeat)
+        pipelined = self.last_stats
+        return {
+            'serial_points_per_s': serial['points_per_s'],
+            'pipelined_points_per_s': pipelined['points_per_s'],
+            'speedup': pipelined['points_per_s'] / serial['points_per_s']
+        }
+
+    @staticmethod
+    def _check_plan(freqs, codes):
+        freqs = np.asarray(freqs, dtype=float)
+        codes = np.asarray(codes)
+        if freqs.shape != codes.shape:
+            raise ValueError('freqs and codes must have the same length')
+        return freqs, codes
+
+    @staticmethod
+    def _stats(mode, points, t1, t2):
+        elapsed = t2 - t1
+        return {
+            'mode': mode,
+            'points': points,
+            'elapsed': elapsed,
+            'points_per_s': points / elapsed if elapsed > 0 else float('inf')
+        }
+
+    @staticmethod
+    def _put(q, item, stop):
+        '''put unless the pass was stopped, returns False if it was'''
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _get(q, stop):
+        '''get unless the pass was stopped, returns None if it was'''
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return None
+
+
+def dip_targets(freqs, dips, target, dip_target, width):
+    """Standard error targets tighter near the known dips.
+
+    Parameters
+    ----------
+    freqs : array_like
+        Frequencies of the pass.
+    dips : array_like
+        Dip frequencies, e.g. of the previous pass; all frequencies get
+        ``dip_target`` if empty.
+    target : float
+        Target on the flat baseline.
+    dip_target : float
+        Target within ``width`` of a dip.
+    width : float
+        Half-width of the region around a dip, in Hz.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    dips = np.atleast_1d(np.asarray(dips, dtype=float))
+    if len(dips) == 0:
+        return np.full(freqs.shape, float(dip_target))
+    near = np.min(np.abs(freqs[:, None] - dips[None, :]), axis=1) <= width
+    return np.where(near, dip_target, target)
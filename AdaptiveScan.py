@@ -0,0 +1,89 @@
+import numpy as np
+from DipDetector import find_dips
+
+
+def adaptive_scan(measure,
+                  start,
+                  stop,
+                  resolution,
+                  coarse_stride=8,
+                  sigma=2,
+                  prominence=0.05,
+                  window=2):
+    """Coarse-to-fine search of the phase dips between start and stop.
+
+    All frequencies lie on the grid ``start + i * resolution``. A sparse
+    first pass measures every ``coarse_stride``-th grid point and locates
+    candidate dips with the smoothing and prominence test of the uniform
+    scan. Around each candidate the stride is then halved level by level,
+    measuring only the grid points within ``window`` strides of the
+    current dip estimate, until the stride is one grid step.
+
+    Parameters
+    ----------
+    measure : callable
+        ``measure(freqs)`` returns the ``F2I`` rows of these frequencies,
+        in the same order.
+    start, stop : float
+        Frequency range of the scan.
+    resolution : float
+        Final frequency step around the dips.
+    coarse_stride : int
+        Grid points between two points of the first pass, a power of two.
+    sigma : float
+        Gaussian smoothing of the uniform scan, in grid points.
+    prominence : float
+        Prominence of a dip in the smoothed phase.
+    window : int
+        Half-width of the refined region, in strides of the current level.
+
+    Returns
+    -------
+    F2I_np : numpy.ndarray
+        Measured rows sorted by frequency.
+    kk : numpy.ndarray
+        Row index of each dip in ``F2I_np``.
+    """
+    count = int(np.floor((stop - start) / resolution + 1e-9)) + 1
+    stride = max(1, int(coarse_stride))
+    rows = {}
+
+    def take(indices):
+        new = np.array(sorted(set(indices) - set(rows)), dtype=int)
+        if len(new):
+            for k, row in zip(new, measure(start + new * resolution)):
+                rows[k] = row
+        return
+
+    # Sparse first pass, the smoothing shrinks with the grid
+    coarse = np.arange(0, count, stride)
+    take(coarse)
+    phase = np.array([rows[k][1] for k in coarse])
+    _, dips = find_dips(phase, max(sigma / stride, 0.5), prominence)
+    candidates = [int(coarse[c]) for c in dips]
+    # Refine around each candidate until the stride is one grid step
+    while stride > 1:
+        stride //= 2
+        windows = []
+        for center in candidates:
+            lo = max(center - window * stride, 0)
+            hi = min(center + window * stride, count - 1)
+            local = np.arange(lo - lo % stride, hi + 1, stride)
+            windows.append(local[(local >= lo) & (local <= hi)])
+        # One measurement call per level for all the dips
+        take(np.concatenate(windows or [np.zeros(0, dtype=int)]))
+        candidates = [_local_minimum(rows, local) for local in windows]
+    order = np.array(sorted(rows))
+    F2I_np = np.array([rows[k] for k in order])
+    kk = np.searchsorted(order, sorted(set(candidates)))
+    return F2I_np, kk
+
+
+def _local_minimum(rows, local):
+    '''grid index of the lowest 3-point averaged phase among local'''
+    phase = np.array([rows[k][1] for k in local])
+    if len(phase) >= 3:
+        phase = np.convolve(np.pad(phase, 1, mode='edge'),
+                            np.ones(3) / 3,
+                            mode='valid')
+    return int(local[np.argmin(phase)])
@@ -0,0 +1,540 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+import scipy
+import scipy.optimize as op
+from scipy.ndimage import gaussian_filter1d as ft
+from scipy.signal import find_peaks as fp
+import CodeMap as cm
+import ResonatorFit as rf
+from DipDetector import DipDetector
+from InstrumentSimulator import ResonatorTwin
+from ModelFunctions import C2F_func, F2Z_func, Error
+
+FITTED_PARA = [13e-6, 22e-12, 53e3]  # starting point of the legacy fit
+CODE_RANGE = (0x99000, 0xE6600, 0x02000)  # startCode, stopCode, stepCode
+
+# Sizes of the synthetic data: calibration codes and points per sweep, pass
+# points and samples per point
+SIZES = {
+    'small': {'codes': 12, 'sp': 101, 'points': 64, 'repeat': 15},
+    'default': {'codes': 40, 'sp': 201, 'points': 250, 'repeat': 15},
+    'large': {'codes': 160, 'sp': 401, 'points': 1000, 'repeat': 31},
+}
+
+
+def synthetic_calibration(codes=40, sp=201, seed=0, noise=0.002):
+    """Impedance sweeps of a calibration, as ``measure_codes`` takes them.
+
+    The sweeps come from ``ResonatorTwin``, each over the window the
+    calibration would use around the resonance of its code.
+
+    Returns
+    -------
+    codes : numpy.ndarray
+        DAC codes, spread over ``CODE_RANGE``.
+    freq, imp : numpy.ndarray
+        Shape ``(codes, sp)``, ``|Z|`` with relative noise.
+    """
+    rng = np.random.default_rng(seed)
+    twin = ResonatorTwin(L=FITTED_PARA[0], R=FITTED_PARA[2])
+    code_list = np.linspace(CODE_RANGE[0], CODE_RANGE[1], codes).astype(int)
+    freq = np.empty((codes, sp))
+    imp = np.empty((codes, sp))
+    for k, code in enumerate(code_list):
+        _set_code(twin, code)
+        f0 = twin.resonance()
+        freq[k] = np.linspace(f0 / 1.15 * 0.999, f0 / 0.95 * 1.001, sp)
+        imp[k] = twin.measure(freq[k], 'Z') * (1 + rng.normal(0, noise, sp))
+    return code_list, freq, imp
+
+
+def synthetic_pass(para_C2F,
+                   points=250,
+                   repeat=15,
+                   seed=0,
+                   noise=0.02,
+                   sensors=None):
+    """Phase samples of one pass, as the acquisition returns them.
+
+    Every frequency is measured at the code whose resonance is 1.002 times
+    above it, as in the sweep loop, so the sensors show up as dips.
+    ``sensors`` are those of ``ResonatorTwin``, its default if omitted.
+
+    Returns
+    -------
+    freqs : numpy.ndarray
+        Shape ``(points,)``.
+    samples : numpy.ndarray
+        Phase in degree, shape ``(points, repeat)``.
+    """
+    rng = np.random.default_rng(seed)
+    twin = ResonatorTwin(L=FITTED_PARA[0], R=FITTED_PARA[2])
+    if sensors is not None:
+        twin.sensors = list(sensors)
+    code_map = cm.build_code_map(para_C2F, [[CODE_RANGE[0]], [CODE_RANGE[1]]],
+                                 step=16)
+    lo, hi = code_map.envelope[0], code_map.envelope[-1]
+    freqs = np.linspace(lo / 1.002 * 1.001, hi / 1.002 * 0.998, points)
+    samples = np.empty((points, repeat))
+    for k, code in enumerate(code_map.codes_for(freqs * 1.002)):
+        _set_code(twin, code)
+        samples[k] = twin.measure(np.full(repeat, freqs[k]), 'TZ')
+    samples += rng.normal(0, noise, samples.shape)
+    return freqs, samples
+
+
+def _set_code(twin, code):
+    twin.apply({
+        'DAC_Register_Data': int(code) ^ (1 << (twin.resolution - 1)),
+        'OPGND': 0
+    })
+    return
+
+
+# --- the host-side math of a calibration and of a pass ------------------
+
+
+def legacy_F2Z(freq, imp):
+    '''op.leastsq and op.fminbound of every sweep, as C2F_Calibr did'''
+    peaks = []
+    for f, z in zip(freq, imp):
+        p_est, _ = op.leastsq(Error, FITTED_PARA, args=(F2Z_func, f, z))
+        peaks.append(op.fminbound(lambda x: -F2Z_func(p_est, x), f[0], f[-1]))
+    return np.array(peaks)
+
+
+def legacy_C2F(codes, peaks):
+    return op.leastsq(Error, [-2.8e7, 170e2, 3e-4, 4e-10, -2e-16, 4e-23],
+                      args=(C2F_func, codes, peaks))[0]
+
+
+def legacy_codes(para_C2F, freqs):
+    '''op.fsolve per point, as the sweep loop did'''
+    codes = []
+    guess = CODE_RANGE[0]
+    for f in freqs:
+        codes.append(
+            int(np.around(
+                op.fsolve(lambda c: C2F_func(para_C2F, c) - f * 1.002,
+                          guess)[0])))
+    return np.array(codes)
+
+
+def legacy_F2I(freqs, samples, codes):
+    '''Freq2Imp list built point by point, then converted'''
+    Freq2Imp = []
+    for f, phase, code in zip(freqs, samples, codes):
+        phase = list(phase)
+        Freq2Imp.append([f, np.average(phase), code] + phase)
+    return np.array(Freq2Imp)
+
+
+def build_F2I(freqs, samples, codes):
+    '''F2I rows filled in place, as AcquisitionEngine does'''
+    F2I_np = np.empty((len(freqs), 3 + samples.shape[1]))
+    F2I_np[:, 0] = freqs
+    F2I_np[:, 2] = codes
+    F2I_np[:, 3:] = samples
+    F2I_np[:, 1] = np.average(F2I_np[:, 3:], axis=1)
+    return F2I_np
+
+
+def stream_dips(F2I_np):
+    detector = DipDetector(2, 0.05)
+    for row in F2I_np:
+        detector.push(row[0], row[1])
+    detector.finish()
+    return detector.indices()
+
+
+def postprocess(code_map, freqs, samples):
+    '''code plan, F2I rows, smoothing and dips of one pass'''
+    codes = code_map.codes_for(freqs * 1.002)
+    F2I_np = build_F2I(freqs, samples, codes)
+    phase_f = ft(F2I_np[:, 1], 2)
+    return fp(-phase_f, prominence=0.05)[0]
+
+
+def legacy_postprocess(para_C2F, freqs, samples):
+    codes = legacy_codes(para_C2F, freqs)
+    F2I_np = legacy_F2I(freqs, samples, codes)
+    phase_f = ft(F2I_np[:, 1], 2)
+    return fp(-phase_f, prominence=0.05)[0]
+
+
+# --- accuracy of the sub-step dip refinement ----------------------------
+
+
+def accuracy(points=(40, 60, 100, 150, 250),
+             trials=10,
+             seed=0,
+             repeat=15,
+             noise=0.02):
+    """Error of the dip frequencies against the number of pass points.
+
+    Every trial moves the two sensors of the twin by up to 200 kHz and
+    measures passes of every point count. The dips found on the grid and
+    the dips of ``ResonatorFit.refine_dips`` are compared with the minima
+    of the noise-free phase on a fine grid, the fitted ``f0`` with the
+    pulled sensor resonance ``f_s / sqrt(1 - k^2)``.
+
+    Returns
+    -------
+    list of dict
+        One entry per point count: the step, the number of dips, the rms
+        error of the grid dips, of the refined dips and of ``f0`` in Hz,
+        the median standard deviation reported for the refined dips, the
+        dips not refined and the mean time of ``refine_dips`` in s.
+    """
+    codes, freq, imp = synthetic_calibration(seed=seed)
+    para_C2F = rf.fit_C2F(codes, rf.resonance(rf.fit_F2Z(freq, imp)))
+    rng = np.random.default_rng(seed)
+    errors = {n: {'grid': [], 'dip': [], 'f0': [], 'std': [], 'time': []}
+              for n in points}
+    steps = {}
+    for trial in range(trials):
+        sensors = [(f_s + rng.uniform(-2e5, 2e5), Q, k)
+                   for f_s, Q, k in ResonatorTwin().sensors]
+        resonances = np.array([f_s / np.sqrt(1 - k**2)
+                               for f_s, Q, k in sensors])
+        fine, samples = synthetic_pass(para_C2F, 6001, 1, noise=0,
+                                       sensors=sensors)
+        truth = _minima(fine, samples[:, 0])
+        # The dips of the sensors, not those of the reader alone
+        truth = truth[np.min(np.abs(truth[:, None] - resonances), axis=1) <
+                      0.03 * truth]
+        for n in points:
+            freqs, samples = synthetic_pass(para_C2F, n, repeat,
+                                            seed + trial, noise, sensors)
+            steps[n] = freqs[1] - freqs[0]
+            phase = samples.mean(axis=1)
+            kk = fp(-ft(phase, 2), prominence=0.05)[0]
+            # Only the dips of the sensors, within two steps of a minimum
+            nearest = truth[np.argmin(np.abs(freqs[kk, None] - truth),
+                                      axis=1)]
+            own = np.abs(freqs[kk] - nearest) <= 2 * steps[n]
+            kk, nearest = kk[own], nearest[own]
+            t1 = time.perf_counter()
+            rows = rf.refine_dips(freqs, phase, kk)
+            e = errors[n]
+            e['time'].append(time.perf_counter() - t1)
+            e['grid'].extend(freqs[kk] - nearest)
+            e['dip'].extend(rows[:, 0] - nearest)
+            e['std'].extend(rows[:, 1])
+            e['f0'].extend(rows[:, 2] - resonances[np.argmin(
+                np.abs(rows[:, 2, None] - resonances), axis=1)])
+    curve = []
+    for n in points:
+        e = {key: np.array(val, dtype=float)
+             for key, val in errors[n].items()}
+        refined = ~np.isnan(e['std'])
+        curve.append({
+            'points': n,
+            'step': float(steps[n]),
+            'dips': len(e['grid']),
+            'grid_rms': _rms(e['grid']),
+            'refined_rms': _rms(e['dip']),
+            'f0_rms': _rms(e['f0'][refined]),
+            'std_p50': _median(e['std'][refined]),
+            'not_refined': int(np.count_nonzero(~refined)),
+            'time': float(np.mean(e['time']))
+        })
+    return curve
+
+
+def _minima(freqs, phase, prominence=0.05):
+    '''dips of a noise-free pass, parabolic between the points'''
+    kk = fp(-phase, prominence=prominence)[0]
+    kk = kk[(kk > 0) & (kk < len(phase) - 1)]
+    y0, y1, y2 = phase[kk - 1], phase[kk], phase[kk + 1]
+    shift = 0.5 * (y0 - y2) / (y0 - 2 * y1 + y2)
+    return freqs[kk] + shift * (freqs[1] - freqs[0])
+
+
+def _rms(e):
+    return float(np.sqrt(np.mean(np.square(e)))) if len(e) else np.nan
+
+
+def _median(e):
+    return float(np.median(e)) if len(e) else np.nan
+
+
+def accuracy_report(curve):
+    '''accuracy curve as a text table, frequencies in Hz'''
+    lines = [
+        f'{"points":>7}{"step":>10}{"dips":>6}{"grid rms":>10}'
+        f'{"refined":>9}{"f0 rms":>8}{"std p50":>9}{"failed":>8}{"ms":>7}'
+    ]
+    for r in curve:
+        lines.append(
+            f'{r["points"]:>7}{r["step"]:>10.0f}{r["dips"]:>6}'
+            f'{r["grid_rms"]:>10.0f}{r["refined_rms"]:>9.0f}'
+            f'{r["f0_rms"]:>8.0f}{r["std_p50"]:>9.0f}'
+            f'{r["not_refined"]:>8}{r["time"] * 1e3:>7.1f}')
+    return '\n'.join(lines)
+
+
+def plot_accuracy(curve, path):
+    '''rms errors of the dips and the step against the pass points'''
+    # matplotlib is only needed for the figure
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    points = [r['points'] for r in curve]
+    fig, ax = plt.subplots()
+    for key, label in (('step', 'sweep step'), ('grid_rms', 'grid dip'),
+                       ('refined_rms', 'refined dip'), ('f0_rms',
+                                                        'refined f0')):
+        ax.plot(points, [r[key] for r in curve], 'o-', label=label)
+    ax.set_yscale('log')
+    ax.set_xlabel('points per pass')
+    ax.set_ylabel('rms error (Hz)')
+    ax.legend()
+    fig.savefig(path)
+    plt.close(fig)
+    return
+
+
+# --- runner --------------------------------------------------------------
+
+
+def measure(func, *args, repeat=20, min_time=0.2):
+    """Times a stage.
+
+    The stage runs at least ``repeat`` times and at least ``min_time`` s,
+    after one untimed warm-up call.
+
+    Returns
+    -------
+    dict
+        ``count``, ``min``, ``p50``, ``mean`` and ``max`` in s.
+    """
+    func(*args)
+    durations = []
+    start = time.perf_counter()
+    while len(durations) < repeat or time.perf_counter() - start < min_time:
+        t1 = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - t1)
+    d = np.array(durations)
+    return {
+        'count': len(d),
+        'min': float(d.min()),
+        'p50': float(np.median(d)),
+        'mean': float(d.mean()),
+        'max': float(d.max())
+    }
+
+
+def run(size='default', seed=0, repeat=20, legacy=True, only=None):
+    """Times every stage on synthetic data of one size.
+
+    Parameters
+    ----------
+    size : str
+        Key of ``SIZES``.
+    seed : int
+        Seed of the synthetic data.
+    repeat : int
+        Minimum number of timed runs per stage.
+    legacy : bool
+        Also time the scipy.optimize code the loop used before.
+    only : str, optional
+        Only the stages whose name contains this text.
+
+    Returns
+    -------
+    dict
+        Statistics of every stage, by stage name.
+    """
+    s = SIZES[size]
+    codes, freq, imp = synthetic_calibration(s['codes'], s['sp'], seed)
+    peaks = rf.resonance(rf.fit_F2Z(freq, imp))
+    para_C2F = rf.fit_C2F(codes, peaks)
+    freqs, samples = synthetic_pass(para_C2F, s['points'], s['repeat'], seed)
+    code_map = cm.build_code_map(para_C2F, np.column_stack([codes, peaks]),
+                                 CODE_RANGE[0], CODE_RANGE[1])
+    plan = code_map.codes_for(freqs * 1.002)
+    F2I_np = build_F2I(freqs, samples, plan)
+    phase_f = ft(F2I_np[:, 1], 2)
+    stages = {
+        'calib.fit_F2Z': (lambda: rf.resonance(rf.fit_F2Z(freq, imp)), ),
+        'calib.fit_F2Z_each': (lambda: [
+            rf.resonance(rf.fit_F2Z(f, z)) for f, z in zip(freq, imp)
+        ], ),
+        'calib.fit_C2F': (rf.fit_C2F, codes, peaks),
+        'pass.code_map_build': (cm.build_code_map, para_C2F,
+                                np.column_stack([codes, peaks]),
+                                CODE_RANGE[0], CODE_RANGE[1]),
+        'pass.codes_for': (code_map.codes_for, freqs * 1.002),
+        'pass.F2I_build': (build_F2I, freqs, samples, plan),
+        'pass.smooth': (ft, F2I_np[:, 1], 2),
+        'pass.find_peaks': (lambda: fp(-phase_f, prominence=0.05), ),
+        'pass.stream_dips': (stream_dips, F2I_np),
+        'pass.postprocess': (postprocess, code_map, freqs, samples),
+    }
+    if legacy:
+        stages.update({
+            'legacy.leastsq_fminbound': (legacy_F2Z, freq, imp),
+            'legacy.C2F_leastsq': (legacy_C2F, codes.astype(float), peaks),
+            'legacy.fsolve': (legacy_codes, para_C2F, freqs),
+            'legacy.F2I_build': (legacy_F2I, freqs, samples, plan),
+            'legacy.postprocess': (legacy_postprocess, para_C2F, freqs,
+                                   samples),
+        })
+    results = {}
+    for name, (func, *args) in stages.items():
+        if only is not None and only not in name:
+            continue
+        # The slow legacy stages are timed fewer times
+        n = max(3, repeat // 5) if name.startswith('legacy.') else repeat
+        results[name] = measure(func, *args, repeat=n)
+    return results
+
+
+def environment():
+    '''versions and commit the results were measured with'''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True,
+                                text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor() or platform.machine(),
+        'node': platform.node()
+    }
+
+
+def load_results(path):
+    '''records of a results file, oldest first'''
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def report(results, baseline=None):
+    '''results as a text table, durations in ms, with the ratio to a
+    baseline record if given'''
+    lines = [
+        f'{"stage":<28}{"count":>7}{"min":>11}{"p50":>11}{"max":>11}'
+        + (f'{"vs base":>10}' if baseline else '')
+    ]
+    for name, r in results.items():
+        line = (f'{name:<28}{r["count"]:>7}{r["min"] * 1e3:>11.3f}'
+                f'{r["p50"] * 1e3:>11.3f}{r["max"] * 1e3:>11.3f}')
+        if baseline:
+            base = baseline['stages'].get(name)
+            line += (f'{r["p50"] / base["p50"]:>9.2f}x'
+                     if base else f'{"-":>10}')
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def timings(args, env):
+    '''timing records of the sizes given on the command line'''
+    history = load_results(args.out)
+    records = []
+    for size in args.size or ['default']:
+        results = run(size, args.seed, args.repeat, not args.no_legacy,
+                      args.only)
+        baseline = None
+        if args.baseline:
+            matches = [
+                r for r in history if r['size'] == size and
+                (args.baseline == 'last' or args.baseline in
+                 (r.get('commit'), r.get('label')))
+            ]
+            baseline = matches[-1] if matches else None
+            if baseline is None:
+                print(f'No {size} record {args.baseline!r} in {args.out}')
+        print(f'\n{size}: {SIZES[size]}')
+        print(report(results, baseline))
+        records.append({
+            'timestamp': time.time(),
+            'label': args.label,
+            'size': size,
+            'seed': args.seed,
+            'params': SIZES[size],
+            **env,
+            'stages': results
+        })
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the host-side math of the calibration and of a '
+        'sweep pass on synthetic resonator data, or measure the accuracy of '
+        'the dip frequencies.')
+    parser.add_argument('--size',
+                        action='append',
+                        choices=sorted(SIZES),
+                        help='data size, repeatable (default: default)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='minimum timed runs per stage (default 20)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='only the stages containing this')
+    parser.add_argument('--no-legacy',
+                        action='store_true',
+                        help='skip the scipy.optimize stages used before')
+    parser.add_argument('--out',
+                        default='./res/benchmark.jsonl',
+                        help='results appended here (default %(default)s)')
+    parser.add_argument('--label', default='', help='label of the record')
+    parser.add_argument('--baseline',
+                        help='commit or label of a record to compare with; '
+                        'the latest record of the size if "last"')
+    parser.add_argument('--accuracy',
+                        action='store_true',
+                        help='error of the grid and refined dips against '
+                        'the pass points, instead of the timings')
+    parser.add_argument('--points',
+                        type=int,
+                        nargs='+',
+                        default=[40, 60, 100, 150, 250],
+                        help='pass points of the accuracy curve')
+    parser.add_argument('--trials', type=int, default=10,
+                        help='sensor placements of the accuracy curve')
+    parser.add_argument('--plot', help='figure of the accuracy curve')
+    args = parser.parse_args(argv)
+    env = environment()
+    if args.accuracy:
+        curve = accuracy(args.points, args.trials, args.seed)
+        print(accuracy_report(curve))
+        if args.plot:
+            plot_accuracy(curve, args.plot)
+        records = [{
+            'timestamp': time.time(),
+            'label': args.label,
+            'size': 'accuracy',
+            'seed': args.seed,
+            'params': {'points': args.points, 'trials': args.trials},
+            **env,
+            'curve': curve
+        }]
+    else:
+        records = timings(args, env)
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+    return records
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+import json
+import os
+import time
+import numpy as np
+import DACFunctions as dacfunc
+import ResonatorFit as rf
+from E4990AFunctions import triggerBasicSweep
+from ModelFunctions import C2F_func
+from Settling import as_model
+from Timing import span
+
+
+class CalibrationIndex:
+    """Index of the C2F files by the reader they were measured with.
+
+    A calibration is only valid for the reader parameters (``FITTED_PARA``),
+    the code range and the frequency band it was measured with, so it is
+    looked up by these instead of by the date in its file name.
+
+    Parameters
+    ----------
+    path : str
+        JSON file of the index, e.g. ``./res/C2F_index.json``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def add(self, c2f_path, fitted_para, code_range, band, para_C2F):
+        """Records a C2F file, replacing an older record of the same file.
+
+        Parameters
+        ----------
+        c2f_path : str
+            Path of the C2F text file.
+        fitted_para : array_like
+            ``[L, C, R]`` of the reader.
+        code_range : tuple
+            ``(startCode, stopCode, stepCode)`` of the calibration.
+        band : tuple
+            ``(startFrequency, stopFrequency)`` of the calibration.
+        para_C2F : array_like
+            Fitted coefficients stored in the file.
+        """
+        self.entries = [
+            e for e in self.entries
+            if os.path.abspath(e['file']) != os.path.abspath(c2f_path)
+        ]
+        self.entries.append({
+            'file': c2f_path,
+            'fitted_para': [float(v) for v in fitted_para],
+            'code_range': [int(v) for v in code_range],
+            'band': [float(v) for v in band],
+            'para_C2F': [float(v) for v in para_C2F],
+            'timestamp': time.time()
+        })
+        with open(self.path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        return
+
+    def find(self, fitted_para, code_range, band):
+        """Latest existing C2F file measured with these parameters.
+
+        Returns
+        -------
+        dict or None
+            Record of the file, see ``add``.
+        """
+        for e in sorted(self.entries, key=lambda e: -e['timestamp']):
+            if (np.allclose(e['fitted_para'], fitted_para, rtol=1e-9, atol=0)
+                    and e['code_range'] == [int(v) for v in code_range]
+                    and np.allclose(e['band'], band, rtol=1e-9, atol=0)
+                    and os.path.exists(e['file'])):
+                return e
+        return None
+
+
+def read_C2F(path):
+    """Reads a C2F file written by ``write_C2F``.
+
+    Returns
+    -------
+    para_C2F : list of float
+    C2F_np : numpy.ndarray
+        ``[code, freq]`` rows.
+    """
+    with open(path, 'r') as f:
+        lines = [line.split() for line in f if line.strip()]
+    # The header wraps over two lines with the default NumPy print width
+    para_C2F = []
+    k = 0
+    while len(para_C2F) < 6 and k < len(lines):
+        para_C2F += [float(v) for v in lines[k]]
+        k += 1
+    return para_C2F, np.array(lines[k:], dtype=float).reshape(-1, 2)
+
+
+def write_C2F(path, para_C2F, C2F_np):
+    '''C2F rows with the coefficients as header, as C2F_Calibr saves them'''
+    np.savetxt(path,
+               C2F_np,
+               header=str(np.asarray(para_C2F))[1:-1],
+               comments='')
+    return
+
+
+def measure_codes(inst_E,
+                  inst_AD,
+                  codes,
+                  startfreq,
+                  stopfreq,
+                  sp=201,
+                  previous=None,
+                  settle=0.005):
+    """Resonant frequency of the reader at each ascending DAC code.
+
+    Each code is applied, an impedance sweep is taken and ``F2Z_func`` is
+    fitted. As in ``C2F_Calibr``, the sweep window of a code follows the
+    resonance of the code before it, so a code measured again sees the
+    same window as during the calibration.
+
+    Parameters
+    ----------
+    inst_E
+        E4990A VISA resource, measuring ``Z``.
+    inst_AD
+        Reference to the connection to the ACE Application.
+    codes : array_like
+        Ascending DAC codes to measure.
+    startfreq, stopfreq : float
+        Frequency band of the reader.
+    sp : int
+        Points of each impedance sweep.
+    previous : float, optional
+        Resonance of the calibration code before the first code; the first
+        sweep covers the whole band if omitted.
+    settle : float or SettlingModel
+        Wait after every DAC write in s, or the model of the wait from the
+        size of the code step.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``[code, freq]`` rows of the codes with a resonance in the band.
+    """
+    F1, F2 = startfreq, stopfreq
+    if previous is not None:
+        F1 = int(max(startfreq, previous * 0.95))
+        F2 = int(min(stopfreq, previous * 1.15))
+    settling = as_model(settle)
+    rows = []
+    last = None
+    for code in codes:
+        dacfunc.write_dac_code(inst_AD, int(code), 20, True)
+        time.sleep(settling.wait(None if last is None else code - last))
+        last = code
+        imp, freq = triggerBasicSweep(inst_E, F1, F2, sp)
+        # Fit the sweep result, the resonant frequency is 1/(2*pi*sqrt(LC))
+        with span('fit.F2Z'):
+            peakF = rf.resonance(rf.fit_F2Z(freq, imp))
+        if startfreq * 1.01 < peakF < stopfreq * 0.99:  # valid data
+            rows.append([int(code), peakF])
+        F1 = int(max(startfreq, peakF * 0.95))
+        F2 = int(min(stopfreq, peakF * 1.15))
+    return np.array(rows, dtype=float).reshape(-1, 2)
+
+
+def check_drift(inst_E,
+                inst_AD,
+                para_C2F,
+                C2F_np,
+                spots,
+                startfreq,
+                stopfreq,
+                sp=201,
+                settle=0.005):
+    """Spot-measures a few calibration codes again.
+
+    The spots are calibration rows spread evenly over the code range. The
+    drift compares the new resonance with the calibrated one; the fit error
+    compares the calibrated resonance with ``C2F_func(para_C2F, code)``.
+
+    Parameters
+    ----------
+    para_C2F, C2F_np
+        Calibration to check.
+    spots : int
+        Number of spot codes.
+    inst_E, inst_AD, startfreq, stopfreq, sp, settle
+        See ``measure_codes``.
+
+    Returns
+    -------
+    numpy.ndarray
+        Rows ``[row, code, measured, calibrated, drift, fit error]`` of the
+        spots with a resonance in the band, errors relative.
+    """
+    rows = []
+    for k in np.unique(np.linspace(0, len(C2F_np) - 1, spots).round()):
+        k = int(k)
+        measured = measure_codes(inst_E, inst_AD, C2F_np[k:k + 1, 0],
+                                 startfreq, stopfreq, sp,
+                                 C2F_np[k - 1, 1] if k > 0 else None,
+                                 settle)
+        if len(measured):
+            rows.append([k, C2F_np[k, 0], measured[0, 1], C2F_np[k, 1]])
+    rows = np.array(rows, dtype=float).reshape(-1, 4)
+    fitted = C2F_func(np.asarray(para_C2F, dtype=float), rows[:, 1])
+    return np.column_stack([
+        rows, (rows[:, 2] - rows[:, 3]) / rows[:, 3],
+        (rows[:, 3] - fitted) / fitted
+    ])
+
+
+def recalibrate(inst_E,
+                inst_AD,
+                para_C2F,
+                C2F_np,
+                code_range,
+                startfreq,
+                stopfreq,
+                sp=201,
+                spots=7,
+                threshold=5e-4,
+                settle=0.005):
+    """Re-measures the code ranges that drifted from the calibration.
+
+    ``spots`` calibration codes are checked with ``check_drift``. Around
+    every spot whose drift exceeds ``threshold`` the calibration codes up
+    to the neighbouring spots are measured again, replacing the old rows,
+    and the polynomial is refitted.
+
+    Parameters
+    ----------
+    para_C2F, C2F_np
+        Current calibration.
+    code_range : tuple
+        ``(startCode, stopCode, stepCode)`` of the calibration.
+    spots : int
+        Number of spot codes of the drift check.
+    threshold : float
+        Relative drift of the resonance tolerated at a spot code.
+    inst_E, inst_AD, startfreq, stopfreq, sp, settle
+        See ``measure_codes``.
+
+    Returns
+    -------
+    para_C2F : numpy.ndarray
+    C2F_np : numpy.ndarray
+        Updated calibration, unchanged if no spot drifted.
+    report : dict
+        ``drift`` rows of ``check_drift``, re-measured code ``ranges`` and
+        the number of ``remeasured`` codes.
+    """
+    startCode, stopCode, stepCode = code_range
+    grid = np.arange(startCode, stopCode + 1, stepCode)
+    drift = check_drift(inst_E, inst_AD, para_C2F, C2F_np, spots, startfreq,
+                        stopfreq, sp, settle)
+    report = {'drift': drift, 'ranges': [], 'remeasured': 0}
+    spot_rows = drift[:, 0].astype(int)
+    bad = np.flatnonzero(np.abs(drift[:, 4]) > threshold)
+    if len(bad) == 0:
+        return np.asarray(para_C2F, dtype=float), C2F_np, report
+    # Each drifted spot extends to its neighbouring spots, merged
+    ranges = []
+    for j in bad:
+        lo = C2F_np[spot_rows[j - 1], 0] if j > 0 else startCode
+        hi = (C2F_np[spot_rows[j + 1], 0]
+              if j + 1 < len(spot_rows) else stopCode)
+        if ranges and lo <= ranges[-1][1]:
+            ranges[-1][1] = hi
+        else:
+            ranges.append([lo, hi])
+    keep = np.ones(len(C2F_np), dtype=bool)
+    new_rows = []
+    for lo, hi in ranges:
+        codes = grid[(grid >= lo) & (grid <= hi)]
+        before = np.flatnonzero(C2F_np[:, 0] < lo)
+        keep &= (C2F_np[:, 0] < lo) | (C2F_np[:, 0] > hi)
+        new_rows.append(
+            measure_codes(inst_E, inst_AD, codes, startfreq, stopfreq, sp,
+                          C2F_np[before[-1], 1] if len(before) else None,
+                          settle))
+        report['remeasured'] += len(codes)
+    C2F_np = np.vstack([C2F_np[keep]] + new_rows)
+    C2F_np = C2F_np[np.argsort(C2F_np[:, 0])]
+    with span('fit.C2F'):
+        para_C2F = rf.fit_C2F(C2F_np[:, 0], C2F_np[:, 1])
+    report['ranges'] = [[int(lo), int(hi)] for lo, hi in ranges]
+    return para_C2F, C2F_np, report
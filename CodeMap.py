@@ -0,0 +1,235 @@
+import os
+import numpy as np
+from ModelFunctions import C2F_func
+
+
+class CodeMap:
+    """Dense frequency -> DAC code table built from the C2F calibration.
+
+    The fitted ``C2F_func`` polynomial is evaluated once on every code of the
+    calibrated range and inverted by a table lookup, which replaces the
+    per-point ``op.fsolve`` of the sweep loop.
+
+    Parameters
+    ----------
+    codes : numpy.ndarray
+        Ascending DAC codes of the table.
+    freqs : numpy.ndarray
+        Resonant frequency ``C2F_func(para_C2F, codes)`` of every code.
+    para_C2F : numpy.ndarray
+        Coefficients the table was built from, used to validate the cache.
+    """
+
+    def __init__(self, codes, freqs, para_C2F):
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.para_C2F = np.asarray(para_C2F, dtype=float)
+        # The running maximum is the monotonic envelope used for the lookup:
+        # a frequency always maps to the first (lowest) code reaching it,
+        # which is the root fsolve finds when started from the lowest code.
+        self.envelope = np.maximum.accumulate(self.freqs)
+        self.nonmonotonic = self._find_nonmonotonic()
+
+    def _find_nonmonotonic(self):
+        '''[code_start, code_stop, f_low, f_high] of every fold-back of the fit'''
+        shadowed = self.freqs < self.envelope
+        if not shadowed.any():
+            return np.empty((0, 4))
+        edges = np.flatnonzero(np.diff(np.r_[0, shadowed.astype(np.int8), 0]))
+        ranges = []
+        for first, last in zip(edges[0::2], edges[1::2] - 1):
+            # The fold starts one code earlier, at the local maximum
+            first = max(first - 1, 0)
+            ranges.append([
+                self.codes[first], self.codes[last],
+                self.freqs[first:last + 1].min(), self.envelope[last]
+            ])
+        return np.array(ranges)
+
+    def codes_for(self, freqs):
+        """Resolves the DAC codes of a whole frequency plan.
+
+        Parameters
+        ----------
+        freqs : array_like
+            Target resonant frequencies.
+
+        Returns
+        -------
+        numpy.ndarray
+            Integer codes, -1 where the frequency is outside the table.
+        """
+        freqs = np.asarray(freqs, dtype=float)
+        env = self.envelope
+        idx = np.clip(np.searchsorted(env, freqs, side='left'), 1,
+                      len(env) - 1)
+        f_lo = env[idx - 1]
+        f_hi = env[idx]
+        span = np.where(f_hi > f_lo, f_hi - f_lo, 1.0)
+        frac = np.clip((freqs - f_lo) / span, 0.0, 1.0)
+        codes = self.codes[idx - 1] + frac * (self.codes[idx] -
+                                              self.codes[idx - 1])
+        codes = np.around(codes).astype(np.int64)
+        return np.where((freqs < env[0]) | (freqs > env[-1]), -1, codes)
+
+    def code_for(self, freq):
+        '''code of a single frequency, -1 if out of range'''
+        return int(self.codes_for([freq])[0])
+
+    def flags_for(self, freqs):
+        """Marks the frequencies that fall in a non-monotonic range of the fit.
+
+        Parameters
+        ----------
+        freqs : array_like
+            Target resonant frequencies.
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean mask, True where more than one code reaches the frequency.
+        """
+        freqs = np.asarray(freqs, dtype=float)
+        flags = np.zeros(freqs.shape, dtype=bool)
+        for _, _, f_low, f_high in self.nonmonotonic:
+            flags |= (freqs >= f_low) & (freqs <= f_high)
+        return flags
+
+    def groups_for(self, freqs, tolerance, offset=1.0):
+        """Groups an ascending frequency plan into runs sharing one DAC code.
+
+        Consecutive frequencies are grouped as long as the resonance of the
+        shared code stays within ``tolerance`` (relative) of every target
+        ``freq * offset``, so one code covers as many points as possible.
+
+        Parameters
+        ----------
+        freqs : array_like
+            Ascending frequencies to measure.
+        tolerance : float
+            Allowed relative distance between target and resonance.
+        offset : float
+            Target resonance relative to the measured frequency.
+
+        Returns
+        -------
+        list of tuple
+            ``(code, freqs)`` of every group, code is -1 out of range.
+        """
+        freqs = np.asarray(freqs, dtype=float)
+        if np.any(np.diff(freqs) <= 0):
+            raise ValueError('the frequency plan must be ascending')
+        groups = []
+        first = 0
+        while first < len(freqs):
+            last = np.searchsorted(freqs,
+                                   freqs[first] * (1 + 2 * tolerance),
+                                   side='right')
+            last = max(last, first + 1)
+            center = 0.5 * (freqs[first] + freqs[last - 1]) * offset
+            groups.append((self.code_for(center), freqs[first:last]))
+            first = last
+        return groups
+
+    def save(self, path):
+        np.savez(path,
+                 codes=self.codes,
+                 freqs=self.freqs,
+                 para_C2F=self.para_C2F)
+        return
+
+
+def list_tolerance(fitted_para, freqs, fraction=0.15):
+    """Detuning tolerance of a list sweep from the reader bandwidth.
+
+    The parallel RLC reader of ``fitted_para`` has Q = R / (2 pi f L),
+    highest at the lowest frequency of the plan; the tolerance is a
+    ``fraction`` of its relative half-power half-width 1 / (2 Q) there.
+
+    Parameters
+    ----------
+    fitted_para : array_like
+        ``[L, C, R]`` of the reader.
+    freqs : array_like
+        Frequencies of the plan.
+    fraction : float
+        Fraction of the half-width.
+
+    Returns
+    -------
+    float
+        Relative tolerance for ``CodeMap.groups_for``.
+    """
+    L, _, R = fitted_para
+    Q = R / (2 * np.pi * np.min(freqs) * L)
+    return fraction / (2 * Q)
+
+
+def build_code_map(para_C2F, C2F_np, code_min=None, code_max=None, step=1):
+    """Builds the frequency -> code table in one vectorized evaluation.
+
+    Parameters
+    ----------
+    para_C2F : array_like
+        Coefficients of ``C2F_func``.
+    C2F_np : numpy.ndarray
+        Calibration data, ``[:, 0]`` is code; its range is the default range.
+    code_min, code_max : int, optional
+        Code range of the table, e.g. the allowed ``startCode``/``stopCode``.
+    step : int
+        Code step of the table.
+
+    Returns
+    -------
+    CodeMap
+    """
+    C2F_np = np.asarray(C2F_np)
+    if code_min is None:
+        code_min = C2F_np[:, 0].min()
+    if code_max is None:
+        code_max = C2F_np[:, 0].max()
+    codes = np.arange(int(code_min), int(code_max) + 1, step, dtype=np.int64)
+    freqs = C2F_func(np.asarray(para_C2F, dtype=float), codes.astype(float))
+    return CodeMap(codes, freqs, para_C2F)
+
+
+def code_map_path(c2f_path):
+    '''cache file stored next to the C2F file'''
+    return os.path.splitext(c2f_path)[0] + '.codemap.npz'
+
+
+def load_code_map(c2f_path, para_C2F, C2F_np, code_min=None, code_max=None,
+                  step=1):
+    """Loads the cached table of a C2F file, building it if missing or stale.
+
+    Parameters
+    ----------
+    c2f_path : str
+        Path of the C2F text file the calibration belongs to.
+    para_C2F, C2F_np, code_min, code_max, step
+        See ``build_code_map``.
+
+    Returns
+    -------
+    CodeMap
+    """
+    C2F_np = np.asarray(C2F_np)
+    if code_min is None:
+        code_min = C2F_np[:, 0].min()
+    if code_max is None:
+        code_max = C2F_np[:, 0].max()
+    path = code_map_path(c2f_path)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            codes = data['codes']
+            if (np.array_equal(data['para_C2F'],
+                               np.asarray(para_C2F, dtype=float))
+                    and len(codes) > 1 and codes[0] == int(code_min)
+                    and codes[1] - codes[0] == step
+                    and codes[-1] == int(code_max) -
+                    (int(code_max) - int(code_min)) % step):
+                return CodeMap(codes, data['freqs'], data['para_C2F'])
+    code_map = build_code_map(para_C2F, C2F_np, code_min, code_max, step)
+    if os.path.isdir(os.path.dirname(path) or '.'):
+        code_map.save(path)
+    return code_map
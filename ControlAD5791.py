@@ -1,5 +1,8 @@
 import ACERemoteController as arc
 import DACFunctions as dacfunc
+from DACService import DACClient
+from AD5791Driver import AD5791Direct, serial_transport
+from Timing import TIMINGS
 import time
 
 # Constants
@@ -7,36 +10,57 @@ board = 'EVAL-AD5791SDZ'
 chip = 'AD5791'
 # Set the ACE installation path
 ace_path = r'C:\Program Files (x86)\Analog Devices\ACE'
+# 'host:port' of a running DACService.py, ACE is opened here if None
+dac_service = None
+# 'spi' sends the SPI frames to the USB-SPI bridge at spi_port instead of ACE
+dac_backend = 'ace'
+spi_port = None
+resolution = 20
 
-AD5791 = arc.establish_connection(board, chip, ace_path)
-arc.reset(AD5791)
-dacfunc.write_dac_code(AD5791, 0x99000, 20, True) 
-dacfunc.remove_output_clamp(AD5791)
 
-resolution = 20
+def main():
+    if dac_service:
+        AD5791 = DACClient(dac_service)
+    else:
+        if dac_backend == 'spi':
+            AD5791 = AD5791Direct(serial_transport(spi_port))
+        else:
+            AD5791 = arc.establish_connection(board, chip, ace_path)
+        dacfunc.initialize_output(AD5791, 0x99000, 20, True)
+
+    # vol_set = 0
+    # V_refP = 10.0029
+    # V_refN = -10.0029
+    # code = bin((vol_set - V_refN) * (2 ^ 20 - 1) / (V_refP - V_refN))
+
+    # while (True):
+    #     dacfunc.write_dac_code(AD5791, 0x9E040, 20, False)
+    #     time.sleep(0.001)
+    #     dacfunc.write_dac_code(AD5791, 0xFE620, 20, False)
+    #     time.sleep(0.001)
 
-# vol_set = 0
-# V_refP = 10.0029
-# V_refN = -10.0029
-# code = bin((vol_set - V_refN) * (2 ^ 20 - 1) / (V_refP - V_refN))
+    code1 = 0x90000
+    code2 = 0xF0000
+    # code = code2
+    t1 = time.perf_counter()
 
-# while (True):
-#     dacfunc.write_dac_code(AD5791, 0x9E040, 20, False)
-#     time.sleep(0.001)
-#     dacfunc.write_dac_code(AD5791, 0xFE620, 20, False)
-#     time.sleep(0.001)
+    for i in range(100):
+        dacfunc.write_dac_code(AD5791, code1, 20, True)
+        dacfunc.write_dac_code(AD5791, code2, 20, True)
+        # code = code + 0x0100
 
-code1 = 0x90000
-code2 = 0xF0000
-# code = code2
-t1 = time.perf_counter()
+    t2 = time.perf_counter()
+    print(t2 - t1)
+    # The same codes queued, in one transfer with the SPI backend
+    t1 = time.perf_counter()
+    dacfunc.write_dac_codes(AD5791, [code1, code2] * 100, 20, True)
+    t2 = time.perf_counter()
+    print(t2 - t1)
+    # Split of the time over the ACE calls
+    print(TIMINGS.report())
 
-for i in range(100):
-    dacfunc.write_dac_code(AD5791, code1, 20, True)
-    dacfunc.write_dac_code(AD5791, code2, 20, True)
-    # code = code + 0x0100
+    arc.close_connection(AD5791)
 
-t2 = time.perf_counter()
-print(t2 - t1)
 
-arc.close_connection(AD5791)
+if __name__ == '__main__':
+    main()
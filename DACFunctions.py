@@ -36,7 +36,8 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS 
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from ACERemoteController import write_to_bitfield
+from ACERemoteController import (write_to_bitfield, batch, reset,
+                                  invalidate_shadow)
 
 def write_dac_code(client, code, resolution, isencoding2scomplement):
     """Writes the specifed value to the DAC_Register_Data bitfield.
@@ -57,6 +58,34 @@ def write_dac_code(client, code, resolution, isencoding2scomplement):
     write_to_bitfield(client, "DAC_Register_Data", code)
     return
 
+def write_dac_codes(client, codes, resolution, isencoding2scomplement):
+    """Writes several codes one after another, as fast as the client allows.
+
+    A client with ``write_codes``, such as ``AD5791Driver.AD5791Direct``,
+    gets all codes in one transfer; the others get one ``write_dac_code``
+    per code.
+
+    Parameters
+    ----------
+    client
+        Reference to the connection to the ACE Application.
+    codes : iterable of int
+        DAC codes in the order they are applied.
+    resolution : int
+        Resolution of the device.
+    isencoding2scomplement : bool
+        Whether 2s complement data is written (true), or straight binary (false).
+    """
+    if not hasattr(client, 'write_codes'):
+        for code in codes:
+            write_dac_code(client, code, resolution, isencoding2scomplement)
+        return
+    flip = (1 << (resolution - 1)) if isencoding2scomplement else 0
+    client.write_codes([int(code) ^ flip for code in codes])
+    # The register shadow does not know the last code
+    invalidate_shadow(client)
+    return
+
 def remove_output_clamp(client):
     """Removes the Output clamp so that the device output responds to the code values.
 
@@ -66,4 +95,28 @@ def remove_output_clamp(client):
         Reference to the connection to the ACE Application.
     """
     write_to_bitfield(client, "OPGND", 0)
-    return
\ No newline at end of file
+    return
+
+def initialize_output(client, code, resolution, isencoding2scomplement):
+    """Resets the device, sets the first code and removes the output clamp.
+
+    The code and the clamp are applied together with one @ApplySettings;
+    ACE writes the DAC register before the control register, so the output
+    is released at the requested voltage.
+
+    Parameters
+    ----------
+    client
+        Reference to the connection to the ACE Application.
+    code : int
+        Integer value of DAC code to be written.
+    resolution : int
+        Resolution of the device.
+    isencoding2scomplement : bool
+        Whether 2s complement data is written (true), or straight binary (false).
+    """
+    reset(client)
+    with batch(client):
+        write_dac_code(client, code, resolution, isencoding2scomplement)
+        remove_output_clamp(client)
+    return
@@ -0,0 +1,449 @@
+import argparse
+import json
+import socket
+import socketserver
+import threading
+import time
+import ACERemoteController as arc
+from AD5791Driver import (AD5791Direct, LoopbackSPI, LoopbackStream,
+                          StreamTransport, serial_transport)
+from Timing import span
+
+DEFAULT_ADDRESS = ('127.0.0.1', 5791)
+
+
+class DACService:
+    """Resident owner of the ACE session of one AD5791.
+
+    Loading the ACE client, adding the hardware plugin and resetting the
+    DAC is paid once, when the service starts, instead of by every script.
+    The scripts connect with ``DACClient`` and share the session; requests
+    are serialized, so the DAC sees one writer at a time.
+
+    Every bitfield applied is remembered. If an ACE call fails, the session
+    is closed and opened again, the DAC is reset and the remembered values
+    are applied before the call is retried, so a reconnect does not leave
+    the output clamped or at another voltage.
+
+    Parameters
+    ----------
+    connect : callable
+        Opens the ACE session, e.g. ``ACERemoteController.establish_connection``
+        bound to the board; called again to reconnect.
+    initial_code : int, optional
+        DAC code applied, with the output clamp removed, when the service
+        starts; the output stays clamped if omitted.
+    resolution : int
+        Resolution of the device.
+    isencoding2scomplement : bool
+        Whether 2s complement data is written (true), or straight binary (false).
+    retries : int
+        Reconnections tried for one request.
+    """
+
+    def __init__(self,
+                 connect,
+                 initial_code=0x99000,
+                 resolution=20,
+                 isencoding2scomplement=True,
+                 retries=1):
+        self.connect = connect
+        self.resolution = resolution
+        self.isencoding2scomplement = isencoding2scomplement
+        self.retries = retries
+        self.client = None
+        # Bitfields applied, restored after a reconnect
+        self.registers = {}
+        if initial_code is not None:
+            self.registers = {
+                'DAC_Register_Data': self.encode(initial_code),
+                'OPGND': 0
+            }
+        self.staged = {}  # bitfields of set_many waiting for apply
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.reconnects = 0
+        self.started = time.time()
+        self.server = None
+
+    def encode(self, code):
+        '''DAC_Register_Data value of a code, as write_dac_code writes it'''
+        code = int(code)
+        if self.isencoding2scomplement:
+            code = code ^ (1 << (self.resolution - 1))
+        return code
+
+    def open(self):
+        '''connects to ACE now rather than on the first request'''
+        return self._call(lambda client: None)
+
+    def close(self):
+        '''stops serving and releases the ACE session'''
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        with self.lock:
+            self._drop()
+        return
+
+    def set_code(self, code):
+        '''applies one DAC code'''
+        return self.set_many({'DAC_Register_Data': self.encode(code)})
+
+    def set_many(self, bitfields, apply=True):
+        """Writes several bitfields.
+
+        Parameters
+        ----------
+        bitfields : dict
+            Values by bitfield name, as in the memory map within ACE.
+        apply : bool
+            Apply them, with the ones staged before, in one @ApplySettings;
+            otherwise they are staged until ``apply``.
+        """
+        bitfields = {name: int(val) for name, val in bitfields.items()}
+        if not apply:
+            with self.lock:
+                self.staged.update(bitfields)
+            return
+        return self._call(lambda client: self._write(client, bitfields))
+
+    def apply(self):
+        '''applies the staged bitfields'''
+        return self._call(lambda client: self._write(client, {}))
+
+    def reset(self):
+        '''resets the DAC, the output is clamped until the next writes'''
+
+        def do(client):
+            arc.reset(client)
+            self.registers = {}
+            self.staged = {}
+
+        return self._call(do)
+
+    def status(self):
+        '''state of the service, as returned by the status request'''
+        with self.lock:
+            code = self.registers.get('DAC_Register_Data')
+            if code is not None and self.isencoding2scomplement:
+                code = code ^ (1 << (self.resolution - 1))
+            return {
+                'connected': self.client is not None,
+                'code': code,
+                'registers': dict(self.registers),
+                'staged': dict(self.staged),
+                'requests': self.requests,
+                'reconnects': self.reconnects,
+                'uptime': time.time() - self.started
+            }
+
+    def handle(self, request):
+        """Executes one request of the socket API.
+
+        Parameters
+        ----------
+        request : dict
+            ``op`` and its arguments: ``set`` with ``code``, ``set_many``
+            with ``bitfields`` and ``apply``, ``apply``, ``reset``,
+            ``status`` or ``shutdown``.
+
+        Returns
+        -------
+        dict
+            ``ok`` and the ``status`` of the service, or ``error``.
+        """
+        op = request.get('op')
+        try:
+            if op == 'set':
+                self.set_code(request['code'])
+            elif op == 'set_many':
+                self.set_many(request['bitfields'], request.get('apply', True))
+            elif op == 'apply':
+                self.apply()
+            elif op == 'reset':
+                self.reset()
+            elif op == 'shutdown':
+                threading.Thread(target=self.close, daemon=True).start()
+            elif op != 'status':
+                raise ValueError(f'unknown request {op!r}')
+        except Exception as ex:
+            return {'ok': False, 'error': f'{type(ex).__name__}: {ex}'}
+        return {'ok': True, 'status': self.status()}
+
+    def serve(self, address=DEFAULT_ADDRESS):
+        """Serves the socket API until ``close`` or a shutdown request.
+
+        Every connection sends requests as JSON lines and gets one JSON line
+        back per request, see ``handle``.
+        """
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line)
+                    except ValueError as ex:
+                        response = {'ok': False, 'error': f'bad request: {ex}'}
+                    else:
+                        response = service.handle(request)
+                    self.wfile.write(json.dumps(response).encode() + b'\n')
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server(tuple(address), Handler)
+        self.server.serve_forever()
+        return
+
+    def _call(self, do):
+        with self.lock:
+            self.requests += 1
+            for attempt in range(self.retries + 1):
+                try:
+                    if self.client is None:
+                        self._reconnect()
+                    return do(self.client)
+                except Exception as ex:
+                    if attempt == self.retries:
+                        raise
+                    print(f'ACE call failed ({type(ex).__name__}: {ex}), '
+                          'reconnecting')
+                    self._drop()
+                    self.reconnects += 1
+
+    def _reconnect(self):
+        client = self.connect()
+        self.client = client
+        arc.reset(client)
+        if self.registers:
+            with arc.batch(client):
+                for name, val in self.registers.items():
+                    arc.write_to_bitfield(client, name, val)
+        return
+
+    def _drop(self):
+        client, self.client = self.client, None
+        if client is None:
+            return
+        try:
+            arc.close_connection(client)
+        except Exception:
+            arc.invalidate_shadow(client)
+        return
+
+    def _write(self, client, bitfields):
+        bitfields = {**self.staged, **bitfields}
+        if bitfields:
+            with arc.batch(client):
+                for name, val in bitfields.items():
+                    arc.write_to_bitfield(client, name, val)
+        self.registers.update(bitfields)
+        self.staged = {}
+        return
+
+
+class DACClient:
+    """Client of a ``DACService``, usable in place of the ACE client.
+
+    ``SetBitfield`` only stages a value and ``Run('@ApplySettings')`` sends
+    the staged values in one request, so ``DACFunctions`` and
+    ``ACERemoteController`` work unchanged on top of the service, with one
+    round-trip per applied DAC code. The service keeps the register shadow
+    shared by all its clients.
+
+    Parameters
+    ----------
+    address : str or tuple
+        ``'host:port'`` or ``(host, port)`` of the service.
+    timeout : float
+        Socket timeout in s.
+    """
+
+    remote_shadow = True  # ACERemoteController leaves the shadow to the service
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=10.0):
+        if isinstance(address, str):
+            host, port = address.rsplit(':', 1)
+            address = (host, int(port))
+        self.address = tuple(address)
+        self.timeout = timeout
+        self.staged = {}
+        self.lock = threading.Lock()
+        self._sock = None
+        self._file = None
+        self.last_status = None
+
+    def request(self, op, **args):
+        """Sends one request, reconnecting once if the connection broke.
+
+        Returns
+        -------
+        dict
+            Status of the service after the request.
+        """
+        message = json.dumps({'op': op, **args}).encode() + b'\n'
+        with self.lock, span('dac.request'):
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._sock = socket.create_connection(
+                            self.address, self.timeout)
+                        self._sock.setsockopt(socket.IPPROTO_TCP,
+                                              socket.TCP_NODELAY, 1)
+                        self._file = self._sock.makefile('rb')
+                    self._sock.sendall(message)
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError('the DAC service closed the '
+                                              'connection')
+                    break
+                except OSError:
+                    self._disconnect()
+                    if attempt == 1:
+                        raise
+        response = json.loads(line)
+        if not response['ok']:
+            raise RuntimeError(f"DAC service: {response['error']}")
+        self.last_status = response['status']
+        return self.last_status
+
+    def set_code(self, code):
+        '''applies one DAC code, encoded by the service'''
+        return self.request('set', code=int(code))
+
+    def set_many(self, bitfields, apply=True):
+        '''writes several bitfields, see DACService.set_many'''
+        return self.request('set_many',
+                            bitfields={n: int(v)
+                                       for n, v in bitfields.items()},
+                            apply=apply)
+
+    def apply(self):
+        return self.request('apply')
+
+    def status(self):
+        return self.request('status')
+
+    def shutdown(self):
+        '''stops the service'''
+        return self.request('shutdown')
+
+    # Interface of the ACE remote client used by ACERemoteController
+
+    def AddHardwarePlugin(self, board):
+        return
+
+    def set_ContextPath(self, path):
+        return
+
+    def SetBitfield(self, bitfieldname, val):
+        self.staged[bitfieldname] = int(val)
+        return
+
+    def Run(self, script):
+        if script == '@ApplySettings':
+            staged, self.staged = self.staged, {}
+            self.set_many(staged)
+        elif script == '@Reset':
+            self.staged = {}
+            self.request('reset')
+        else:
+            raise ValueError(f'{script} is not supported by the DAC service')
+        return
+
+    def CloseSession(self):
+        '''closes the connection, the service keeps running'''
+        with self.lock:
+            self._disconnect()
+        return
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._file = None
+        return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Keep the ACE session of the AD5791 open and share it '
+        'with the measurement scripts over a local socket.')
+    parser.add_argument('--host', default=DEFAULT_ADDRESS[0])
+    parser.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1])
+    parser.add_argument('--board', default='EVAL-AD5791SDZ')
+    parser.add_argument('--chip', default='AD5791')
+    parser.add_argument('--ace-path',
+                        default=r'C:\Program Files (x86)\Analog Devices\ACE')
+    parser.add_argument('--initial-code',
+                        type=lambda v: int(v, 0),
+                        default=0x99000,
+                        help='code applied at start (default 0x99000)')
+    parser.add_argument('--spi-port',
+                        help='drive the AD5791 with SPI frames through the '
+                        'USB-SPI bridge at this serial port instead of ACE')
+    parser.add_argument('--spi-ldac',
+                        default='sync',
+                        choices=('sync', 'software', 'pin'),
+                        help='LDAC handling of the SPI driver')
+    parser.add_argument('--spi-ldac-line',
+                        choices=('rts', 'dtr'),
+                        help='line of the bridge wired to LDAC, needed by '
+                        '--spi-ldac pin')
+    parser.add_argument('--simulate',
+                        action='store_true',
+                        help='drive a FakeACEClient instead of ACE, or a '
+                        'LoopbackSPI behind a bridge with --spi-port')
+    args = parser.parse_args(argv)
+    if args.simulate:
+        import InstrumentSimulator as sim
+        twin = sim.ResonatorTwin()
+
+        def connect():
+            if args.spi_port:
+                return AD5791Direct(
+                    StreamTransport(
+                        LoopbackStream(
+                            LoopbackSPI(twin, args.spi_ldac == 'sync')),
+                        args.spi_ldac_line), args.spi_ldac)
+            return sim.FakeACEClient(twin, latency={'Run': 0.005})
+    elif args.spi_port:
+
+        def connect():
+            return AD5791Direct(
+                serial_transport(args.spi_port,
+                                 ldac_line=args.spi_ldac_line),
+                args.spi_ldac)
+    else:
+
+        def connect():
+            return arc.establish_connection(args.board, args.chip,
+                                            args.ace_path)
+
+    service = DACService(connect, args.initial_code)
+    t1 = time.perf_counter()
+    service.open()
+    print(f'ACE session opened in {time.perf_counter() - t1:.2f} s, '
+          f'serving on {args.host}:{args.port}')
+    try:
+        service.serve((args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return
+
+
+if __name__ == '__main__':
+    main()
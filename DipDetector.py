@@ -0,0 +1,191 @@
+import numpy as np
+
+
+class DipDetector:
+    """Finds the phase dips of a pass while its points come in.
+
+    The batch path smooths the whole pass with ``gaussian_filter1d`` and
+    runs ``find_peaks(-phase_f, prominence=...)``. Here the smoothed value
+    of a point is computed as soon as the ``radius`` points after it have
+    arrived, with the same kernel, edge reflection and order of operations,
+    so it equals the batch value bit for bit. A dip is confirmed once the
+    smoothed phase rises after it and its prominence, which can only grow
+    with more points, already reaches the threshold. After ``finish`` the
+    dips are exactly those of the batch path.
+
+    Parameters
+    ----------
+    sigma : float
+        Gaussian smoothing of the phase, in points.
+    prominence : float
+        Prominence of a dip in the smoothed phase.
+    expected : int, optional
+        Number of dips after which the pass may stop, see ``done``.
+    truncate : float
+        Radius of the kernel in standard deviations, as in
+        ``gaussian_filter1d``.
+    """
+
+    def __init__(self, sigma=2, prominence=0.05, expected=None, truncate=4.0):
+        self.sigma = float(sigma)
+        self.prominence = prominence
+        self.expected = expected
+        self.radius = int(truncate * self.sigma + 0.5)
+        x = np.arange(-self.radius, self.radius + 1)
+        phi = np.exp(-0.5 / (self.sigma * self.sigma) * x**2)
+        self.weights = (phi / phi.sum())[self.radius:]  # centre and one side
+        self.freqs = []
+        self.phase = []
+        self.smoothed = np.zeros(0)  # final smoothed phase, first points
+        self.dips = []  # indices of the confirmed dips
+        self.finished = False
+        self._next = 1  # next point tested as a peak of -smoothed
+        self._pending = []  # peaks whose prominence is still too low
+
+    @property
+    def done(self):
+        '''the expected number of dips is confirmed'''
+        return self.expected is not None and len(self.dips) >= self.expected
+
+    def push(self, freqs, phase):
+        """Adds the next points of the pass, in ascending frequency.
+
+        Parameters
+        ----------
+        freqs, phase : float or array_like
+            Frequency and mean phase of the points.
+
+        Returns
+        -------
+        list of int
+            Indices of the dips confirmed by these points.
+        """
+        if self.finished:
+            raise RuntimeError('the pass is finished')
+        self.freqs.extend(np.atleast_1d(np.asarray(freqs, dtype=float)))
+        self.phase.extend(np.atleast_1d(np.asarray(phase, dtype=float)))
+        # Points whose window lies within the points received so far
+        final = len(self.phase) - self.radius
+        if final > len(self.smoothed) and len(self.phase) > self.radius:
+            self._smooth(final, False)
+        return self._confirm()
+
+    def finish(self):
+        '''ends the pass, smooths the last points with the reflected edge,
+        returns the indices of the dips confirmed by them'''
+        if not self.finished:
+            self.finished = True
+            if len(self.phase) > len(self.smoothed):
+                self._smooth(len(self.phase), True)
+        return self._confirm()
+
+    def indices(self):
+        '''indices of the confirmed dips, ascending'''
+        return np.array(sorted(self.dips), dtype=int)
+
+    def rows(self, indices=None):
+        """Confirmed dips.
+
+        Parameters
+        ----------
+        indices : array_like, optional
+            Points to describe instead, e.g. dips found by another scan of
+            the same pass.
+
+        Returns
+        -------
+        numpy.ndarray
+            Rows ``[freq, smoothed phase, phase, prominence, index]`` in
+            ascending frequency, as ``Reprocess.find_dips``; the prominence
+            of a dip is final once the phase after it rose above the dip's
+            start or the pass is finished.
+        """
+        if indices is None:
+            indices = self.indices()
+        rows = []
+        for k in np.asarray(indices, dtype=int):
+            rows.append([
+                self.freqs[k], self.smoothed[k], self.phase[k],
+                self._prominence(k)[0], k
+            ])
+        return np.array(rows, dtype=float).reshape(-1, 5)
+
+    def _smooth(self, stop, edge):
+        '''smoothed values up to stop, the right edge reflected if edge'''
+        r = self.radius
+        start = len(self.smoothed)
+        x = np.asarray(self.phase, dtype=float)
+        # mode='reflect' of ndimage is mode='symmetric' of np.pad
+        padded = np.pad(x, (r, r if edge else 0), mode='symmetric')
+        centre = padded[start + r:stop + r]
+        # The order of correlate1d for a symmetric kernel: outer taps first
+        out = centre * self.weights[0]
+        for j in range(r, 0, -1):
+            out += (padded[start + r - j:stop + r - j] +
+                    padded[start + r + j:stop + r + j]) * self.weights[j]
+        self.smoothed = np.concatenate([self.smoothed, out])
+        return
+
+    def _confirm(self):
+        y = -self.smoothed
+        n = len(y)
+        new = []
+        # Local maxima of -smoothed as find_peaks finds them, plateaus
+        # by their middle point
+        i = self._next
+        while i < n - 1:
+            if y[i - 1] < y[i]:
+                ahead = i + 1
+                while ahead < n - 1 and y[ahead] == y[i]:
+                    ahead += 1
+                if (ahead == n - 1 and y[ahead] == y[i]
+                        and not self.finished):
+                    break  # the plateau may go on
+                if y[ahead] < y[i]:
+                    self._pending.append((i + ahead - 1) // 2)
+                    i = ahead
+            i += 1
+        self._next = max(i, 1)
+        still = []
+        for k in self._pending:
+            if self._prominence(k)[0] >= self.prominence:
+                self.dips.append(k)
+                new.append(k)
+            elif not self.finished and not self._prominence(k)[1]:
+                still.append(k)
+        self._pending = still
+        return new
+
+    def _prominence(self, k):
+        '''prominence of -smoothed at k from the points so far, and whether
+        it is final'''
+        y = -self.smoothed
+        peak = y[k]
+        left = y[:k + 1]
+        higher = np.flatnonzero(left > peak)
+        left_min = left[higher[-1] + 1:].min() if len(higher) else left.min()
+        right = y[k:]
+        higher = np.flatnonzero(right > peak)
+        closed = len(higher) > 0 or self.finished
+        right_min = right[:higher[0]].min() if len(higher) else right.min()
+        return peak - max(left_min, right_min), closed
+
+
+def find_dips(phase, sigma=2, prominence=0.05):
+    """Dips of a whole pass, as the batch path finds them.
+
+    Equals ``find_peaks(-gaussian_filter1d(phase, sigma), prominence=...)``
+    without importing ``scipy.signal``, which takes about a second.
+
+    Returns
+    -------
+    phase_f : numpy.ndarray
+        Smoothed phase.
+    kk : numpy.ndarray
+        Indices of the dips, ascending.
+    """
+    phase = np.asarray(phase, dtype=float)
+    detector = DipDetector(sigma, prominence)
+    detector.push(np.arange(len(phase)), phase)
+    detector.finish()
+    return detector.smoothed, detector.indices()
@@ -0,0 +1,280 @@
+import time
+import numpy as np
+
+SEGMENT_MAX = 201  # max number of segments of a segment sweep
+SEGMENT_POINT_MAX = 1601  # max number of points of a segment sweep
+
+_UNKNOWN = object()  # shadow value of a setting never written
+
+
+class E4990ASession:
+    """Host-side SCPI state of one E4990A.
+
+    Every setting written through the session is kept in a shadow, so
+    writing a value the analyzer already holds costs nothing. Changed
+    settings are not sent at once but concatenated in front of the next
+    command or query, e.g. the frequency, the point count and the trigger
+    of a sweep go out as one message. Settings changed directly on the
+    resource must be followed by ``invalidate``.
+
+    Parameters
+    ----------
+    inst
+        E4990A VISA resource.
+    """
+
+    def __init__(self, inst):
+        self.inst = inst
+        self.shadow = {}
+        self.pending = {}  # settings to send, header -> value
+        self.commands = []  # commands to send before the settings
+        self.segments = None  # segment table of the list sweep
+        self.selected = None  # active trace
+        self._stimulus = {}
+
+    def invalidate(self):
+        '''forget the instrument state, every setting is sent again'''
+        self.shadow = {}
+        self.pending = {}
+        self.commands = []
+        self.segments = None
+        self.selected = None
+        return
+
+    def value(self, header):
+        '''value of a setting once the pending settings are sent'''
+        return self.pending.get(header, self.shadow.get(header, _UNKNOWN))
+
+    def set(self, header, value):
+        """Stages a setting unless the analyzer already holds it.
+
+        Parameters
+        ----------
+        header : str
+            Short-form header with explicit suffixes, e.g.
+            ``'SENS1:FREQ:STAR'``.
+        value
+            Value of the setting.
+        """
+        if self.shadow.get(header, _UNKNOWN) == value:
+            self.pending.pop(header, None)
+        else:
+            self.pending[header] = value
+        return
+
+    def command(self, message):
+        '''stages a command which is not a setting, sent before them'''
+        self.commands.append(message)
+        return
+
+    def flush(self):
+        '''sends the staged commands and settings in one write'''
+        message = self._message()
+        if message:
+            self.inst.write(message)
+        return
+
+    def write(self, message):
+        '''writes a message after the staged commands and settings'''
+        self.inst.write(self._message(message))
+        return
+
+    def query(self, message):
+        '''queries after the staged commands and settings'''
+        return self.inst.query(self._message(message))
+
+    def fetch(self, count=None, out=None, trace=1):
+        """Transfers the formatted data of a trace as binary block.
+
+        The block is decoded with ``np.frombuffer`` and only the primary
+        values, without the zero place holders, are copied to ``out``.
+
+        Parameters
+        ----------
+        count : int, optional
+            Points of the trace, the size of ``out`` if omitted.
+        out : numpy.ndarray, optional
+            Preallocated buffer of ``count`` values, any shape.
+        trace : int
+            Trace to transfer, selected first if it is not active.
+
+        Returns
+        -------
+        numpy.ndarray
+            ``out`` or a new array of ``count`` values.
+        """
+        if self.value('FORM:DATA') not in {'REAL', 'REAL32'}:
+            self.set('FORM:DATA', 'REAL32')
+        if trace != self.selected:
+            self.command(f'CALC1:PAR{trace}:SEL')
+            self.selected = trace
+        dtype = '>f4' if self.value('FORM:DATA') == 'REAL32' else '>f8'
+        self.write('CALC1:DATA:FDAT?')
+        data = _read_block(self.inst, dtype)
+        if out is None:
+            out = np.empty(len(data) // 2 if count is None else count)
+        # Every other value is a zero place holder
+        np.copyto(out, data[0::2].reshape(out.shape))
+        return out
+
+    def stimulus(self, startfreq, stopfreq, n):
+        '''frequencies of a linear sweep, cached'''
+        key = (startfreq, stopfreq, n)
+        if key not in self._stimulus:
+            if len(self._stimulus) > 64:
+                self._stimulus.clear()
+            self._stimulus[key] = np.linspace(startfreq, stopfreq, n)
+        return self._stimulus[key]
+
+    def _message(self, tail=None):
+        parts = self.commands + [
+            f'{header} {value}' for header, value in self.pending.items()
+        ]
+        if tail is not None:
+            parts.append(tail)
+        self.shadow.update(self.pending)
+        self.pending = {}
+        self.commands = []
+        # Absolute headers, ';:' returns to the root of the command tree
+        return ';'.join(p if p.startswith('*') else ':' + p for p in parts)
+
+
+_sessions = {}  # E4990ASession of each analyzer, keyed by id(inst)
+
+
+def session(inst):
+    '''the E4990ASession of an analyzer, created on first use'''
+    s = _sessions.get(id(inst))
+    if s is None or s.inst is not inst:
+        s = _sessions[id(inst)] = E4990ASession(inst)
+    return s
+
+
+def closeSession(inst):
+    '''drop the session of an analyzer, e.g. when it is closed'''
+    _sessions.pop(id(inst), None)
+    return
+
+
+def _read_block(inst, dtype):
+    '''values of the IEEE 488.2 definite length block being returned'''
+    raw = inst.read_raw()
+    start = raw.index(b'#')
+    digits = int(raw[start + 1:start + 2])
+    length = int(raw[start + 2:start + 2 + digits])
+    offset = start + 2 + digits
+    while len(raw) < offset + length:
+        raw += inst.read_raw()
+    return np.frombuffer(raw, dtype, length // np.dtype(dtype).itemsize,
+                         offset)
+
+
+def configBasic(inst, mType1='Z', dataFormat='REAL32'):
+    # , mType2='TZ', vol=500e-3
+    trace1MeasType = mType1
+    apertureDuration = 1
+    s = session(inst)
+    s.invalidate()
+    # Configure Trigger Source to support single trigger with synchronization
+    s.set("TRIG:SOUR", "BUS")
+    s.set("INIT1:CONT", "ON")
+    # Set the aperture which affects trace noise and repeatability, i.e. averaging
+    s.set("SENS1:APER", apertureDuration)
+    # Select trace 1 and set measurement format
+    s.set("CALC1:PAR1:DEF", trace1MeasType)
+    # Set OSC level
+    s.set("SOUR1:VOLT", 1.0)  # Max 1V
+    # Set data format to binary bin block, REAL32 halves the transfer of
+    # REAL (64-bit) and keeps 7 significant digits
+    s.set("FORM:DATA", dataFormat)
+    s.set("TRIG1:POIN1", "ON")
+    # turn off the display update of all windows
+    s.set("DISP:ENAB", 0)
+    # All in one write
+    s.flush()
+    s.selected = 1  # the only trace
+    return
+
+
+def setMeasurement(inst, mType1):
+    '''measurement parameter of trace 1, sent with the next sweep'''
+    session(inst).set("CALC1:PAR1:DEF", mType1)
+    return
+
+
+def startBasicSweep(inst, startfreq, stopfreq, n=601, sp_t=1000):
+    '''set up and run a sweep, returns once the sweep is complete'''
+    s = session(inst)
+    # Leaves the segment sweep of the list mode
+    s.set("SENS1:SWE:TYPE", "LIN")
+    # Only the changed settings are sent, with the trigger
+    s.set("SENS1:FREQ:STAR", startfreq)
+    s.set("SENS1:FREQ:STOP", stopfreq)
+    s.set("SENS1:SWE:POIN", n)
+    if sp_t != 1000:
+        s.set("TRIG:SOUR", "INT")
+        s.flush()
+        # wait for sweep to complete
+        time.sleep(sp_t)
+    else:
+        s.set("TRIG:SOUR", "BUS")
+        # Force single trigger with hold-off.
+        s.query("TRIG:SING;*OPC?")
+    return
+
+
+def fetchBasicSweep(inst, startfreq, stopfreq, n=601, out=None):
+    '''transfer the trace of the last completed sweep, into out if given'''
+    s = session(inst)
+    return s.fetch(n, out), s.stimulus(startfreq, stopfreq, n)
+
+
+def triggerBasicSweep(inst, startfreq, stopfreq, n=601, sp_t=1000):
+    startBasicSweep(inst, startfreq, stopfreq, n, sp_t)
+    return fetchBasicSweep(inst, startfreq, stopfreq, n)
+
+
+def listSweepChunks(freqs, n=15):
+    '''split a frequency list to fit the segment and point limits of one sweep'''
+    per_sweep = max(1, min(SEGMENT_MAX, SEGMENT_POINT_MAX // n))
+    return [freqs[k:k + per_sweep] for k in range(0, len(freqs), per_sweep)]
+
+
+def startListSweep(inst, freqs, n=15):
+    '''measure n points at each frequency with one segment sweep'''
+    s = session(inst)
+    segments = tuple(float(f) for f in freqs)
+    if len(segments) > SEGMENT_MAX or len(segments) * n > SEGMENT_POINT_MAX:
+        raise ValueError('too many frequencies for one segment sweep, '
+                         'split them with listSweepChunks')
+    if s.segments != (segments, n):
+        # <buf>,<stim>,<ifbw>,<pow>,<del>,<time>,<segm> then <star>,<stop>,<nop>
+        # per segment: start/stop stimulus, no per-segment settings
+        table = [5, 0, 0, 0, 0, 0, len(segments)]
+        for f in segments:
+            table += [f, f, n]
+        s.command("SENS1:SEGM:DATA " + ','.join(str(v) for v in table))
+        s.segments = (segments, n)
+    s.set("SENS1:SWE:TYPE", "SEGM")
+    s.set("TRIG:SOUR", "BUS")
+    # Force single trigger with hold-off.
+    s.query("TRIG:SING;*OPC?")
+    return
+
+
+def fetchListSweep(inst, freqs, n=15, out=None):
+    '''transfer the segment sweep, one row of n points per frequency'''
+    if out is None:
+        out = np.empty((len(freqs), n))
+    return session(inst).fetch(out=out)
+
+
+def triggerListSweep(inst, freqs, n=15):
+    '''average and samples of n points at each frequency'''
+    samples = np.empty((len(freqs), n))
+    k = 0
+    for chunk in listSweepChunks(freqs, n):
+        startListSweep(inst, chunk, n)
+        fetchListSweep(inst, chunk, n, samples[k:k + len(chunk)])
+        k += len(chunk)
+    return np.average(samples, axis=1), samples
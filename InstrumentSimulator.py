@@ -0,0 +1,497 @@
+import re
+import struct
+import time
+import numpy as np
+
+
+class ResonatorTwin:
+    """Digital twin of the reader, its varactor and the coupled sensors.
+
+    The reader is the parallel RLC of ``F2Z_func`` whose capacitance is a
+    varactor biased by the AD5791 output. Each sensor is a series RLC
+    coupled to the reader inductor and shows up as a dip in the reader
+    phase around its own resonant frequency.
+
+    Parameters
+    ----------
+    L, R : float
+        Reader inductance and parallel resistance.
+    C_fixed, C_j0, V_bi, m : float
+        Varactor model ``C = C_fixed + C_j0 / (1 + V / V_bi) ** m``.
+    sensors : list of tuple
+        ``(resonant frequency, quality factor, coupling coefficient)`` of
+        every sensor.
+    V_ref : float
+        Reference voltage of the DAC, the output spans ``-V_ref..V_ref``.
+    resolution : int
+        Resolution of the DAC.
+    settle_tau : float
+        Time constant of the varactor bias in s, the voltage follows a DAC
+        step exponentially; instantaneous if 0.
+    """
+
+    def __init__(self,
+                 L=13e-6,
+                 R=53e3,
+                 C_fixed=3.6e-12,
+                 C_j0=58e-12,
+                 V_bi=0.7,
+                 m=0.6,
+                 sensors=((9.2e6, 60, 0.04), (10.1e6, 60, 0.04)),
+                 V_ref=10.0,
+                 resolution=20,
+                 settle_tau=0.0):
+        self.L = L
+        self.R = R
+        self.C_fixed = C_fixed
+        self.C_j0 = C_j0
+        self.V_bi = V_bi
+        self.m = m
+        self.sensors = list(sensors)
+        self.V_ref = V_ref
+        self.resolution = resolution
+        self.settle_tau = settle_tau
+        self.registers = {}
+        self.reset()
+
+    def reset(self):
+        '''power-on state of the AD5791: zero code, output clamped to ground'''
+        self.registers = {'DAC_Register_Data': 0, 'OPGND': 1, 'BIN_2sC': 0}
+        self.code_noise = 0.0
+        self.v_start = 0.0  # bias voltage when the last step was applied
+        self.t_apply = -np.inf
+        return
+
+    def apply(self, registers, code_noise=0.0):
+        '''latch new register values, as @ApplySettings does'''
+        if self.settle_tau > 0:
+            now = time.perf_counter()
+            self.v_start = self._settled(now)
+            self.t_apply = now
+        self.registers.update(registers)
+        self.code_noise = code_noise
+        return
+
+    def code(self):
+        '''DAC code as straight binary, whatever the register encoding'''
+        code = int(self.registers['DAC_Register_Data'])
+        if not self.registers['BIN_2sC']:
+            code = code ^ (1 << (self.resolution - 1))
+        return code
+
+    def voltage(self, times=None):
+        '''bias voltage now, or at the perf_counter times given'''
+        voltage = self._settled(time.perf_counter() if times is None else
+                                np.asarray(times, dtype=float))
+        if self.code_noise > 0 and not self.registers['OPGND']:
+            lsb = 2 * self.V_ref / ((1 << self.resolution) - 1)
+            voltage = voltage + lsb * np.random.normal(
+                0, self.code_noise, np.shape(voltage) or None)
+        return voltage
+
+    def _settled(self, times):
+        if self.registers['OPGND']:
+            target = 0.0
+        else:
+            target = -self.V_ref + 2 * self.V_ref * self.code() / (
+                (1 << self.resolution) - 1)
+        if self.settle_tau <= 0:
+            return target if np.ndim(times) == 0 else np.full(
+                np.shape(times), target)
+        elapsed = np.maximum(times - self.t_apply, 0)
+        return target + (self.v_start - target) * np.exp(
+            -elapsed / self.settle_tau)
+
+    def capacitance(self, voltage=None):
+        if voltage is None:
+            voltage = self.voltage()
+        # The varactor is reverse biased, a negative output only saturates it
+        voltage = np.maximum(voltage, 0.0)
+        return self.C_fixed + self.C_j0 / (1 + voltage / self.V_bi)**self.m
+
+    def resonance(self, voltage=None):
+        '''resonant frequency of the reader alone'''
+        return 1 / (2 * np.pi * np.sqrt(self.L * self.capacitance(voltage)))
+
+    def impedance(self, freqs, times=None):
+        '''complex impedance seen by the analyzer at the current DAC output,
+        or at the output at the times of the points'''
+        w = 2 * np.pi * np.asarray(freqs, dtype=float)
+        Z_L = 1j * w * self.L
+        for f_s, Q_s, k in self.sensors:
+            L_s = self.L
+            C_s = 1 / ((2 * np.pi * f_s)**2 * L_s)
+            R_s = 2 * np.pi * f_s * L_s / Q_s
+            Z_s = R_s + 1j * w * L_s + 1 / (1j * w * C_s)
+            Z_L = Z_L + (w * k * np.sqrt(self.L * L_s))**2 / Z_s
+        Y = 1 / self.R + 1j * w * self.capacitance(self.voltage(times)) + \
+            1 / Z_L
+        return 1 / Y
+
+    def measure(self, freqs, parameter='Z', times=None):
+        '''|Z| in Ohm for "Z", phase in degree for "TZ"'''
+        Z = self.impedance(freqs, times)
+        if parameter == 'TZ':
+            return np.degrees(np.angle(Z))
+        return np.abs(Z)
+
+
+class FakeE4990A:
+    """Stand-in for the E4990A pyvisa resource.
+
+    Answers the SCPI commands of ``E4990AFunctions`` (frequency, points,
+    trigger, format, measurement parameter, ``TRIG:SING;*OPC?`` and
+    ``CALC:DATA:FDATA?`` as IEEE 488.2 binary blocks) from a
+    ``ResonatorTwin``. Unknown commands go to the error queue
+    (``SYST:ERR?``).
+
+    Parameters
+    ----------
+    twin : ResonatorTwin
+        Resonator measured by the analyzer.
+    latency : dict, optional
+        Delays in s: ``'write'`` and ``'query'`` per command, ``'point'``
+        per measured point, ``'byte'`` per transferred byte.
+    noise : dict, optional
+        Standard deviation of the measurement noise: ``'TZ'`` in degree,
+        ``'Z'`` relative to the magnitude.
+    """
+
+    def __init__(self, twin, latency=None, noise=None):
+        self.twin = twin
+        self.latency = {'write': 0.0, 'query': 0.0, 'point': 0.0, 'byte': 0.0}
+        self.latency.update(latency or {})
+        self.noise = {'TZ': 0.0, 'Z': 0.0}
+        self.noise.update(noise or {})
+        self.timeout = 2000
+        self.settings = {
+            'SENS:FREQ:STAR': 20.0,
+            'SENS:FREQ:STOP': 120e6,
+            'SENS:SWE:POIN': 201,
+            'SENS:SWE:TYPE': 'LIN',
+            'SENS:APER': 1,
+            'CALC:PAR:DEF': 'Z',
+            'FORM:DATA': 'ASC',
+            'TRIG:SOUR': 'INT',
+            'INIT:CONT': 'ON',
+            'SOUR:VOLT': 0.5,
+            'DISP:ENAB': 1
+        }
+        self.segments = []
+        self.trace = np.zeros(0)
+        self.errors = []
+        self.commands = []
+        self._response = b''
+
+    # --- pyvisa resource interface -------------------------------------
+    def write(self, message):
+        self._sleep('write')
+        self._execute(message)
+        return len(message)
+
+    def read_raw(self, size=None):
+        response, self._response = self._response, b''
+        self._sleep('byte', len(response))
+        return response
+
+    def read(self):
+        return self.read_raw().decode('ascii').rstrip('\n')
+
+    def query(self, message, delay=None):
+        self._sleep('query')
+        self._execute(message)
+        return self.read()
+
+    def query_binary_values(self,
+                            message,
+                            datatype='f',
+                            is_big_endian=False,
+                            container=list,
+                            **kwargs):
+        self._sleep('query')
+        self._execute(message)
+        block = self.read_raw()
+        return container(parse_ieee_block(block, datatype, is_big_endian))
+
+    def close(self):
+        return
+
+    # --- SCPI -----------------------------------------------------------
+    def _execute(self, message):
+        for header, args in split_scpi(message):
+            self.commands.append(header)
+            handler = self._QUERIES.get(header) if header.endswith(
+                '?') else self._COMMANDS.get(header)
+            if handler is not None:
+                handler(self, args)
+            elif header.endswith('?') and header[:-1] in self.settings:
+                self._respond_text(self.settings[header[:-1]])
+            elif header in self.settings and args:
+                self.settings[header] = _parse_value(args)
+            else:
+                self.errors.append(f'-113,"Undefined header";{header}')
+        return
+
+    def _respond_text(self, value):
+        self._response += (str(value) + '\n').encode('ascii')
+        return
+
+    def _sweep(self, args=''):
+        '''run one sweep and keep it as the current trace'''
+        s = self.settings
+        freqs = self.frequencies()
+        # The points are taken one after the other while the bias settles
+        times = time.perf_counter() + self.latency['point'] * np.arange(
+            len(freqs))
+        self._sleep('point', len(freqs))
+        parameter = str(s['CALC:PAR:DEF']).upper()
+        data = self.twin.measure(freqs, parameter, times)
+        std = self.noise.get(parameter, 0.0)
+        if std > 0:
+            if parameter == 'Z':
+                data = data * (1 + np.random.normal(0, std, data.shape))
+            else:
+                data = data + np.random.normal(0, std, data.shape)
+        self.trace = data
+        return
+
+    def frequencies(self):
+        '''stimulus of the current sweep setup'''
+        s = self.settings
+        if str(s['SENS:SWE:TYPE']).startswith('SEGM'):
+            return np.concatenate([
+                np.linspace(start, stop, int(nop))
+                for start, stop, nop in self.segments
+            ] or [np.zeros(0)])
+        return np.linspace(float(s['SENS:FREQ:STAR']),
+                           float(s['SENS:FREQ:STOP']),
+                           int(s['SENS:SWE:POIN']))
+
+    def _segments(self, args=''):
+        '''<buf>,<stim>,<ifbw>,<pow>,<del>,<time>,<segm>,{<star>,<stop>,<nop>}'''
+        table = [float(v) for v in args.split(',')]
+        flags = table[2:6]
+        if table[1] != 0 or any(flags):
+            self.errors.append('-224,"Illegal parameter value";SENS:SEGM:DATA')
+            return
+        count = int(table[6])
+        values = table[7:7 + 3 * count]
+        self.segments = [
+            tuple(values[k:k + 3]) for k in range(0, len(values), 3)
+        ]
+        return
+
+    def _trigger(self, args=''):
+        if str(self.settings['TRIG:SOUR']).upper().startswith('BUS'):
+            self._sweep()
+        return
+
+    def _opc(self, args=''):
+        self._respond_text(1)
+        return
+
+    def _fdata(self, args=''):
+        if str(self.settings['TRIG:SOUR']).upper().startswith('INT'):
+            self._sweep()
+        # Formatted data carries a zero secondary value after every point
+        data = np.zeros(2 * len(self.trace))
+        data[0::2] = self.trace
+        fmt = str(self.settings['FORM:DATA']).upper()
+        if fmt in {'REAL', 'REAL64'}:
+            self._response += ieee_block(data, 'd', True)
+        elif fmt == 'REAL32':
+            self._response += ieee_block(data, 'f', True)
+        else:
+            self._respond_text(','.join(f'{v:+.12E}' for v in data))
+        return
+
+    def _sweep_time(self, args=''):
+        self._respond_text(self.latency['point'] * len(self.frequencies()))
+        return
+
+    def _error(self, args=''):
+        if self.errors:
+            self._respond_text(self.errors.pop(0))
+        else:
+            self._respond_text('+0,"No error"')
+        return
+
+    _COMMANDS = {
+        'TRIG:SING': _sweep,
+        'TRIG': _trigger,
+        '*RST': lambda self, args: None,
+        '*CLS': lambda self, args: self.errors.clear(),
+        'TRIG:POIN': lambda self, args: None,
+        'CALC:PAR:SEL': lambda self, args: None,
+        'SENS:SEGM:DATA': _segments,
+    }
+    _QUERIES = {
+        '*OPC?': _opc,
+        '*IDN?': lambda self, args: self._respond_text(
+            'Keysight Technologies,E4990A,SIMULATOR,A.00.00'),
+        'CALC:DATA:FDAT?': _fdata,
+        'SYST:ERR?': _error,
+        'SENS:SWE:TIME?': _sweep_time,
+    }
+
+    def _sleep(self, kind, count=1):
+        delay = self.latency.get(kind, 0.0) * count
+        if delay > 0:
+            time.sleep(delay)
+        return
+
+
+class FakeResourceManager:
+    """Stand-in for ``pyvisa.ResourceManager`` opening ``FakeE4990A``."""
+
+    def __init__(self, twin, latency=None, noise=None):
+        self.twin = twin
+        self.latency = latency
+        self.noise = noise
+
+    def list_resources(self, query='?*::INSTR'):
+        return ('SIM::E4990A::INSTR', )
+
+    def open_resource(self, resource_name, **kwargs):
+        return FakeE4990A(self.twin, self.latency, self.noise)
+
+    def close(self):
+        return
+
+
+class FakeACEClient:
+    """Stand-in for the ACE remote client driving the twin's DAC.
+
+    Parameters
+    ----------
+    twin : ResonatorTwin
+        Resonator biased by the DAC.
+    latency : dict, optional
+        Delay in s per call: ``'SetBitfield'`` and ``'Run'``.
+    noise : float
+        Standard deviation of the DAC output in LSB.
+    """
+
+    def __init__(self, twin, latency=None, noise=0.0):
+        self.twin = twin
+        self.latency = {'SetBitfield': 0.0, 'Run': 0.0}
+        self.latency.update(latency or {})
+        self.noise = noise
+        self.staged = {}
+        self.context_path = ''
+        self.calls = []
+        self.closed = False
+        self.dropped = False
+
+    def drop(self):
+        '''every later call fails, as when the ACE server goes away'''
+        self.dropped = True
+        return
+
+    def AddHardwarePlugin(self, board):
+        self._call('AddHardwarePlugin')
+        return
+
+    def set_ContextPath(self, path):
+        self.context_path = path
+        return
+
+    def SetBitfield(self, bitfieldname, val):
+        self._call('SetBitfield')
+        self.staged[bitfieldname] = int(val)
+        return
+
+    def Run(self, script):
+        self._call('Run')
+        if script == '@ApplySettings':
+            self.twin.apply(self.staged, self.noise)
+            self.staged = {}
+        elif script == '@Reset':
+            self.staged = {}
+            self.twin.reset()
+        return
+
+    def CloseSession(self):
+        self._call('CloseSession')
+        self.closed = True
+        return
+
+    def _call(self, name):
+        if self.dropped:
+            raise ConnectionError('ACE session lost')
+        self.calls.append(name)
+        delay = self.latency.get(name, 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        return
+
+
+def split_scpi(message):
+    """Splits a SCPI message into canonical ``(header, arguments)`` pairs.
+
+    Headers are reduced to their short form without the default suffix
+    (``SENSe1:FREQuency:STARt`` -> ``SENS:FREQ:STAR``), a header after ``;``
+    inherits the path of the previous one, and the optional ``SENS`` root
+    is added where it was left out.
+    """
+    commands = []
+    path = []
+    for part in message.strip().split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        header, _, args = part.partition(' ')
+        if header.startswith('*'):
+            commands.append((header.upper(), args.strip()))
+            continue
+        query = header.endswith('?')
+        nodes = [_short_form(n) for n in header.rstrip('?').split(':') if n]
+        if not header.startswith(':') and commands and path:
+            nodes = path + nodes
+        path = nodes[:-1]
+        if nodes and nodes[0] in {'FREQ', 'SWE', 'APER', 'SEGM'}:
+            nodes = ['SENS'] + nodes
+        commands.append((':'.join(nodes) + ('?' if query else ''),
+                         args.strip()))
+    return commands
+
+
+def _short_form(node):
+    match = re.match(r'([A-Za-z_]+)(\d*)$', node)
+    if match is None:
+        return node.upper()
+    name, suffix = match.groups()
+    if name != name.upper():
+        short = ''.join(c for c in name if c.isupper())
+    elif len(name) > 4:
+        short = name[:3] if name[3] in 'AEIOU' else name[:4]
+    else:
+        short = name
+    return short + (suffix if suffix not in {'', '1'} else '')
+
+
+def _parse_value(args):
+    args = args.strip()
+    try:
+        return float(args) if any(c in args for c in '.eE') else int(args)
+    except ValueError:
+        return args.upper()
+
+
+def ieee_block(values, datatype='d', is_big_endian=True):
+    '''IEEE 488.2 definite length block of the values'''
+    data = struct.pack(('>' if is_big_endian else '<') +
+                       f'{len(values)}{datatype}', *values)
+    length = str(len(data))
+    return f'#{len(length)}{length}'.encode('ascii') + data + b'\n'
+
+
+def parse_ieee_block(block, datatype='d', is_big_endian=True):
+    '''values of an IEEE 488.2 definite length block'''
+    start = block.index(b'#')
+    digits = int(block[start + 1:start + 2])
+    length = int(block[start + 2:start + 2 + digits])
+    offset = start + 2 + digits
+    count = length // struct.calcsize(datatype)
+    return struct.unpack_from(('>' if is_big_endian else '<') +
+                              f'{count}{datatype}', block, offset)
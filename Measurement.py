@@ -0,0 +1,836 @@
+import time
+
+_T0 = time.perf_counter()  # start of the imports, for the startup report
+
+import argparse
+import json
+import os
+import sys
+import traceback
+from datetime import datetime
+import numpy as np
+import ACERemoteController as arc
+import DACFunctions as dacfunc
+import CodeMap as cm
+import ResonatorFit as rf
+import Timing
+from AD5791Driver import (AD5791Direct, LoopbackSPI, LoopbackStream,
+                          StreamTransport, serial_transport)
+from AcquisitionEngine import AcquisitionEngine, dip_targets
+from AdaptiveScan import adaptive_scan
+from Calibration import (CalibrationIndex, read_C2F, write_C2F,
+                         measure_codes, recalibrate)
+from DACService import DACClient
+from DipDetector import DipDetector
+from MultiReader import Reader, ReaderScheduler
+from E4990AFunctions import configBasic, setMeasurement, closeSession
+from ModelFunctions import C2F_func
+from PeakSeries import PeakSeries
+from PlotWorker import PlotWorker
+from ResonanceTracker import ResonanceTracker
+from ResultStore import open_store
+from Settling import (load_settling, save_settling, measure_settling,
+                      sweep_order)
+from Timing import span
+
+IMPORT_TIME = time.perf_counter() - _T0
+
+# Settings of a measurement, named as the constants of main.py. A JSON
+# config file holds any of them, the others keep these values.
+DEFAULTS = {
+    'SIMULATE': False,  # run against the offline instrument simulator
+    # Delays in s of the simulated E4990A (per 'write', 'query', 'point',
+    # 'byte') and ACE client (per 'SetBitfield', 'Run'), see
+    # InstrumentSimulator
+    'SIM_E4990A_LATENCY': {'query': 0.002, 'point': 0.0002},
+    'SIM_ACE_LATENCY': {'Run': 0.005},
+    'SIM_NOISE': {'TZ': 0.02, 'Z': 0.002},  # degree, relative
+    'SIM_SETTLE_TAU': 0.001,  # time constant of the varactor bias, s
+    'LIVE_VIEW': None,  # keep the latest figures open, if not SIMULATE when None
+    'PLOTS': True,  # render the figures in a worker process
+    'VISA_ADDRESS': '???::?????::?????::??::?::INSTR',  # of the E4990A
+    'VISA_LIBRARY': 'C:\\Program Files (x86)\\IVI Foundation\\VISA\\WinNT'
+    '\\ktvisa\\ktbin\\visa32.dll',
+    'BOARD': 'EVAL-AD5791SDZ',
+    'CHIP': 'AD5791',
+    'ACE_PATH': r'C:\Program Files (x86)\Analog Devices\ACE',
+    'DAC_SERVICE': None,  # 'host:port' of a running DACService.py
+    'DAC_BACKEND': 'ace',  # 'ace', or 'spi' for SPI frames sent to SPI_PORT
+    'SPI_PORT': None,  # serial port of the USB-SPI bridge
+    'SPI_LDAC': 'sync',  # 'sync', 'software' or 'pin', see AD5791Direct
+    'SPI_LDAC_LINE': None,  # 'rts' or 'dtr' of the bridge wired to LDAC
+    'FITTED_PARA': [13e-6, 22e-12, 53e3],  # inductance, capacitance, resistance
+    'STARTF': 8e6,  # calibration band
+    'STORTF': 11e6,
+    'CALIBRATION_POINTS': 201,  # points of a calibration sweep
+    'START_CODE': 0x99000,
+    'STOP_CODE': 0xE6600,
+    'STEP_CODE': 0x02000,
+    'SWEEP_POINT_NUM': 250,
+    'SWEEP_REPEAT': 15,  # samples per point
+    'PIPELINED': True,
+    'SWEEP_ORDER': 'serpentine',
+    'SETTLING_FILE': './res/settling.json',
+    'LIST_SWEEP': False,
+    'LIST_TOLERANCE': None,  # None: from the reader half-width, see CodeMap
+    'ADAPTIVE_AVERAGING': False,
+    'SE_TARGET': 0.01,
+    'SE_TARGET_DIP': 0.005,
+    'SAMPLE_BATCH': 5,
+    'ADAPTIVE_SCAN': False,
+    'EXPECTED_DIPS': None,
+    'COARSE_STRIDE': 8,
+    'TRACK_SPAN': 4,
+    'REFINE_DIPS': False,  # fit a model around every dip for sub-step freqs
+    'RESULT_STORE': './res/F2I.store',
+    'READERS': None,  # settings of every reader of the multi command
+    'MULTI_STORE': './res/F2I_multi.store',  # merged passes of the readers
+    'PEAK_SERIES': './res/peaks',  # time series of the dips, None to skip
+    'TIMING_LOG': './res/timing.jsonl',
+    'CALIBRATION_INDEX': './res/C2F_index.json',
+    'DRIFT_SPOTS': 7,
+    'DRIFT_THRESHOLD': 5e-4,
+    'RES_DIR': './res/',
+    'REMARK': 'P',  # remarks in the file names
+}
+
+VISA_DLL_DIRS = (r'C:/Program Files/Keysight/IO Libraries Suite/bin',
+                 r'C:/Program Files (x86)/Keysight/IO Libraries Suite/bin')
+
+
+def load_config(path=None, **overrides):
+    """Settings of a measurement.
+
+    Parameters
+    ----------
+    path : str, optional
+        JSON file with some of the ``DEFAULTS``.
+    **overrides
+        Settings taking precedence over the file.
+
+    Returns
+    -------
+    dict
+        Every setting of ``DEFAULTS``.
+    """
+    config = dict(DEFAULTS)
+    settings = {}
+    if path is not None:
+        with open(path, 'r') as f:
+            settings = json.load(f)
+    settings.update(overrides)
+    unknown = sorted(set(settings) - set(DEFAULTS))
+    if unknown:
+        raise ValueError(f'unknown settings {unknown}')
+    config.update(settings)
+    if config['LIVE_VIEW'] is None:
+        config['LIVE_VIEW'] = not config['SIMULATE']
+    return config
+
+
+def saveFileStr(lable: str,
+                remark: str,
+                tp: str,
+                format: int = 1,
+                saveDir: str = './res/'):  # for convenient save file
+    if format == 1:
+        testTime = datetime.now().strftime('%m-%d_%H-%M-%S.%f')
+    else:
+        testTime = datetime.now().strftime('%m-%d_%H')
+    if remark != '':
+        remark = '_' + remark
+    return f'{saveDir}{lable}_{testTime}{remark}.{tp}'
+
+
+class MeasurementSession:
+    """Calibration and sweep passes of one reader, without prompts.
+
+    ``open`` connects the E4990A and the AD5791 (or the simulator),
+    ``calibrate`` loads or measures the C2F calibration, ``prepare`` plans
+    the sweep and ``run_pass`` measures, stores and plots one pass. The
+    interactive ``main.py`` and the command line of this module are both
+    built on it.
+
+    Only the code path in use loads its heavy modules: pyvisa and the ACE
+    client (CLR) when real instruments are opened, matplotlib in the plot
+    worker process. The dips are found by ``DipDetector``, so
+    scipy is not imported by a calibration or a sweep.
+
+    Parameters
+    ----------
+    config : str or dict, optional
+        JSON config file or settings, see ``DEFAULTS``.
+    **overrides
+        Settings taking precedence over ``config``.
+    """
+
+    def __init__(self, config=None, **overrides):
+        if isinstance(config, dict):
+            overrides = {**config, **overrides}
+            config = None
+        self.config = load_config(config, **overrides)
+        c = self.config
+        self.code_range = (c['START_CODE'], c['STOP_CODE'], c['STEP_CODE'])
+        self.band = (c['STARTF'], c['STORTF'])
+        self.E4990A = None
+        self.AD5791 = None
+        self.twin = None
+        self.plotter = None
+        self.settling = None
+        self.para_C2F = None
+        self.C2F_np = None
+        self.c2f_file = None
+        self.code_map = None
+        self.engine = None
+        self.store = None
+        self.peaks = None
+        self.sweep_freqs = None
+        self.plan_codes = None
+        self.plan_groups = None
+        self.list_tolerance = None
+        self.sweep_step = None
+        self.pass_index = 0
+        self.last_dips = np.zeros(0)
+        self.startup = {}
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def path(self, lable, remark, tp, format=1):
+        '''file name in the result folder, see saveFileStr'''
+        return saveFileStr(lable, remark, tp, format, self.config['RES_DIR'])
+
+    def open(self):
+        """Connects the instruments and starts the plot worker.
+
+        The time taken by the imports and by the connections is printed and
+        kept in ``startup``.
+        """
+        c = self.config
+        t1 = time.perf_counter()
+        os.makedirs(c['RES_DIR'], exist_ok=True)
+        if c['SIMULATE']:
+            import InstrumentSimulator as sim
+            self.twin = sim.ResonatorTwin(L=c['FITTED_PARA'][0],
+                                          R=c['FITTED_PARA'][2],
+                                          settle_tau=c['SIM_SETTLE_TAU'])
+            rm = sim.FakeResourceManager(self.twin,
+                                         latency=c['SIM_E4990A_LATENCY'],
+                                         noise=c['SIM_NOISE'])
+        else:
+            import pyvisa
+            for path in VISA_DLL_DIRS:
+                os.add_dll_directory(path)
+            rm = pyvisa.ResourceManager(c['VISA_LIBRARY'])  # kt or ag?
+        if c['DAC_SERVICE']:
+            # The service owns the ACE session, its output is already enabled
+            self.AD5791 = DACClient(c['DAC_SERVICE'])
+            dacfunc.write_dac_code(self.AD5791, c['START_CODE'], 20, True)
+        else:
+            if c['DAC_BACKEND'] == 'spi':
+                if c['SIMULATE']:
+                    # The bridge path with the device in the loopback
+                    transport = StreamTransport(
+                        LoopbackStream(
+                            LoopbackSPI(self.twin, c['SPI_LDAC'] == 'sync')),
+                        c['SPI_LDAC_LINE'])
+                else:
+                    transport = serial_transport(
+                        c['SPI_PORT'], ldac_line=c['SPI_LDAC_LINE'])
+                self.AD5791 = AD5791Direct(transport, c['SPI_LDAC'])
+            elif c['SIMULATE']:
+                self.AD5791 = sim.FakeACEClient(self.twin,
+                                                latency=c['SIM_ACE_LATENCY'])
+            else:
+                self.AD5791 = arc.establish_connection(
+                    c['BOARD'], c['CHIP'], c['ACE_PATH'])
+            # Set the output voltage to around 1.95V FIRST, then enable the
+            # voltage output
+            dacfunc.initialize_output(self.AD5791, c['START_CODE'], 20, True)
+        # Wait after a DAC step from the measured model, a fixed 5 ms until
+        # measured
+        self.settling = load_settling(c['SETTLING_FILE'], c['BOARD'])
+        if c['PLOTS']:
+            # Figures are rendered and saved in a separate process
+            self.plotter = PlotWorker(c['LIVE_VIEW'])
+        self.E4990A = Timing.TimedResource(rm.open_resource(
+            c['VISA_ADDRESS']))
+        self.E4990A.timeout = 10000
+        configBasic(self.E4990A)
+        t2 = time.perf_counter()
+        self.startup = {
+            'import': IMPORT_TIME,
+            'connect': t2 - t1,
+            'ready': t2 - _T0
+        }
+        Timing.record('startup.import', IMPORT_TIME)
+        Timing.record('startup.connect', t2 - t1)
+        print(f'Startup: imports {IMPORT_TIME:.3f} s, instruments '
+              f'{t2 - t1:.3f} s, ready {t2 - _T0:.3f} s after the imports '
+              'started')
+        return self
+
+    def close(self):
+        '''restores the front panel settings and closes the instruments'''
+        if self.E4990A is not None:
+            E4990A, self.E4990A = self.E4990A, None
+            E4990A.write(':DISPlay:ENABle %d' % (1))
+            E4990A.write("SENSe:SWEep:POINts " + str(201))
+            E4990A.write("CALCulate:PARameter1:DEFine " + 'Z')
+            E4990A.write("SENS:FREQ:STAR " + str(5e6) + ";STOP " + str(10e6))
+            E4990A.write("TRIGger1:SOURce internal")
+            E4990A.close()
+            closeSession(E4990A)
+        if self.AD5791 is not None:
+            AD5791, self.AD5791 = self.AD5791, None
+            arc.close_connection(AD5791)
+        if self.plotter is not None:
+            plotter, self.plotter = self.plotter, None
+            plotter.close()
+        return
+
+    # --- calibration -----------------------------------------------------
+
+    def find_calibration(self):
+        '''index entry of the latest calibration of this reader, code range
+        and band, None if there is none'''
+        index = CalibrationIndex(self.config['CALIBRATION_INDEX'])
+        return index.find(self.config['FITTED_PARA'], self.code_range,
+                          self.band)
+
+    def measure_calibration(self):
+        """Measures the relationship between the applied code and the
+        resonant frequency.
+
+        Returns
+        -------
+        para_C2F : numpy.ndarray
+            Coefficients of ``C2F_func``.
+        C2F_np : numpy.ndarray
+            ``[:, 0]`` is code, ``[:, 1]`` is resonant frequency.
+        name : str
+            C2F file written.
+        """
+        c = self.config
+        startC, stopC, stepC = self.code_range
+        C2F_np = measure_codes(self.E4990A, self.AD5791,
+                               np.arange(startC, stopC + 1, stepC),
+                               self.band[0], self.band[1],
+                               c['CALIBRATION_POINTS'],
+                               settle=self._settle())
+        # Fit the data with preset function "C2F_func", linear in its
+        # coefficients
+        with span('fit.C2F'):
+            para_C2F = rf.fit_C2F(C2F_np[:, 0], C2F_np[:, 1])
+        name = self.path('C2F', '', 'txt', 0)
+        if os.path.exists(name):
+            # Another calibration of the same hour is kept
+            name = self.path('C2F', '', 'txt')
+        write_C2F(name, para_C2F, C2F_np)
+        # Plot the relationship between the code and the resonant frequency
+        if self.plotter is not None:
+            self.plotter.submit('C2F',
+                                self.path('C2F', c['REMARK'], 'png'),
+                                C2F_np=C2F_np,
+                                para_C2F=para_C2F)
+        return para_C2F, C2F_np, name
+
+    def calibrate(self, c2f=None, force=False):
+        """Loads or measures the C2F calibration.
+
+        A loaded calibration is spot-checked and the drifted code ranges
+        are measured again into a new file, see
+        ``Calibration.recalibrate``. It is measured anew if none of its spot
+        codes has a resonance in the band.
+
+        Parameters
+        ----------
+        c2f : str, optional
+            C2F file to load, also looked up in the result folder. The
+            latest calibration in the index if omitted, measured if there
+            is none.
+        force : bool
+            Measure a new calibration.
+
+        Returns
+        -------
+        para_C2F, C2F_np
+            See ``measure_calibration``.
+        """
+        c = self.config
+        if c2f is None and not force:
+            entry = self.find_calibration()
+            c2f = None if entry is None else entry['file']
+        if c2f is None or force:
+            para_C2F, C2F_np, name = self.measure_calibration()
+        else:
+            name = c2f
+            if not os.path.exists(name):
+                name = os.path.join(c['RES_DIR'], c2f)
+            if not os.path.exists(name):
+                raise FileNotFoundError(f'Cannot find {c2f!r}')
+            para_C2F, C2F_np = read_C2F(name)
+            # Spot-check the loaded calibration, re-measure the drifted ranges
+            para_new, C2F_new, report = recalibrate(
+                self.E4990A, self.AD5791, para_C2F, C2F_np, self.code_range,
+                self.band[0], self.band[1], c['CALIBRATION_POINTS'],
+                c['DRIFT_SPOTS'], c['DRIFT_THRESHOLD'], self._settle())
+            print('C2F drift (code, drift, fit error): '
+                  f'{report["drift"][:, [1, 4, 5]].tolist()}')
+            if len(report['drift']) == 0:
+                # Not a single spot could be checked, the calibration may
+                # belong to another reader or band
+                print(f'Warning: no spot resonance of {name} in the band '
+                      f'{self.band}, measuring a new calibration!')
+                para_C2F, C2F_np, name = self.measure_calibration()
+            elif report['ranges']:
+                print(f"Recalibrated {report['remeasured']} codes in "
+                      f"{report['ranges']}")
+                para_C2F, C2F_np = para_new, C2F_new
+                # A new file, the loaded calibration is kept
+                name = self.path('C2F', 'recal', 'txt')
+                write_C2F(name, para_C2F, C2F_np)
+        CalibrationIndex(c['CALIBRATION_INDEX']).add(name, c['FITTED_PARA'],
+                                                     self.code_range,
+                                                     self.band, para_C2F)
+        self.para_C2F, self.C2F_np, self.c2f_file = para_C2F, C2F_np, name
+        return para_C2F, C2F_np
+
+    # --- sweep -----------------------------------------------------------
+
+    def prepare(self, outputs=True):
+        '''frequency plan, settling model, acquisition engine and, with
+        outputs, result store and peak series of the sweep, after
+        calibrate'''
+        c = self.config
+        startCode, stopCode, _ = self.code_range
+        time.sleep(1)
+        # Select trace 1 and set measurement format
+        setMeasurement(self.E4990A, 'TZ')
+
+        sweepStop = int(np.max(self.C2F_np[:, 1]) * 0.998) - 1.0
+        sweepstart = int(np.min(self.C2F_np[:, 1]) * 1.0001) + 1.0
+        self.sweep_step = round(
+            (sweepStop - sweepstart) / c['SWEEP_POINT_NUM'])
+        # Invert the C2F fit once for the whole frequency plan; * 1.005
+        with span('fit.code_map'):
+            self.code_map = cm.load_code_map(self.c2f_file, self.para_C2F,
+                                             self.C2F_np, startCode,
+                                             stopCode)
+        sweepFreqs = np.arange(sweepstart, sweepStop + 1.0, self.sweep_step)
+        planCodes = self.code_map.codes_for(sweepFreqs * 1.002)
+        if self.code_map.flags_for(sweepFreqs * 1.002).any():
+            print('Warning: the C2F fit is not monotonic in the ranges '
+                  f'{self.code_map.nonmonotonic[:, 2:].tolist()} Hz!')
+        # Prevent the unexpected applied voltage
+        outRange = (planCodes < startCode) | (planCodes > stopCode)
+        if outRange.any():
+            first = np.argmax(outRange)
+            print(self._out_of_range(sweepFreqs[first], planCodes[first]) +
+                  '!')  # raise Exception
+            sweepFreqs = sweepFreqs[:first]
+            planCodes = planCodes[:first]
+        self.sweep_freqs = sweepFreqs
+        self.plan_codes = planCodes
+        self.list_tolerance = c['LIST_TOLERANCE']
+        if self.list_tolerance is None:
+            self.list_tolerance = cm.list_tolerance(c['FITTED_PARA'],
+                                                    sweepFreqs)
+        self.plan_groups = self.code_map.groups_for(sweepFreqs,
+                                                    self.list_tolerance,
+                                                    1.002)
+        if c['LIST_SWEEP']:
+            print(f'List sweep: {len(sweepFreqs)} points on '
+                  f'{len(self.plan_groups)} codes, '
+                  f'{len(sweepFreqs) / len(self.plan_groups):.1f} points '
+                  f'per code (tolerance {self.list_tolerance:.2e})')
+        if self.settling is None:
+            # Steps from the first code, each watched at the new resonance
+            steps = np.array(
+                [0x400, 0x1000, 0x4000, 0x10000, stopCode - startCode])
+            self.settling, settleRows = measure_settling(
+                self.E4990A, self.AD5791, startCode, steps,
+                C2F_func(np.asarray(self.para_C2F),
+                         startCode + steps.astype(float)))
+            print(f'Settling (step, s): {settleRows.tolist()}')
+            save_settling(c['SETTLING_FILE'], c['BOARD'], self.settling)
+        print(self.settling)
+        self.engine = AcquisitionEngine(self.E4990A, self.AD5791, 20, True,
+                                        self.settling)
+        if not outputs:
+            return
+        # F2I passes are appended to the binary store instead of text files,
+        # ResultStore.convert_text_results imports the older ones
+        self.store = open_store(c['RESULT_STORE'], 3 + c['SWEEP_REPEAT'])
+        if c['PEAK_SERIES']:
+            self.peaks = PeakSeries(c['PEAK_SERIES'])
+        return
+
+    def measure_points(self, freqs):
+        '''F2I rows of any frequencies, each at the code of its resonance;
+        ValueError before any DAC write if a code is out of range'''
+        freqs = np.asarray(freqs, dtype=float)
+        codes = self.code_map.codes_for(freqs * 1.002)
+        startCode, stopCode, _ = self.code_range
+        # Prevent the unexpected applied voltage, as for the plan
+        outRange = (codes < startCode) | (codes > stopCode)
+        if outRange.any():
+            first = np.argmax(outRange)
+            raise ValueError(self._out_of_range(freqs[first], codes[first]))
+        return self.engine.run(freqs, codes, self.config['SWEEP_REPEAT'])
+
+    def _out_of_range(self, freq, code):
+        '''message of a frequency without a code in the allowed range'''
+        startCode, stopCode, _ = self.code_range
+        env = self.code_map.envelope / 1.002
+        message = (f'Frequency {freq:.0f} Hz is outside the calibration, '
+                   f'band {env[0]:.0f}..{env[-1]:.0f} Hz, codes '
+                   f'[{startCode}: {stopCode}]')
+        if code != -1:
+            message += f', code {code}'
+        return message
+
+    def reader(self, name=None):
+        '''MultiReader.Reader measuring the sweep plan of this session,
+        after prepare'''
+        c = self.config
+        return Reader(name or c['VISA_ADDRESS'],
+                      self.E4990A,
+                      self.AD5791,
+                      self.code_map,
+                      self.sweep_freqs,
+                      c['SWEEP_REPEAT'],
+                      1.002,
+                      self.list_tolerance if c['LIST_SWEEP'] else None,
+                      self.settling,
+                      c['SWEEP_ORDER'])
+
+    def scan_dips(self):
+        '''coarse-to-fine scan of the dips, see AdaptiveScan.adaptive_scan'''
+        return adaptive_scan(self.measure_points, self.sweep_freqs[0],
+                             self.sweep_freqs[-1], self.sweep_step,
+                             self.config['COARSE_STRIDE'])
+
+    def tracker(self):
+        '''ResonanceTracker following the dips with a few probes'''
+        return ResonanceTracker(self.measure_points, self.scan_dips,
+                                self.config['TRACK_SPAN'] * self.sweep_step,
+                                5, self.sweep_freqs[0], self.sweep_freqs[-1])
+
+    def run_pass(self, remark=None):
+        """Measures one pass, stores it and queues its figure.
+
+        Parameters
+        ----------
+        remark : str, optional
+            Remark in the file names, ``REMARK`` if omitted.
+
+        Returns
+        -------
+        F2I_np : numpy.ndarray
+            ``[freq, mean phase, code, samples...]`` of every point.
+        kk : numpy.ndarray
+            Indices of the phase dips.
+        """
+        c = self.config
+        engine = self.engine
+        sweepFreqs = self.sweep_freqs
+        sweepRepeat = c['SWEEP_REPEAT']
+        remark = c['REMARK'] if remark is None else remark
+        Timing.TIMINGS.reset()
+        # Small code steps only, the direction alternates for 'serpentine'
+        order = sweep_order(len(sweepFreqs), c['SWEEP_ORDER'],
+                            self.pass_index)
+        self.pass_index += 1
+        detector = None
+        t1 = time.perf_counter()
+        if c['ADAPTIVE_SCAN']:
+            F2I_np, kk = self.scan_dips()
+        elif c['LIST_SWEEP']:
+            F2I_np = engine.run_list(self.plan_groups, sweepRepeat)
+        elif c['EXPECTED_DIPS']:
+            # The dips are detected while the pass runs, ascending
+            detector = DipDetector(2, 0.05, c['EXPECTED_DIPS'])
+            F2I_np = engine.run_until(sweepFreqs, self.plan_codes, detector,
+                                      sweepRepeat)
+        elif c['ADAPTIVE_AVERAGING']:
+            # sweepRepeat is the cap, the dips of the first pass are unknown
+            F2I_np = engine.run_adaptive(
+                sweepFreqs, self.plan_codes,
+                dip_targets(sweepFreqs, self.last_dips, c['SE_TARGET'],
+                            c['SE_TARGET_DIP'],
+                            c['TRACK_SPAN'] * self.sweep_step), sweepRepeat,
+                c['SAMPLE_BATCH'], order=order)
+        elif c['PIPELINED']:
+            F2I_np = engine.run(sweepFreqs, self.plan_codes, sweepRepeat,
+                                order)
+        else:
+            F2I_np = engine.run_serial(sweepFreqs, self.plan_codes,
+                                       sweepRepeat, order)
+        t2 = time.perf_counter()
+        Timing.record('pass.acquire', t2 - t1)
+        print(f'time: {t2 - t1} s, {len(F2I_np)} points, '
+              f'{len(F2I_np) / (t2 - t1):.2f} points/s, '
+              f"settling {engine.last_stats.get('settle', 0):.3f} s")
+        extra = {}
+        if c['ADAPTIVE_AVERAGING'] and not (c['ADAPTIVE_SCAN']
+                                            or c['LIST_SWEEP']):
+            extra['samples'] = engine.last_counts.tolist()
+            print(f"samples: {engine.last_stats['samples']} of "
+                  f'{len(F2I_np) * sweepRepeat}, '
+                  f"up to {engine.last_stats['batches']} batches a point")
+
+        with span('peaks'):
+            batch = DipDetector(2, 0.05)
+            batch.push(F2I_np[:, 0], F2I_np[:, 1])
+            batch.finish()
+            phase_f = batch.smoothed
+            if detector is not None:
+                kk = detector.indices()
+            elif not c['ADAPTIVE_SCAN']:
+                kk = batch.indices()
+            kk = np.asarray(kk, dtype=int)
+            dips = batch.rows(kk)
+        if c['REFINE_DIPS'] and len(kk):
+            # Sub-step frequencies, the grid points stay in kk
+            with span('peaks.refine'):
+                refined = rf.refine_dips(F2I_np[:, 0], F2I_np[:, 1], kk)
+            dips[:, 0] = refined[:, 0]
+            extra['dips'] = np.where(np.isnan(refined), None,
+                                     refined).tolist()
+            print('refined: ' + ', '.join(
+                f'{f:.1f} +- {std:.1f} Hz' for f, std in refined[:, :2]))
+        # Sampled more densely in the next pass
+        self.last_dips = F2I_np[kk, 0]
+        with span('output.store'):
+            passId = self.store.append(F2I_np, remark, t1, t2,
+                                       self.para_C2F, **extra)
+        if self.peaks is not None:
+            with span('output.peaks'):
+                self.peaks.append(self.store.index[passId]['timestamp'],
+                                  dips, remark, passId)
+
+        print(F2I_np[kk if len(kk) else 0, 0])
+        if self.plotter is not None:
+            # Rendered by the worker process while the next pass runs
+            with span('output.plot'):
+                self.plotter.submit('F2I',
+                                    self.path('F2I', remark, 'png'),
+                                    F2I_np=F2I_np,
+                                    phase_f=phase_f,
+                                    kk=kk if len(kk) else 0)
+            stats = self.plotter.stats()
+            print(f"plots pending: {stats['pending']}, "
+                  f"dropped: {stats['dropped']}, "
+                  f"latency: {stats['latency_p50']:.3f} s")
+        # Where the pass spent its time, p50/p99 per stage
+        print(Timing.TIMINGS.report())
+        Timing.TIMINGS.export(c['TIMING_LOG'],
+                              remark=remark,
+                              points=len(F2I_np))
+        return F2I_np, kk
+
+    def sweep(self, passes, remark=None):
+        '''runs passes one after another, yields F2I_np, kk of each'''
+        for _ in range(passes):
+            yield self.run_pass(remark)
+
+    def _settle(self):
+        return 0.005 if self.settling is None else self.settling
+
+
+def run_readers(config=None, passes=1, remark=None, force=False):
+    """Measures with every reader of ``READERS`` at the same time.
+
+    Every reader is a ``MeasurementSession`` of the settings with the
+    overrides of its ``READERS`` entry, e.g. its own ``VISA_ADDRESS`` and
+    ``DAC_SERVICE``, and the entry's ``NAME``. Unless the entry sets them,
+    ``RES_DIR``, ``CALIBRATION_INDEX`` and ``SETTLING_FILE`` are in the
+    folder ``RES_DIR/NAME``, so readers of the same type do not share
+    their calibration. The readers are calibrated and prepared one after
+    another, then ``MultiReader.ReaderScheduler`` runs their passes
+    concurrently and every pass is appended to ``MULTI_STORE`` as it
+    completes.
+
+    Parameters
+    ----------
+    config : str or dict, optional
+        Settings, see ``MeasurementSession``.
+    passes : int
+        Passes of every reader.
+    remark : str, optional
+        Remark of the records, ``REMARK`` if omitted.
+    force : bool
+        Measure new calibrations.
+
+    Returns
+    -------
+    stored : list of int
+        Ids of the passes in ``MULTI_STORE``, each with rows
+        ``[t2, reader, pass] + F2I row``, see ``MultiReader.merge_timeline``.
+    names : list of str
+        Reader names, indexed by the ``reader`` column.
+    """
+    base = (load_config(**config)
+            if isinstance(config, dict) else load_config(config))
+    entries = base['READERS'] or [{}]
+    remark = base['REMARK'] if remark is None else remark
+    sessions = []
+    try:
+        readers = []
+        for k, entry in enumerate(entries):
+            entry = dict(entry)
+            name = entry.pop('NAME', f'reader{k}')
+            folder = os.path.join(base['RES_DIR'], name)
+            own = {
+                'RES_DIR': folder + os.sep,
+                'CALIBRATION_INDEX': os.path.join(folder, 'C2F_index.json'),
+                'SETTLING_FILE': os.path.join(folder, 'settling.json')
+            }
+            # The passes are not plotted one by one
+            session = MeasurementSession(base, **{
+                **own,
+                **entry, 'PLOTS': False
+            })
+            sessions.append(session)
+            session.open()
+            session.calibrate(force=force)
+            # The passes go to MULTI_STORE
+            session.prepare(outputs=False)
+            readers.append(session.reader(name))
+        names = [reader.name for reader in readers]
+        calibrations = dict(zip(names, (s.c2f_file for s in sessions)))
+        store = open_store(
+            base['MULTI_STORE'],
+            6 + max(s.config['SWEEP_REPEAT'] for s in sessions))
+        scheduler = ReaderScheduler(readers)
+        stored = []
+        for t1, t2, name, k, F2I_np in scheduler.run(passes):
+            # Stored as it completes, an interrupted run keeps its passes
+            head = np.tile([t2, names.index(name), k], (len(F2I_np), 1))
+            stored.append(
+                store.append(np.hstack([head, F2I_np]),
+                             remark,
+                             timestamp=t2,
+                             started=t1,
+                             readers=names,
+                             reader=name,
+                             reader_pass=k,
+                             calibration=calibrations[name]))
+        stats = scheduler.last_stats
+        print(f"{sum(stats['points'].values())} points of {len(readers)} "
+              f"readers in {stats['elapsed']:.3f} s, "
+              f"{stats['points_per_s']:.2f} points/s, {len(stored)} passes "
+              f"in {store.path}")
+        if scheduler.errors:
+            print(f'Stopped readers: {sorted(scheduler.errors)}')
+        return stored, names
+    finally:
+        for session in sessions:
+            session.close()
+
+
+def _value(text):
+    '''setting given on the command line, JSON if it parses'''
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Calibrate the reader, run sweep passes or reprocess '
+        'archived results without prompts.')
+    parser.add_argument('--config', help='JSON file of settings, see DEFAULTS')
+    parser.add_argument('--set',
+                        action='append',
+                        default=[],
+                        metavar='NAME=VALUE',
+                        help='one setting, e.g. SWEEP_POINT_NUM=500 or '
+                        'FITTED_PARA=[13e-6,22e-12,53e3]; repeatable')
+    parser.add_argument('--simulate',
+                        action='store_true',
+                        help='use the offline instrument simulator')
+    parser.add_argument('--no-plots',
+                        action='store_true',
+                        help='do not render the figures')
+    commands = parser.add_subparsers(dest='command', required=True)
+    calibrate = commands.add_parser('calibrate',
+                                    help='load or measure the calibration')
+    sweep = commands.add_parser('sweep', help='run sweep passes')
+    for command in (calibrate, sweep):
+        command.add_argument('--c2f', help='C2F file to load')
+        command.add_argument('--force',
+                             action='store_true',
+                             help='measure a new calibration')
+    sweep.add_argument('--passes', type=int, default=1)
+    sweep.add_argument('--remark', help='remark in the file names')
+    multi = commands.add_parser(
+        'multi', help='run the passes of every reader of READERS at once')
+    multi.add_argument('--force',
+                       action='store_true',
+                       help='measure new calibrations')
+    multi.add_argument('--passes', type=int, default=1,
+                       help='passes of every reader')
+    multi.add_argument('--remark', help='remark of the merged record')
+    commands.add_parser('reprocess',
+                        add_help=False,
+                        help='extract the dips of archived results, the '
+                        'arguments of Reprocess.py follow')
+    args, rest = parser.parse_known_args(argv)
+    if args.command == 'reprocess':
+        # scipy is loaded by this command only
+        import Reprocess
+        Reprocess.main(rest)
+        return 0
+    if rest:
+        parser.error(f'unrecognized arguments: {" ".join(rest)}')
+    overrides = {}
+    for item in args.set:
+        name, sep, text = item.partition('=')
+        if not sep:
+            parser.error(f'--set {item}: expected NAME=VALUE')
+        overrides[name] = _value(text)
+    if args.simulate:
+        overrides['SIMULATE'] = True
+    if args.no_plots:
+        overrides['PLOTS'] = False
+    try:
+        config = load_config(args.config, **overrides)
+    except (OSError, ValueError) as ex:
+        parser.error(str(ex))
+    if args.command == 'multi':
+        try:
+            run_readers(config, args.passes, args.remark, args.force)
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            traceback.print_exc()
+            return 1
+        return 0
+    session = MeasurementSession(config)
+    try:
+        session.open()
+        session.calibrate(args.c2f, args.force)
+        print(f'Calibration: {session.c2f_file}')
+        if args.command == 'sweep':
+            session.prepare()
+            for _ in session.sweep(args.passes, args.remark):
+                pass
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        session.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def C2F_func(p, x):
+    '''relationship between Code and resonant frequency'''
+    # a1, a2, b1, b2 = p
+    # return a1 * np.exp(a2 * x) + b1 * np.exp(b2 * x)
+    return p[0] + p[1] * x + p[2] * np.power(x, 2) + p[3] * np.power(
+        x, 3) + p[4] * np.power(x, 4) + p[5] * np.power(x, 5)
+
+
+def F2Z_func(p, freq):
+    '''relationship between frequency and impedance'''
+    L, C, R = p
+    Real = 1 / R
+    Vir = 1j * 2 * np.pi * freq * C - 1j / (2 * np.pi * freq * L)
+    return np.abs(
+        1 / (Real + Vir)) - 1e12 * (R < 0)  # R should not small than zero
+
+
+def F2T_func(p, freq):
+    '''relationship between frequency and phase'''
+    L, C, R = p
+    Real = R
+    Vir = 2 * np.pi * freq * L - 1 / (2 * np.pi * freq * C)
+    return np.arctan(Vir / Real)
+
+
+def Error(p, func, x, y):  # for the calculation of optimize.leastsq
+    return func(p, x) - y
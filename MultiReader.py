@@ -0,0 +1,216 @@
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+from AcquisitionEngine import AcquisitionEngine
+from Settling import ORDERS, sweep_order
+
+
+class Reader:
+    """One E4990A / AD5791 pair with its calibration and sweep plan.
+
+    Everything a pass needs is held by the reader: the instrument handles
+    (the sweep settings cached by ``E4990AFunctions`` and the register
+    shadow of ``ACERemoteController`` are kept per handle), the code map of
+    its calibration and the frequencies of its pass.
+
+    Parameters
+    ----------
+    name : str
+        Name of the reader in the merged timeline.
+    inst_E
+        E4990A VISA resource, configured with ``configBasic``.
+    inst_AD
+        Reference to the connection to the ACE Application.
+    code_map : CodeMap
+        Inverted C2F calibration of the reader.
+    freqs : array_like
+        Frequencies of a pass.
+    repeat : int
+        Number of points measured at each frequency.
+    offset : float
+        Detuning of the codes from the frequencies, as in ``main.py``.
+    list_tolerance : float, optional
+        Measure with one segment sweep per DAC code, see
+        ``CodeMap.groups_for``; point by point pipelined if omitted.
+    settle : float or SettlingModel
+        Wait after every DAC write, see ``AcquisitionEngine``; the fixed
+        5 ms of ``MeasurementSession`` without a settling model.
+    order : str
+        Order of the codes of a point-by-point pass, see
+        ``Settling.sweep_order``.
+    """
+
+    def __init__(self,
+                 name,
+                 inst_E,
+                 inst_AD,
+                 code_map,
+                 freqs,
+                 repeat=15,
+                 offset=1.002,
+                 list_tolerance=None,
+                 settle=0.005,
+                 order='serpentine'):
+        if order not in ORDERS:
+            raise ValueError(f'unknown sweep order {order!r}, expected one '
+                             f'of {ORDERS}')
+        self.name = name
+        self.inst_E = inst_E
+        self.inst_AD = inst_AD
+        self.code_map = code_map
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.codes = code_map.codes_for(self.freqs * offset)
+        valid = self.codes >= 0
+        if not valid.all():
+            print(f'{name}: {np.count_nonzero(~valid)} frequencies are out '
+                  'of the calibrated range and skipped')
+            self.freqs = self.freqs[valid]
+            self.codes = self.codes[valid]
+        self.groups = None if list_tolerance is None else code_map.groups_for(
+            self.freqs, list_tolerance, offset)
+        self.repeat = repeat
+        self.order = order
+        self.engine = AcquisitionEngine(inst_E, inst_AD, 20, True, settle)
+        self.passes = 0
+
+    def measure(self):
+        '''one pass, returns its F2I rows'''
+        if self.groups is not None:
+            F2I_np = self.engine.run_list(self.groups, self.repeat)
+        else:
+            F2I_np = self.engine.run(
+                self.freqs, self.codes, self.repeat,
+                sweep_order(len(self.freqs), self.order, self.passes))
+        self.passes += 1
+        return F2I_np
+
+
+class ReaderScheduler:
+    """Runs several readers concurrently and merges their passes.
+
+    Each reader gets its own thread, which runs its passes back to back;
+    the instruments are waited on with the GIL released, so the aggregate
+    throughput grows with the number of readers. Threads are used rather
+    than processes because the VISA sessions and ACE clients cannot be
+    passed to another process.
+
+    Parameters
+    ----------
+    readers : list of Reader
+        Readers with distinct instruments.
+    queue_size : int
+        Finished passes buffered before the readers wait for the consumer.
+    """
+
+    def __init__(self, readers, queue_size=16):
+        if len({r.name for r in readers}) != len(readers):
+            raise ValueError('the reader names must be unique')
+        self.readers = list(readers)
+        self.queue_size = queue_size
+        self.errors = {}
+        self.last_stats = {}
+
+    def run(self, passes=None, stop=None):
+        """Yields the passes of all readers in order of completion.
+
+        Parameters
+        ----------
+        passes : int, optional
+            Passes per reader, endless if omitted.
+        stop : threading.Event, optional
+            Ends the run once the passes in progress are finished.
+
+        Yields
+        ------
+        tuple
+            ``(t1, t2, reader name, pass index, F2I_np)`` with the
+            ``time.time()`` start and end of the pass.
+        """
+        stop = threading.Event() if stop is None else stop
+        done = queue.Queue(self.queue_size)
+        self.errors = {}
+
+        def work(reader):
+            try:
+                k = 0
+                while (passes is None or k < passes) and not stop.is_set():
+                    t1 = time.time()
+                    F2I_np = reader.measure()
+                    done.put((t1, time.time(), reader.name, k, F2I_np))
+                    k += 1
+            except Exception:
+                self.errors[reader.name] = traceback.format_exc()
+                print(f'Reader {reader.name} stopped:\n'
+                      f'{self.errors[reader.name]}')
+            finally:
+                done.put(None)
+
+        threads = [
+            threading.Thread(target=work, args=(r, ), daemon=True)
+            for r in self.readers
+        ]
+        t1 = time.perf_counter()
+        for th in threads:
+            th.start()
+        running = len(threads)
+        points = dict.fromkeys((r.name for r in self.readers), 0)
+        try:
+            while running:
+                item = done.get()
+                if item is None:
+                    running -= 1
+                    continue
+                points[item[2]] += len(item[4])
+                yield item
+        finally:
+            # Also reached when the consumer stops iterating
+            stop.set()
+            while running:
+                if done.get() is None:
+                    running -= 1
+            for th in threads:
+                th.join()
+            elapsed = time.perf_counter() - t1
+            self.last_stats = {
+                'elapsed': elapsed,
+                'points': points,
+                'points_per_s': sum(points.values()) / elapsed
+            }
+
+
+def merge_timeline(events):
+    """Stacks the passes of several readers into one time-ordered table.
+
+    Parameters
+    ----------
+    events : iterable of tuple
+        Passes as yielded by ``ReaderScheduler.run``.
+
+    Returns
+    -------
+    timeline : numpy.ndarray
+        Rows ``[t2, reader, pass] + F2I row``, sorted by the end time of
+        the pass, then by frequency; ``reader`` indexes ``names``.
+    names : list of str
+        Reader names in order of first appearance.
+    """
+    names = []
+    blocks = []
+    width = 0
+    for t1, t2, name, k, F2I_np in sorted(events, key=lambda e: e[1]):
+        if name not in names:
+            names.append(name)
+        head = np.tile([t2, names.index(name), k], (len(F2I_np), 1))
+        blocks.append(np.hstack([head, F2I_np]))
+        width = max(width, blocks[-1].shape[1])
+    if not blocks:
+        return np.zeros((0, 3)), names
+    # Readers may average a different number of points
+    timeline = np.full((sum(len(b) for b in blocks), width), np.nan)
+    row = 0
+    for b in blocks:
+        timeline[row:row + len(b), :b.shape[1]] = b
+        row += len(b)
+    return timeline, names
@@ -0,0 +1,440 @@
+import glob
+import json
+import os
+from datetime import datetime
+import numpy as np
+
+COLUMNS = ('time', 'pass', 'dip', 'point', 'freq', 'phase_f', 'phase',
+           'prominence', 'remark')
+SEGMENT_ROWS = 1 << 16  # dips per segment file
+ROLLUP_LEVELS = (60, 3600)  # bucket widths of the rollups, s
+ROLLUP_STATS = ('count', 'freq_min', 'freq_max', 'freq_sum', 'phase_min',
+                'phase_max', 'phase_sum')
+CHUNK_BUCKETS = 1024  # rollup buckets preallocated at a time
+
+
+class PeakSeries:
+    """Time series of the phase dips of the passes, with rollups.
+
+    Every dip of a pass is one row: its time, pass id, ordinal ``dip``
+    within the pass (0 is the lowest frequency), ``point`` index, frequency,
+    smoothed phase ``phase_f`` (the depth), phase, prominence and remark.
+    The rows go to segment files of ``SEGMENT_ROWS`` rows, each holding
+    every column contiguously as little-endian float64, so a range query
+    memory-maps the columns it needs and bisects the time column. The time
+    column is written last and a zero time marks a free row, so an
+    interrupted append leaves the series consistent. With ``max_segments``
+    the oldest segment is deleted when a new one starts, a ring buffer of
+    the raw rows.
+
+    For every level of ``levels`` the count, minimum, maximum and sum of
+    the frequency and of the smoothed phase of each dip ordinal are kept
+    per bucket of that many seconds, updated with every append. The
+    rollups are kept when the raw rows are dropped, so weeks of
+    monitoring come back from a few thousand buckets.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the series, created if missing.
+    levels : tuple of int
+        Bucket widths of the rollups in s, fixed when the series is created.
+    max_dips : int
+        Dip ordinals rolled up, fixed when the series is created; later
+        dips of a pass are only kept raw.
+    max_segments : int, optional
+        Raw segments kept, all if None.
+    """
+
+    def __init__(self, path, levels=ROLLUP_LEVELS, max_dips=8,
+                 max_segments=None):
+        self.path = path
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        else:
+            os.makedirs(path, exist_ok=True)
+            meta = {
+                'columns': list(COLUMNS),
+                'segment_rows': SEGMENT_ROWS,
+                'levels': [int(level) for level in levels],
+                'max_dips': int(max_dips),
+                'dtype': '<f8'
+            }
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        self.segment_rows = meta['segment_rows']
+        self.levels = tuple(meta['levels'])
+        self.max_dips = meta['max_dips']
+        self.max_segments = max_segments
+        self.width = 1 + len(ROLLUP_STATS) * self.max_dips  # of a bucket
+        self.remarks_path = os.path.join(path, 'remarks.json')
+        self.remarks = []
+        if os.path.exists(self.remarks_path):
+            with open(self.remarks_path, 'r') as f:
+                self.remarks = json.load(f)
+        # [id, first time, last time, rows] of the segments, oldest first
+        self.segments = []
+        for name in sorted(glob.glob(os.path.join(path, 'segment_*.f8'))):
+            seg = int(os.path.basename(name)[8:-3])
+            times = self._segment(seg)[0]
+            rows = _used(times)
+            self.segments.append([
+                seg, times[0] if rows else 0.0,
+                times[rows - 1] if rows else 0.0, rows
+            ])
+        self.buckets = {}  # used buckets per level
+        for level in self.levels:
+            self.buckets[level] = _used(self._rollup(level)[:, 0])
+        self._repair()
+
+    def __len__(self):
+        return sum(s[3] for s in self.segments)
+
+    def append(self, timestamp, rows, remark='', pass_id=-1):
+        """Appends the dips of one pass.
+
+        Parameters
+        ----------
+        timestamp : float or datetime
+            Time of the pass, not before the last one appended.
+        rows : array_like
+            ``[freq, smoothed phase, phase, prominence, index]`` of every
+            dip in ascending frequency, see ``DipDetector.rows``.
+        remark : str
+            Remark of the pass.
+        pass_id : int
+            Id of the pass in the ``ResultStore``.
+        """
+        rows = np.asarray(rows, dtype=float).reshape(-1, 5)
+        if len(rows) == 0:
+            return
+        t = _epoch(timestamp)
+        if self.segments:
+            t = max(t, self.segments[-1][2])  # a clock step back
+        if remark not in self.remarks:
+            self.remarks.append(remark)
+            with open(self.remarks_path, 'w') as f:
+                json.dump(self.remarks, f)
+        n = len(rows)
+        columns = np.empty((len(COLUMNS), n))
+        columns[0] = t
+        columns[1] = pass_id
+        columns[2] = np.arange(n)
+        columns[3] = rows[:, 4]
+        columns[4:8] = rows[:, :4].T
+        columns[8] = self.remarks.index(remark)
+        start = 0
+        while start < n:
+            if not self.segments or \
+                    self.segments[-1][3] == self.segment_rows:
+                self._new_segment()
+            seg = self.segments[-1]
+            stop = min(n, start + self.segment_rows - seg[3])
+            self._write(seg, columns[:, start:stop])
+            start = stop
+        for level in self.levels:
+            self._roll(level, columns)
+        return
+
+    def query(self, since=None, until=None, dip=None, remark=None,
+              columns=COLUMNS):
+        """Raw rows in a time range.
+
+        Parameters
+        ----------
+        since, until : float or datetime, optional
+            Time range, inclusive.
+        dip : int, optional
+            Only this dip ordinal.
+        remark : str, optional
+            Only the passes with this remark.
+        columns : tuple of str
+            Columns returned.
+
+        Returns
+        -------
+        dict of numpy.ndarray
+            Columns of the rows, ``remark`` as remark ids, see ``remarks``.
+        """
+        lo = -np.inf if since is None else _epoch(since)
+        hi = np.inf if until is None else _epoch(until)
+        index = [COLUMNS.index(c) for c in columns]
+        parts = {c: [] for c in columns}
+        keep = []
+        for seg, first, last, rows in self.segments:
+            if rows == 0 or last < lo or first > hi:
+                continue
+            data = self._segment(seg)
+            a = np.searchsorted(data[0, :rows], lo, 'left')
+            b = np.searchsorted(data[0, :rows], hi, 'right')
+            mask = np.ones(b - a, dtype=bool)
+            if dip is not None:
+                mask &= data[2, a:b] == dip
+            if remark is not None:
+                mask &= data[8, a:b] == (self.remarks.index(remark)
+                                         if remark in self.remarks else -1)
+            keep.append(mask)
+            for c, k in zip(columns, index):
+                parts[c].append(data[k, a:b])
+        result = {}
+        for c in columns:
+            values = np.concatenate(parts[c]) if parts[c] else np.zeros(0)
+            result[c] = values[np.concatenate(keep)] if keep else values
+        return result
+
+    def rollup(self, level, since=None, until=None, dip=None):
+        """Buckets of a rollup level in a time range.
+
+        Parameters
+        ----------
+        level : int
+            Bucket width in s, one of ``levels``.
+        since, until : float or datetime, optional
+            Time range, buckets starting within it.
+        dip : int, optional
+            Only this dip ordinal; otherwise the statistics have one column
+            per ordinal.
+
+        Returns
+        -------
+        dict of numpy.ndarray
+            ``time`` (bucket start), ``count``, ``freq_min``, ``freq_max``,
+            ``freq_mean``, ``phase_min``, ``phase_max`` and ``phase_mean``;
+            NaN where a bucket has no dip of an ordinal.
+        """
+        if level not in self.levels:
+            raise ValueError(f'no rollup of {level} s, the levels are '
+                             f'{self.levels}')
+        data = self._rollup(level)[:self.buckets[level]]
+        a = 0 if since is None else np.searchsorted(data[:, 0],
+                                                    _epoch(since), 'left')
+        b = len(data) if until is None else np.searchsorted(
+            data[:, 0], _epoch(until), 'right')
+        data = np.array(data[a:b])
+        D = self.max_dips
+        stats = {
+            name: data[:, 1 + k * D:1 + (k + 1) * D]
+            for k, name in enumerate(ROLLUP_STATS)
+        }
+        count = stats['count']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = {
+                'time': data[:, 0],
+                'count': count,
+                'freq_min': np.where(count > 0, stats['freq_min'], np.nan),
+                'freq_max': np.where(count > 0, stats['freq_max'], np.nan),
+                'freq_mean': stats['freq_sum'] / count,
+                'phase_min': np.where(count > 0, stats['phase_min'], np.nan),
+                'phase_max': np.where(count > 0, stats['phase_max'], np.nan),
+                'phase_mean': stats['phase_sum'] / count
+            }
+        if dip is not None:
+            result = {
+                name: values if name == 'time' else values[:, dip]
+                for name, values in result.items()
+            }
+        return result
+
+    def series(self, since=None, until=None, dip=None, max_points=2000):
+        """Frequency of a dip over a time range at a plottable resolution.
+
+        The raw rows if there are at most ``max_points`` of them, else the
+        finest rollup with at most ``max_points`` buckets.
+
+        Returns
+        -------
+        level : int
+            Bucket width in s, 0 for the raw rows.
+        data : dict of numpy.ndarray
+            See ``query`` or ``rollup``.
+        """
+        lo = -np.inf if since is None else _epoch(since)
+        hi = np.inf if until is None else _epoch(until)
+        raw = sum(r for _, first, last, r in self.segments
+                  if r and last >= lo and first <= hi)
+        if raw <= max_points:
+            return 0, self.query(since, until, dip)
+        for level in sorted(self.levels):
+            starts = self._rollup(level)[:self.buckets[level], 0]
+            count = (np.searchsorted(starts, hi, 'right') -
+                     np.searchsorted(starts, lo - level, 'right'))
+            if count <= max_points:
+                return level, self.rollup(level, lo - level
+                                          if since is not None else None,
+                                          until, dip)
+        level = max(self.levels)
+        return level, self.rollup(level, since, until, dip)
+
+    def rebuild_rollups(self):
+        '''recomputes the rollups from the raw rows still kept, the buckets
+        before the oldest of them are kept'''
+        first = next((s[1] for s in self.segments if s[3]), None)
+        if first is None:
+            return
+        for level in self.levels:
+            self._rebuild(level, np.floor(first / level) * level)
+        return
+
+    def _segment(self, seg, mode='r'):
+        return np.memmap(os.path.join(self.path, f'segment_{seg:08d}.f8'),
+                         dtype='<f8',
+                         mode=mode,
+                         shape=(len(COLUMNS), self.segment_rows))
+
+    def _new_segment(self):
+        seg = self.segments[-1][0] + 1 if self.segments else 0
+        with open(os.path.join(self.path, f'segment_{seg:08d}.f8'),
+                  'wb') as f:
+            f.truncate(len(COLUMNS) * self.segment_rows * 8)
+        self.segments.append([seg, 0.0, 0.0, 0])
+        if self.max_segments is not None:
+            while len(self.segments) > self.max_segments:
+                old = self.segments.pop(0)
+                os.remove(
+                    os.path.join(self.path, f'segment_{old[0]:08d}.f8'))
+        return
+
+    def _write(self, seg, columns):
+        n = columns.shape[1]
+        with open(os.path.join(self.path, f'segment_{seg[0]:08d}.f8'),
+                  'r+b') as f:
+            # The time column commits the rows, it is written last
+            for k in list(range(1, len(COLUMNS))) + [0]:
+                f.seek((k * self.segment_rows + seg[3]) * 8)
+                f.write(np.ascontiguousarray(columns[k], dtype='<f8').tobytes())
+        if seg[3] == 0:
+            seg[1] = columns[0, 0]
+        seg[2] = columns[0, -1]
+        seg[3] += n
+        return
+
+    def _rollup_path(self, level):
+        return os.path.join(self.path, f'rollup_{level}.f8')
+
+    def _rollup(self, level, buckets=0):
+        '''memory-mapped buckets of a level, grown to hold buckets'''
+        path = self._rollup_path(level)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        needed = max(buckets, 1) * self.width * 8
+        if size < needed:
+            chunk = CHUNK_BUCKETS * self.width * 8
+            with open(path, 'ab') as f:
+                f.truncate(-(-needed // chunk) * chunk)
+            size = os.path.getsize(path)
+        return np.memmap(path,
+                         dtype='<f8',
+                         mode='r',
+                         shape=(size // (self.width * 8), self.width))
+
+    def _buckets(self, columns, level):
+        '''rollup rows of raw columns, one per bucket in time order'''
+        D = self.max_dips
+        dips = columns[2].astype(int)
+        columns = columns[:, dips < D]
+        dips = dips[dips < D]
+        starts = np.floor(columns[0] / level) * level
+        unique, inverse = np.unique(starts, return_inverse=True)
+        out = np.zeros((len(unique), self.width))
+        out[:, 0] = unique
+        stat = {name: 1 + k * D for k, name in enumerate(ROLLUP_STATS)}
+        for name in ('freq_min', 'phase_min'):
+            out[:, stat[name]:stat[name] + D] = np.inf
+        for name in ('freq_max', 'phase_max'):
+            out[:, stat[name]:stat[name] + D] = -np.inf
+        for col, prefix in ((4, 'freq'), (5, 'phase')):
+            values = columns[col]
+            np.minimum.at(out, (inverse, stat[prefix + '_min'] + dips), values)
+            np.maximum.at(out, (inverse, stat[prefix + '_max'] + dips), values)
+            np.add.at(out, (inverse, stat[prefix + '_sum'] + dips), values)
+        np.add.at(out, (inverse, stat['count'] + dips), 1)
+        return out
+
+    def _roll(self, level, columns):
+        '''merges the dips of an append into the buckets of a level'''
+        new = self._buckets(columns, level)
+        if len(new) == 0:
+            return
+        used = self.buckets[level]
+        data = self._rollup(level, used + len(new))
+        if used and new[0, 0] == data[used - 1, 0]:
+            # The pass falls into the open bucket
+            new[0] = _merge(np.array(data[used - 1]), new[0], self.max_dips)
+            used -= 1
+        self._write_buckets(level, used, new)
+        return
+
+    def _write_buckets(self, level, position, rows):
+        '''writes buckets from position on, they are the last ones'''
+        self._rollup(level, position + len(rows))
+        stale = max(self.buckets[level] - position - len(rows), 0)
+        with open(self._rollup_path(level), 'r+b') as f:
+            f.seek(position * self.width * 8)
+            f.write(np.ascontiguousarray(rows, dtype='<f8').tobytes())
+            f.write(bytes(stale * self.width * 8))
+        self.buckets[level] = position + len(rows)
+        return
+
+    def _rebuild(self, level, since):
+        '''recomputes the buckets of a level from since on'''
+        raw = self.query(since)
+        if len(raw['time']) == 0:
+            return
+        columns = np.vstack([raw[c] for c in COLUMNS])
+        starts = self._rollup(level)[:self.buckets[level], 0]
+        position = int(np.searchsorted(starts, since, 'left'))
+        self._write_buckets(level, position, self._buckets(columns, level))
+        return
+
+    def _repair(self):
+        '''rolls up the raw rows committed after the last bucket update,
+        e.g. after an interrupted append'''
+        if not len(self):
+            return
+        last = self.segments[-1][2]
+        for level in self.levels:
+            used = self.buckets[level]
+            data = self._rollup(level)
+            if used == 0:
+                self._rebuild(level, -np.inf)
+                continue
+            start = data[used - 1, 0]
+            counted = data[used - 1, 1:1 + self.max_dips].sum()
+            in_bucket = self.query(start, start + level, columns=('dip', ))
+            expected = np.count_nonzero(in_bucket['dip'] < self.max_dips)
+            if last >= start + level or counted != expected:
+                self._rebuild(level, start)
+        return
+
+
+def _merge(a, b, D):
+    '''bucket row of two bucket rows of the same start'''
+    out = np.array(a)
+    stat = {name: 1 + k * D for k, name in enumerate(ROLLUP_STATS)}
+    for name in ('count', 'freq_sum', 'phase_sum'):
+        s = slice(stat[name], stat[name] + D)
+        out[s] = a[s] + b[s]
+    for name in ('freq_min', 'phase_min'):
+        s = slice(stat[name], stat[name] + D)
+        out[s] = np.minimum(a[s], b[s])
+    for name in ('freq_max', 'phase_max'):
+        s = slice(stat[name], stat[name] + D)
+        out[s] = np.maximum(a[s], b[s])
+    return out
+
+
+def _used(starts):
+    '''rows in use of a column that is positive up to its first zero'''
+    lo, hi = 0, len(starts)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if starts[mid] > 0:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _epoch(t):
+    return t.timestamp() if isinstance(t, datetime) else float(t)
@@ -0,0 +1,263 @@
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import numpy as np
+from ModelFunctions import C2F_func
+from Timing import record
+
+
+class PlotWorker:
+    """Renders and saves the result figures in a separate process.
+
+    The worker is a child Python process running this module with a
+    headless matplotlib backend (or TkAgg with ``live``, where the latest
+    figure of each kind stays open and is refreshed). Jobs are pickled to
+    its stdin by a sender thread, so ``submit`` returns at once, and every
+    finished job is acknowledged on its stdout with its render time. If the
+    worker dies, the sender keeps taking the jobs off the queue and counts
+    them as ``dropped``, so neither ``submit`` nor ``close`` blocks.
+
+    The child is started from its own script rather than through
+    ``multiprocessing``, whose spawn start method would re-run the
+    measurement script on Windows.
+
+    Parameters
+    ----------
+    live : bool
+        Keep a live view of the latest figures open.
+    queue_size : int
+        Jobs waiting to be sent before ``submit`` blocks.
+    """
+
+    def __init__(self, live=False, queue_size=32):
+        args = [sys.executable, os.path.abspath(__file__)]
+        if live:
+            args.append('--live')
+        self.process = subprocess.Popen(args,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.live = live
+        self.jobs = queue.Queue(queue_size)
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_pending = 0
+        self.latency = []  # submit to acknowledgement, s
+        self.render = []  # rendering and saving in the worker, s
+        self._sent = {}
+        self._lock = threading.Lock()
+        self._sender = threading.Thread(target=self._send, daemon=True)
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._sender.start()
+        self._receiver.start()
+
+    def submit(self, kind, path, **arrays):
+        """Queues one figure.
+
+        Parameters
+        ----------
+        kind : str
+            ``'F2I'`` or ``'C2F'``, see ``render_F2I`` and ``render_C2F``.
+        path : str
+            File the figure is saved to.
+        **arrays
+            Keyword arguments of the render function.
+        """
+        with self._lock:
+            job = self.submitted
+            self.submitted += 1
+            self._sent[job] = time.perf_counter()
+            self.max_pending = max(self.max_pending, self.pending())
+        self.jobs.put((job, kind, path, arrays))
+        return job
+
+    def pending(self):
+        '''number of submitted jobs not acknowledged yet (queue depth)'''
+        return self.submitted - self.done - self.failed - self.dropped
+
+    def stats(self):
+        """Queue depth and latency of the finished jobs.
+
+        Returns
+        -------
+        dict
+            ``submitted``, ``done``, ``failed``, ``dropped``, ``pending``
+            and ``max_pending`` jobs; median and maximum ``latency`` from
+            ``submit`` to acknowledgement and mean ``render`` time, in s.
+        """
+        with self._lock:
+            latency = np.array(self.latency)
+            render = np.array(self.render)
+            return {
+                'submitted': self.submitted,
+                'done': self.done,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'pending': self.pending(),
+                'max_pending': self.max_pending,
+                'latency_p50': float(np.median(latency)) if len(latency)
+                else np.nan,
+                'latency_max': float(latency.max()) if len(latency)
+                else np.nan,
+                'render_mean': float(render.mean()) if len(render)
+                else np.nan
+            }
+
+    def close(self, timeout=None):
+        '''waits for the queued figures, then stops the worker; a live
+        worker is left running until its windows are closed'''
+        self.jobs.put(None)
+        self._sender.join(timeout)
+        self._receiver.join(timeout)
+        if self.live and self.process.poll() is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        return
+
+    def _send(self):
+        while True:
+            item = self.jobs.get()
+            try:
+                pickle.dump(item, self.process.stdin)
+                self.process.stdin.flush()
+                if item is None:
+                    self.process.stdin.close()
+                    return
+            except (BrokenPipeError, OSError):
+                print('The plot worker has stopped, figures are not saved')
+                if item is None:
+                    return
+                self._drop(item)
+                break
+        # Keep the queue moving so that submit and close do not block
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                return
+            self._drop(item)
+
+    def _drop(self, item):
+        '''counts a job that was not sent to the worker'''
+        with self._lock:
+            self._sent.pop(item[0], None)
+            self.dropped += 1
+
+    def _receive(self):
+        while True:
+            try:
+                job, render, error = pickle.load(self.process.stdout)
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                self.latency.append(time.perf_counter() - self._sent.pop(job))
+                record('plot.latency', self.latency[-1])
+                if error is None:
+                    record('plot.render', render)
+                    self.done += 1
+                    self.render.append(render)
+                else:
+                    self.failed += 1
+            if error is not None:
+                print(error)
+
+
+def render_F2I(fig, F2I_np, phase_f, kk):
+    '''phase of an F2I pass, its smoothed phase and the detected dips'''
+    ax = fig.add_subplot()
+    ax.plot(F2I_np[3:, 0], F2I_np[3:, 1], c='#77A88D')
+    ax.plot(F2I_np[3:, 0], phase_f[3:], c='y', ls='--')
+    ax.plot(F2I_np[kk, 0], phase_f[kk], 'r^')
+    ax.set_xlabel('Frequency (Hz)')
+    ax.set_ylabel('Phase (°)')
+    return
+
+
+def render_C2F(fig, C2F_np, para_C2F):
+    '''measured and fitted resonant frequency of the codes, and the error'''
+    ax = fig.add_subplot()
+    p1 = ax.plot(C2F_np[:, 0], C2F_np[:, 1], c='#003366', label='measured')
+    p2 = ax.plot(C2F_np[:, 0],
+                 C2F_func(para_C2F, C2F_np[:, 0]),
+                 '--',
+                 c='#cc3333',
+                 label='fitted')
+    ax.set_xlabel("Code")
+    ax.set_ylabel("resonant frequency (Hz)")
+    ax2 = ax.twinx()
+    p3 = ax2.plot(C2F_np[:, 0],
+                  (C2F_func(para_C2F, C2F_np[:, 0]) - C2F_np[:, 1]) /
+                  C2F_np[:, 1] * 100,
+                  '-r',
+                  label='error')
+    ax2.set_ylabel("Error (%)")
+    p = p1 + p2 + p3
+    ax.legend(p, [kk.get_label() for kk in p], loc=0)
+    return
+
+
+RENDERERS = {'F2I': render_F2I, 'C2F': render_C2F}
+
+
+def _serve(live):
+    '''worker process: renders the jobs read from stdin'''
+    import matplotlib
+    matplotlib.use('TkAgg' if live else 'Agg')
+    import matplotlib.pyplot as plt
+    source, sink = sys.stdin.buffer, sys.stdout.buffer
+    sys.stdout = sys.stderr  # keep the acknowledgement channel clean
+    jobs = queue.Queue()
+
+    def read():
+        while True:
+            try:
+                jobs.put(pickle.load(source))
+            except EOFError:
+                jobs.put(None)
+                return
+
+    threading.Thread(target=read, daemon=True).start()
+    shown = {}
+    while True:
+        try:
+            item = jobs.get(timeout=0.1)
+        except queue.Empty:
+            if live:
+                plt.pause(0.05)
+            continue
+        if item is None:
+            break
+        job, kind, path, arrays = item
+        t = time.perf_counter()
+        error = None
+        try:
+            fig = plt.figure()
+            RENDERERS[kind](fig, **arrays)
+            fig.savefig(path)
+            if live:
+                if kind in shown:
+                    plt.close(shown[kind])
+                shown[kind] = fig
+                plt.pause(0.001)
+            else:
+                plt.close(fig)
+        except Exception:
+            error = f'Plot of {path} failed:\n{traceback.format_exc()}'
+        pickle.dump((job, time.perf_counter() - t, error), sink)
+        sink.flush()
+    if live and shown:
+        sink.close()  # the parent stops waiting, the windows stay open
+        plt.show()
+    return
+
+
+if __name__ == '__main__':
+    _serve('--live' in sys.argv[1:])
@@ -0,0 +1,363 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.ndimage import gaussian_filter1d as ft
+from scipy.signal import find_peaks as fp
+import ResonatorFit as rf
+from Calibration import read_C2F
+from ModelFunctions import C2F_func
+from ResultStore import ResultStore, parse_result_name
+
+PEAK_COLUMNS = ('source', 'time', 'remark', 'freq', 'phase_f', 'phase',
+                'prominence', 'index')
+C2F_COLUMNS = ('source', 'time', 'para_C2F', 'max_error', 'rms_error',
+               'codes')
+
+
+def find_dips(F2I_np, sigma=2, prominence=0.05):
+    """Phase dips of one pass, as the acquisition loop detects them.
+
+    Parameters
+    ----------
+    F2I_np : numpy.ndarray
+        ``F2I`` rows ``[freq, mean phase, ...]`` of the pass.
+    sigma : float
+        Gaussian smoothing of the phase, in points.
+    prominence : float
+        Prominence of a dip in the smoothed phase.
+
+    Returns
+    -------
+    numpy.ndarray
+        Rows ``[freq, smoothed phase, phase, prominence, index]``.
+    """
+    phase_f = ft(F2I_np[:, 1], sigma)
+    kk, props = fp(-phase_f, prominence=prominence)
+    return np.column_stack([
+        F2I_np[kk, 0], phase_f[kk], F2I_np[kk, 1], props['prominences'], kk
+    ]).reshape(-1, 5)
+
+
+def refit_C2F(C2F_np):
+    """Fits the C2F polynomial again.
+
+    Returns
+    -------
+    para_C2F : numpy.ndarray
+    errors : numpy.ndarray
+        Relative error of the fit at every code.
+    """
+    if len(C2F_np) < 6:
+        raise ValueError(f'{len(C2F_np)} codes do not determine the C2F '
+                         'polynomial')
+    para_C2F = rf.fit_C2F(C2F_np[:, 0], C2F_np[:, 1])
+    return para_C2F, (C2F_func(para_C2F, C2F_np[:, 0]) - C2F_np[:, 1]) / \
+        C2F_np[:, 1]
+
+
+def scan_sources(dirs, skip=()):
+    """Passes and calibrations found in result folders.
+
+    ``F2I_*.txt`` and ``C2F_*.txt`` files and every pass of the result
+    stores below the folders are listed; nothing is loaded yet. The folders
+    in ``skip``, e.g. the output of ``reprocess``, are not searched.
+
+    Returns
+    -------
+    list of tuple
+        ``(key, kind, path, pass id, signature)``; ``kind`` is ``'F2I'``
+        or ``'C2F'``, the signature changes when a text file is rewritten.
+    """
+    skip = {os.path.realpath(path) for path in skip}
+    sources = []
+    for top in dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            if os.path.realpath(dirpath) in skip:
+                dirnames[:] = []
+                continue
+            if 'meta.json' in filenames and 'passes.jsonl' in filenames:
+                store = ResultStore(dirpath)
+                kind = 'C2F' if store.width == 2 else 'F2I'
+                for entry in store.index:
+                    sources.append((f'{dirpath}#{entry["pass"]}', kind,
+                                    dirpath, entry['pass'], ''))
+                dirnames[:] = []
+                continue
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                parsed = parse_result_name(path)
+                if parsed is not None:
+                    st = os.stat(path)
+                    sources.append((path, parsed[0], path, None,
+                                    f'{st.st_size}:{st.st_mtime_ns}'))
+    return sources
+
+
+def process_source(source, sigma=2, prominence=0.05):
+    """Loads one pass or calibration and analyzes it, in a worker process.
+
+    Returns
+    -------
+    dict
+        ``key``, ``kind``, ``time``, ``remark`` and the ``peaks`` rows of
+        ``find_dips`` for a pass, ``para_C2F`` and ``errors`` of
+        ``refit_C2F`` for a calibration; ``error`` if it failed.
+    """
+    key, kind, path, pass_id, signature = source
+    try:
+        if pass_id is None:
+            _, remark, timestamp = parse_result_name(path)
+            if kind == 'C2F':
+                rows = read_C2F(path)[1]
+            else:
+                rows = np.atleast_2d(np.loadtxt(path))
+        else:
+            store = ResultStore(path)
+            entry = store.index[pass_id]
+            remark, timestamp = entry['remark'], entry['timestamp']
+            rows = np.array(store.view(pass_id))
+        result = {'key': key, 'kind': kind, 'time': timestamp,
+                  'remark': remark}
+        if kind == 'C2F':
+            result['para_C2F'], result['errors'] = refit_C2F(rows)
+        else:
+            result['peaks'] = find_dips(rows, sigma, prominence)
+        return result
+    except Exception as ex:
+        return {
+            'key': key,
+            'kind': kind,
+            'error': f'{type(ex).__name__}: {ex}'
+        }
+
+
+class PeakTable:
+    """Columnar peak table of the reprocessed passes, built incrementally.
+
+    Every run writes the results of its new sources to a part file
+    (``part_<n>.npz``) and records the sources in ``manifest.jsonl``; the
+    consolidated ``peaks.npz`` and ``c2f.npz`` are concatenations of the
+    parts. The analysis parameters are fixed per table.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the table, created if missing.
+    sigma, prominence : float
+        Parameters of ``find_dips``.
+    """
+
+    def __init__(self, path, sigma=2, prominence=0.05):
+        self.path = path
+        params = {'sigma': sigma, 'prominence': prominence}
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                if json.load(f) != params:
+                    raise ValueError(f'{path} was processed with other '
+                                     'parameters, choose another folder')
+        else:
+            os.makedirs(path, exist_ok=True)
+            with open(meta_path, 'w') as f:
+                json.dump(params, f)
+        self.params = params
+        self.manifest_path = os.path.join(path, 'manifest.jsonl')
+        self.done = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.done[entry['key']] = entry['signature']
+
+    def pending(self, sources):
+        '''sources not processed yet, or changed since'''
+        return [s for s in sources if self.done.get(s[0]) != s[4]]
+
+    def add(self, results, sources):
+        """Writes the results of one run as a new part.
+
+        Parameters
+        ----------
+        results : list of dict
+            Successful results of ``process_source``.
+        sources : dict
+            Source tuples by key, for the manifest signatures.
+        """
+        if not results:
+            return
+        part = 0
+        while os.path.exists(os.path.join(self.path, f'part_{part}.npz')):
+            part += 1
+        np.savez(os.path.join(self.path, f'part_{part}.npz'),
+                 **_columns([r for r in results if r['kind'] == 'F2I'],
+                            [r for r in results if r['kind'] == 'C2F']))
+        # The part is complete, commit its sources
+        with open(self.manifest_path, 'a') as f:
+            for r in results:
+                f.write(
+                    json.dumps({
+                        'key': r['key'],
+                        'signature': sources[r['key']][4],
+                        'part': part
+                    }) + '\n')
+                self.done[r['key']] = sources[r['key']][4]
+        self.consolidate()
+        return
+
+    def consolidate(self):
+        """Rebuilds ``peaks.npz`` and ``c2f.npz`` from the parts.
+
+        A source processed again, because its file changed, keeps the rows
+        of its latest part only.
+        """
+        latest = {}
+        with open(self.manifest_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    latest[entry['key']] = entry['part']
+        tables = {'peaks': {}, 'c2f': {}}
+        part = 0
+        while os.path.exists(os.path.join(self.path, f'part_{part}.npz')):
+            with np.load(os.path.join(self.path, f'part_{part}.npz')) as data:
+                for table, columns in tables.items():
+                    keep = np.array([
+                        latest.get(key) == part
+                        for key in data[f'{table}.source']
+                    ], dtype=bool)
+                    for column in (PEAK_COLUMNS
+                                   if table == 'peaks' else C2F_COLUMNS):
+                        columns.setdefault(column, []).append(
+                            data[f'{table}.{column}'][keep])
+            part += 1
+        for table, columns in tables.items():
+            np.savez(os.path.join(self.path, f'{table}.npz'),
+                     **{c: np.concatenate(v) for c, v in columns.items()})
+        return
+
+
+def load_table(path, table='peaks'):
+    """Columns of a consolidated table.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the ``PeakTable``.
+    table : str
+        ``'peaks'`` or ``'c2f'``.
+
+    Returns
+    -------
+    dict of numpy.ndarray
+    """
+    with np.load(os.path.join(path, f'{table}.npz')) as data:
+        return {c: data[c] for c in data.files}
+
+
+def _columns(peaks, c2f):
+    counts = [len(r['peaks']) for r in peaks]
+    rows = np.vstack([r['peaks'] for r in peaks] + [np.zeros((0, 5))])
+    errors = [np.abs(r['errors']) for r in c2f]
+    return {
+        'peaks.source': np.repeat(np.array([r['key'] for r in peaks],
+                                           dtype=str), counts),
+        'peaks.time': np.repeat(np.array([r['time'] for r in peaks],
+                                         dtype=float), counts),
+        'peaks.remark': np.repeat(np.array([r['remark'] for r in peaks],
+                                           dtype=str), counts),
+        'peaks.freq': rows[:, 0],
+        'peaks.phase_f': rows[:, 1],
+        'peaks.phase': rows[:, 2],
+        'peaks.prominence': rows[:, 3],
+        'peaks.index': rows[:, 4].astype(np.int64),
+        'c2f.source': np.array([r['key'] for r in c2f], dtype=str),
+        'c2f.time': np.array([r['time'] for r in c2f], dtype=float),
+        'c2f.para_C2F': np.array([r['para_C2F'] for r in c2f],
+                                 dtype=float).reshape(-1, 6),
+        'c2f.max_error': np.array([e.max() for e in errors], dtype=float),
+        'c2f.rms_error': np.array([np.sqrt(np.mean(e**2)) for e in errors],
+                                  dtype=float),
+        'c2f.codes': np.array([len(e) for e in errors], dtype=np.int64)
+    }
+
+
+def reprocess(dirs, out, sigma=2, prominence=0.05, workers=None,
+              chunksize=16):
+    """Analyzes the new passes and calibrations of result folders.
+
+    Parameters
+    ----------
+    dirs : list of str
+        Result folders, searched recursively.
+    out : str
+        Folder of the ``PeakTable``.
+    sigma, prominence : float
+        Parameters of ``find_dips``.
+    workers : int, optional
+        Worker processes, one per CPU if omitted.
+    chunksize : int
+        Sources sent to a worker at a time.
+
+    Returns
+    -------
+    dict
+        Number of ``sources`` found, ``processed`` now, ``skipped`` as
+        already done and ``failed``.
+    """
+    table = PeakTable(out, sigma, prominence)
+    # The table may be below the result folders
+    sources = scan_sources(dirs, [out])
+    todo = table.pending(sources)
+    results = []
+    failed = 0
+    if todo:
+        with ProcessPoolExecutor(workers) as pool:
+            for r in pool.map(process_source,
+                              todo,
+                              [sigma] * len(todo), [prominence] * len(todo),
+                              chunksize=chunksize):
+                if 'error' in r:
+                    failed += 1
+                    print(f"Skip {r['key']}: {r['error']}")
+                else:
+                    results.append(r)
+    table.add(results, {s[0]: s for s in todo})
+    return {
+        'sources': len(sources),
+        'processed': len(results),
+        'skipped': len(sources) - len(todo),
+        'failed': failed
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Extract the phase dips and refit the C2F calibrations '
+        'of archived results into a columnar table.')
+    parser.add_argument('dirs', nargs='+', help='result folders, e.g. ./res/')
+    parser.add_argument('--out',
+                        default='./res/reprocessed',
+                        help='folder of the table (default %(default)s)')
+    parser.add_argument('--sigma', type=float, default=2,
+                        help='gaussian smoothing in points (default 2)')
+    parser.add_argument('--prominence', type=float, default=0.05,
+                        help='dip prominence (default 0.05)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: CPU count)')
+    args = parser.parse_args(argv)
+    t1 = time.perf_counter()
+    summary = reprocess(args.dirs, args.out, args.sigma, args.prominence,
+                        args.workers)
+    t2 = time.perf_counter()
+    print(f"{summary['sources']} sources: {summary['processed']} processed, "
+          f"{summary['skipped']} already done, {summary['failed']} failed "
+          f'in {t2 - t1:.2f} s')
+    return summary
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import time
+import numpy as np
+
+
+class ResonanceTracker:
+    """Closed-loop following of the sensor phase dips.
+
+    After a full scan has located the dips, every iteration measures a few
+    probe frequencies across each dip, fits a parabola to their phase and
+    moves the dip estimate to its vertex; the probes (and with them the
+    DAC codes) are re-centered on the new estimate for the next iteration.
+    When a dip is no longer a clear minimum within the probes the lock is
+    lost and the full scan is repeated.
+
+    Parameters
+    ----------
+    measure : callable
+        ``measure(freqs)`` returns the ``F2I`` rows of these frequencies.
+    scan : callable
+        ``scan()`` runs a full scan and returns ``(F2I_np, kk)``.
+    span : float
+        Half-width of the probe set around a dip, in Hz.
+    probes : int
+        Number of probe frequencies per dip, at least 3.
+    f_min, f_max : float, optional
+        Frequency range the probes must stay in.
+    min_curvature : float
+        Minimum phase rise from the vertex to the probe edges, in degree,
+        for a dip to stay locked.
+    """
+
+    def __init__(self,
+                 measure,
+                 scan,
+                 span,
+                 probes=5,
+                 f_min=None,
+                 f_max=None,
+                 min_curvature=0.02):
+        if probes < 3:
+            raise ValueError('at least 3 probes are needed per dip')
+        self.measure = measure
+        self.scan = scan
+        self.span = span
+        self.offsets = np.linspace(-1, 1, probes)
+        self.f_min = -np.inf if f_min is None else f_min
+        self.f_max = np.inf if f_max is None else f_max
+        self.min_curvature = min_curvature
+        self.dips = np.zeros(0)
+        self.scans = 0
+
+    def acquire(self):
+        '''full scan, (re)initializes the dip estimates'''
+        F2I_np, kk = self.scan()
+        self.scans += 1
+        self.dips = np.atleast_1d(F2I_np[kk, 0]).astype(float)
+        return self.dips
+
+    def step(self):
+        """Runs one tracking iteration.
+
+        Returns
+        -------
+        numpy.ndarray
+            Rows ``[time, dip index, frequency, phase, locked]`` of every
+            dip; ``locked`` is 0 when the estimate comes from a new scan.
+        """
+        if len(self.dips) == 0:
+            self.acquire()
+            return self._rows(np.full(len(self.dips), np.nan), 0)
+        centers = np.clip(self.dips, self.f_min + self.span,
+                          self.f_max - self.span)
+        freqs = (centers[:, None] + self.span * self.offsets).ravel()
+        phase = self.measure(freqs)[:, 1].reshape(len(centers), -1)
+        # Parabola phase = a x^2 + b x + c over the normalized offsets
+        a, b, c = np.polyfit(self.offsets, phase.T, 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vertex = -b / (2 * a)
+        depth = a * (1 - np.abs(vertex))**2
+        locked = ((a > 0) & (np.abs(vertex) <= 1) &
+                  (depth >= self.min_curvature))
+        if not locked.all():
+            self.acquire()
+            return self._rows(np.full(len(self.dips), np.nan), 0)
+        self.dips = np.clip(centers + vertex * self.span, self.f_min,
+                            self.f_max)
+        return self._rows(c - b**2 / (4 * a), 1)
+
+    def track(self, iterations=None):
+        """Yields the rows of ``step`` for every iteration.
+
+        Parameters
+        ----------
+        iterations : int, optional
+            Number of iterations, endless if omitted.
+        """
+        count = 0
+        while iterations is None or count < iterations:
+            yield self.step()
+            count += 1
+
+    def _rows(self, phase, locked):
+        n = len(self.dips)
+        return np.column_stack([
+            np.full(n, time.time()),
+            np.arange(n), self.dips, phase,
+            np.full(n, locked)
+        ])
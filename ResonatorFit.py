@@ -0,0 +1,505 @@
+import numpy as np
+from ModelFunctions import F2Z_func, F2T_func
+
+
+def jacobian_F2Z(p, freq):
+    """Analytic Jacobian of ``F2Z_func`` with respect to ``[L, C, R]``.
+
+    Parameters
+    ----------
+    p : array_like
+        ``[L, C, R]``, shape ``(3,)`` or ``(m, 3)`` for stacked sweeps.
+    freq : array_like
+        Frequencies, shape ``(n,)`` or ``(m, n)``.
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape ``(..., n, 3)``.
+    """
+    L, C, R = _split(p)
+    w = 2 * np.pi * np.asarray(freq, dtype=float)
+    G = 1 / R
+    B = w * C - 1 / (w * L)
+    Z3 = (G**2 + B**2)**-1.5
+    # |Z| = (G^2 + B^2)^-1/2, d|Z| = -|Z|^3 (G dG + B dB)
+    return np.stack([-Z3 * B / (w * L**2), -Z3 * B * w, Z3 * G / R**2],
+                    axis=-1)
+
+
+def jacobian_F2T(p, freq):
+    """Analytic Jacobian of ``F2T_func`` with respect to ``[L, C, R]``.
+
+    Parameters
+    ----------
+    p : array_like
+        ``[L, C, R]``, shape ``(3,)`` or ``(m, 3)`` for stacked sweeps.
+    freq : array_like
+        Frequencies, shape ``(n,)`` or ``(m, n)``.
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape ``(..., n, 3)``.
+    """
+    L, C, R = _split(p)
+    w = 2 * np.pi * np.asarray(freq, dtype=float)
+    X = w * L - 1 / (w * C)
+    # theta = arctan(X / R)
+    D = 1 / (1 + (X / R)**2)
+    return np.stack([D * w / R, D / (w * C**2 * R), -D * X / R**2], axis=-1)
+
+
+def initial_guess_F2Z(freq, imp):
+    """Closed-form ``[L, C, R]`` estimate of an impedance sweep.
+
+    The peak gives the resonance and R, the half-power width gives Q,
+    and C = Q / (2 pi f0 R), L = 1 / ((2 pi f0)^2 C) for a parallel RLC.
+
+    Parameters
+    ----------
+    freq : array_like
+        Ascending frequencies, shape ``(n,)`` or ``(m, n)``.
+    imp : array_like
+        Impedance magnitude, same shape as ``freq``.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``[L, C, R]``, shape ``(3,)`` or ``(m, 3)``.
+    """
+    freq, imp, single = _stack(freq, imp)
+    m, n = imp.shape
+    rows = np.arange(m)
+    idx = np.arange(n)
+    peak = np.argmax(imp, axis=1)
+    R = imp[rows, peak]
+    # Parabolic interpolation of the peak on its neighbours
+    k = np.clip(peak, 1, n - 2)
+    y0, y1, y2 = imp[rows, k - 1], imp[rows, k], imp[rows, k + 1]
+    den = y0 - 2 * y1 + y2
+    shift = np.where(den < 0, 0.5 * (y0 - y2) / np.where(den < 0, den, -1),
+                     0.0)
+    shift = np.clip(shift, -1, 1)
+    f0 = freq[rows, k] + shift * np.where(
+        shift > 0, freq[rows, k + 1] - freq[rows, k],
+        freq[rows, k] - freq[rows, k - 1])
+    # Half-power (-3 dB) crossings on both sides of the peak
+    below = imp < R[:, None] / np.sqrt(2)
+    left = np.where(below & (idx < peak[:, None]), idx, -1).max(axis=1)
+    right = np.where(below & (idx > peak[:, None]), idx, n).min(axis=1)
+    f_left = _crossing(freq, imp, R / np.sqrt(2), left, left + 1)
+    f_right = _crossing(freq, imp, R / np.sqrt(2), right - 1, right)
+    # Without a crossing the sweep edge is used and Q is overestimated
+    Q = f0 / np.maximum(f_right - f_left, 1e-12 * f0)
+    C = Q / (2 * np.pi * f0 * R)
+    L = 1 / ((2 * np.pi * f0)**2 * C)
+    p = np.stack([L, C, R], axis=-1)
+    return p[0] if single else p
+
+
+def fit_F2Z(freq, imp, p0=None, max_iter=100, tol=1e-10):
+    """Least-squares fit of ``F2Z_func`` to one or many impedance sweeps.
+
+    Parameters
+    ----------
+    freq : array_like
+        Frequencies, shape ``(n,)`` or ``(m, n)`` for stacked sweeps.
+    imp : array_like
+        Impedance magnitude, same shape as ``freq``.
+    p0 : array_like, optional
+        Initial ``[L, C, R]``; the closed-form guess is used if omitted.
+    max_iter : int
+        Maximum number of Levenberg-Marquardt iterations.
+    tol : float
+        Relative parameter step at which a sweep is converged.
+
+    Returns
+    -------
+    numpy.ndarray
+        Fitted ``[L, C, R]``, shape ``(3,)`` or ``(m, 3)``.
+    """
+    freq, imp, single = _stack(freq, imp)
+    if p0 is None:
+        p0 = initial_guess_F2Z(freq, imp)
+    p = _levenberg_marquardt(F2Z_func, jacobian_F2Z, freq, imp, p0,
+                             [True, True, True], max_iter, tol)
+    return p[0] if single else p
+
+
+def fit_F2T(freq, phase, p0, max_iter=100, tol=1e-10):
+    """Least-squares fit of ``F2T_func`` to one or many phase sweeps.
+
+    The phase only depends on ``(w L - 1 / (w C)) / R``, so scaling L, 1/C
+    and R together leaves it unchanged; L is held at its initial value and
+    C and R are fitted.
+
+    Parameters
+    ----------
+    freq : array_like
+        Frequencies, shape ``(n,)`` or ``(m, n)`` for stacked sweeps.
+    phase : array_like
+        Phase in rad, same shape as ``freq``.
+    p0 : array_like
+        Initial ``[L, C, R]``.
+    max_iter : int
+        Maximum number of Levenberg-Marquardt iterations.
+    tol : float
+        Relative parameter step at which a sweep is converged.
+
+    Returns
+    -------
+    numpy.ndarray
+        Fitted ``[L, C, R]``, shape ``(3,)`` or ``(m, 3)``.
+    """
+    freq, phase, single = _stack(freq, phase)
+    p = _levenberg_marquardt(F2T_func, jacobian_F2T, freq, phase, p0,
+                             [False, True, True], max_iter, tol)
+    return p[0] if single else p
+
+
+def resonance(p):
+    """Resonant frequency 1 / (2 pi sqrt(L C)) of fitted parameters.
+
+    Parameters
+    ----------
+    p : array_like
+        ``[L, C, R]``, shape ``(3,)`` or ``(m, 3)``.
+
+    Returns
+    -------
+    float or numpy.ndarray
+    """
+    p = np.asarray(p, dtype=float)
+    return 1 / (2 * np.pi * np.sqrt(p[..., 0] * p[..., 1]))
+
+
+def fit_C2F(code, freq, degree=5):
+    """Linear least-squares fit of the ``C2F_func`` polynomial.
+
+    The columns are normalized before solving, which keeps the system well
+    conditioned with codes around 1e6 raised to the 5th power.
+
+    Parameters
+    ----------
+    code : array_like
+        Applied DAC codes.
+    freq : array_like
+        Resonant frequency of each code.
+    degree : int
+        Degree of the polynomial, 5 for ``C2F_func``.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``degree + 1`` coefficients, lowest order first.
+    """
+    code = np.asarray(code, dtype=float)
+    A = np.vander(code, degree + 1, increasing=True)
+    scale = np.linalg.norm(A, axis=0)
+    coef = np.linalg.lstsq(A / scale, np.asarray(freq, dtype=float),
+                           rcond=None)[0]
+    return coef / scale
+
+
+def refine_dips(freq,
+                phase,
+                dips,
+                span=0.03,
+                degree=(0, 2),
+                starts=4,
+                max_iter=100,
+                tol=1e-10):
+    """Sub-step frequencies of the dips of a pass from a local model fit.
+
+    Around a dip the reader admittance is the parallel RLC of ``F2Z_func``
+    plus the sensor reflected through the coupling. Divided by the scale
+    of the sensor term it reads::
+
+        Y = G(x) + j B(x) + cos(theta) exp(-j theta)
+
+    where ``theta`` is ``F2T_func`` of the loaded sensor, resonant at
+    ``f0`` with quality factor ``Q``, and ``G``, ``B`` are polynomials of
+    ``x = (f - f_grid) / (span f_grid)`` around the dip found on the grid,
+    taking up the reader and the tails of the other sensors. The phase is
+    ``-angle(Y)``; ``f0`` is the sensor resonance pulled by the coupling,
+    ``f_s / sqrt(1 - k^2)``, the dip is the minimum of the fitted phase.
+    All dips are fitted together, from the best ``starts`` points of a
+    grid over ``f0`` and ``Q``.
+
+    Parameters
+    ----------
+    freq : array_like
+        Frequencies of the pass, ascending.
+    phase : array_like
+        Phase in degree, not smoothed.
+    dips : array_like
+        Indices of the dips found on the grid, e.g. by ``DipDetector``.
+    span : float
+        Half-width of the points fitted around a dip, relative to its
+        frequency; a few sensor bandwidths. Widened where it holds too few
+        points of the pass.
+    degree : tuple of int
+        Degrees of ``G`` and ``B``.
+    starts : int
+        Grid points a fit is started from, the best fit is kept.
+    max_iter : int
+        Maximum number of Levenberg-Marquardt iterations.
+    tol : float
+        Parameter step at which a dip is converged.
+
+    Returns
+    -------
+    numpy.ndarray
+        Rows ``[f_dip, std of f_dip, f0, std of f0, Q, rms]`` of the dips,
+        frequencies in Hz and the rms residual in degree. The standard
+        deviations follow from the residual of the fit; the error of the
+        model itself, a few hundred Hz on the simulator, is not included.
+        A dip whose fit left its window keeps its grid frequency with NaN
+        for the rest.
+    """
+    freq = np.asarray(freq, dtype=float)
+    phase = np.asarray(phase, dtype=float)
+    dips = np.asarray(dips, dtype=int).reshape(-1)
+    rows = np.full((len(dips), 6), np.nan)
+    rows[:, 0] = freq[dips]
+    npar = degree[0] + degree[1] + 4
+    if len(dips) == 0 or len(freq) < npar + 2:
+        return rows
+    # Every dip sees the whole pass, weighted 0 outside its window. The
+    # window of a coarse pass is widened to hold enough points.
+    m = len(dips)
+    fc = freq[dips]
+    F = np.broadcast_to(freq, (m, len(freq)))
+    Y = np.broadcast_to(phase, F.shape)
+    distance = np.abs(F - fc[:, None])
+    scale = np.maximum(span * fc, np.sort(distance, axis=1)[:, npar + 1])
+    W = (distance <= scale[:, None]).astype(float)
+
+    # Linear part solved on a grid of the sensor, the best ones fitted
+    candidates = []
+    costs = []
+    for Q in (10, 20, 40, 80, 160, 320):
+        for x0 in np.linspace(-0.5, 1, 16):
+            nl = np.tile([x0, np.log(Q)], (m, 1))
+            p = np.column_stack(
+                [_dip_linear(F, Y, W, fc, scale, nl, degree), nl])
+            r = (_dip_phase(p, F, fc, scale, degree) - Y) * W
+            candidates.append(p)
+            costs.append(np.sum(r**2, axis=1))
+    best = np.argsort(np.stack(costs, axis=1), axis=1)[:, :starts]
+    k = best.shape[1]
+    p = np.take_along_axis(np.stack(candidates, axis=1), best[..., None],
+                           axis=1).reshape(m * k, npar)
+    p, cost, A = _fit_dips(p, np.repeat(F, k, axis=0),
+                           np.repeat(Y, k, axis=0), np.repeat(W, k, axis=0),
+                           np.repeat(fc, k), np.repeat(scale, k), degree,
+                           max_iter, tol)
+    pick = np.arange(m) * k + np.argmin(cost.reshape(m, k), axis=1)
+    p, cost, A = p[pick], cost[pick], A[pick]
+    dof = np.maximum(W.sum(axis=1) - npar, 1)
+    cov = np.linalg.pinv(A) * (cost / dof)[:, None, None]
+    f0 = fc + p[:, -2] * scale
+    f0_std = np.sqrt(cov[:, -2, -2]) * scale
+
+    # Minimum of the fitted phase, on a fine grid and then by Newton steps
+    fine = fc[:, None] + scale[:, None] * np.linspace(-1, 1, 401)
+    f_dip = fine[np.arange(m),
+                 np.argmin(_dip_phase(p, fine, fc, scale, degree), axis=1)]
+    delta = 1e-4 * scale
+    for _ in range(3):
+        d1, d2, _ = _dip_slope(p, f_dip, delta, fc, scale, degree)
+        f_dip = f_dip - np.where(d2 > 0, d1 / np.where(d2 > 0, d2, 1), 0)
+    # The slope stays 0 at the minimum as the parameters move
+    _, d2, dd1 = _dip_slope(p, f_dip, delta, fc, scale, degree)
+    grad = dd1 / np.where(d2 > 0, d2, np.nan)[:, None]
+    f_dip_std = np.sqrt(np.einsum('mi,mij,mj->m', grad, cov, grad))
+
+    inside = (np.abs(f_dip - fc) < scale) & (np.abs(f0 - fc) < scale)
+    rows[inside] = np.column_stack([
+        f_dip, f_dip_std, f0, f0_std,
+        np.exp(p[:, -1]),
+        np.sqrt(cost / dof)
+    ])[inside]
+    return rows
+
+
+def _levenberg_marquardt(func, jac, freq, y, p0, free, max_iter, tol):
+    '''vectorized LM over stacked sweeps, in log-parameters to keep p > 0'''
+    m = y.shape[0]
+    p = np.array(np.broadcast_to(np.asarray(p0, dtype=float), (m, 3)))
+    free = np.asarray(free)
+    lam = np.full(m, 1e-3)
+    active = np.ones(m, dtype=bool)
+    r = _residual(func, p, freq, y)
+    cost = np.sum(r**2, axis=1)
+    eye = np.eye(3)[free][:, free]
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        a = np.flatnonzero(active)
+        J = jac(p[a], freq[a])[..., free] * p[a][:, None, free]
+        A = np.einsum('mni,mnj->mij', J, J)
+        g = np.einsum('mni,mn->mi', J, r[a])
+        diag = np.einsum('mii->mi', A)[:, :, None] * eye
+        try:
+            step = -np.linalg.solve(A + lam[a, None, None] * diag,
+                                    g[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            break
+        trial = p[a].copy()
+        trial[:, free] *= np.exp(np.clip(step, -5, 5))
+        r_trial = _residual(func, trial, freq[a], y[a])
+        cost_trial = np.sum(r_trial**2, axis=1)
+        better = cost_trial < cost[a]
+        ok = a[better]
+        p[ok] = trial[better]
+        r[ok] = r_trial[better]
+        cost[ok] = cost_trial[better]
+        lam[ok] = np.maximum(lam[ok] / 3, 1e-12)
+        lam[a[~better]] *= 4
+        small = np.max(np.abs(step), axis=1) < tol
+        active[a[(better & small) | (lam[a] > 1e12)]] = False
+    return p
+
+
+def _residual(func, p, freq, y):
+    L, C, R = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    return func((L, C, R), freq) - y
+
+
+def _crossing(freq, y, level, lo, hi):
+    '''interpolated frequency where y crosses level between lo and hi'''
+    m, n = y.shape
+    rows = np.arange(m)
+    lo = np.clip(lo, 0, n - 1)
+    hi = np.clip(hi, 0, n - 1)
+    y_lo, y_hi = y[rows, lo], y[rows, hi]
+    den = np.where(y_hi != y_lo, y_hi - y_lo, 1.0)
+    frac = np.clip((level - y_lo) / den, 0, 1)
+    return freq[rows, lo] + frac * (freq[rows, hi] - freq[rows, lo])
+
+
+def _dip_basis(x, degree):
+    '''columns of G and B, powers of x'''
+    return (np.stack([x**k for k in range(degree[0] + 1)], axis=-1),
+            np.stack([x**k for k in range(degree[1] + 1)], axis=-1))
+
+
+def _dip_sensor(p, F, fc, scale):
+    '''theta of the loaded sensor and its Jacobian to [x0, ln Q]'''
+    f0 = (fc + p[:, -2] * scale)[:, None]
+    Q = np.exp(p[:, -1])[:, None]
+    # Unit inductance, the phase only depends on f0 and Q
+    C = 1 / (2 * np.pi * f0)**2
+    R = 2 * np.pi * f0 / Q
+    theta = F2T_func((1.0, C, R), F)
+    J = jacobian_F2T(np.column_stack([np.ones(len(p)), C[:, 0], R[:, 0]]),
+                     F)
+    # dC / df0 = -2 C / f0, dR / df0 = R / f0, dR / dln Q = -R
+    d_f0 = -2 * C / f0 * J[..., 1] + R / f0 * J[..., 2]
+    return theta, np.stack([d_f0 * scale[:, None], -R * J[..., 2]],
+                           axis=-1)
+
+
+def _dip_phase(p, F, fc, scale, degree, jac=False):
+    '''phase of the dip model in degree, with its Jacobian if jac'''
+    x = (F - fc[:, None]) / scale[:, None]
+    G, B = _dip_basis(x, degree)
+    n = G.shape[-1]
+    theta, J_theta = _dip_sensor(p, F, fc, scale)
+    Y = (np.einsum('mnk,mk->mn', G, p[:, :n]) +
+         1j * np.einsum('mnk,mk->mn', B, p[:, n:-2]) +
+         np.cos(theta) * np.exp(-1j * theta))
+    phase = -np.degrees(np.angle(Y))
+    if not jac:
+        return phase
+    # d(cos(theta) exp(-j theta)) / dtheta = -j exp(-2j theta)
+    dY = np.concatenate(
+        [G, 1j * B, -1j * np.exp(-2j * theta)[..., None] * J_theta],
+        axis=-1)
+    return phase, -np.degrees(np.imag(dY / Y[..., None]))
+
+
+def _dip_linear(F, Y, W, fc, scale, nl, degree):
+    '''G and B for given [x0, ln Q], least squares on Im(Y exp(j phase))
+    = 0 which is linear in them'''
+    x = (F - fc[:, None]) / scale[:, None]
+    G, B = _dip_basis(x, degree)
+    p = np.column_stack(
+        [np.zeros((len(nl), G.shape[-1] + B.shape[-1])), nl])
+    theta, _ = _dip_sensor(p, F, fc, scale)
+    rot = np.exp(1j * np.radians(Y))
+    M = np.concatenate(
+        [np.imag(rot)[..., None] * G,
+         np.real(rot)[..., None] * B], axis=-1) * W[..., None]
+    t = -np.imag(np.cos(theta) * np.exp(-1j * theta) * rot) * W
+    A = np.einsum('mni,mnj->mij', M, M)
+    A += 1e-12 * np.einsum('mii->m', A)[:, None, None] * np.eye(A.shape[-1])
+    return np.linalg.solve(A,
+                           np.einsum('mni,mn->mi', M, t)[..., None])[..., 0]
+
+
+def _fit_dips(p, F, Y, W, fc, scale, degree, max_iter, tol):
+    '''vectorized LM over stacked windows, returns p, cost and J^T J'''
+    m, npar = p.shape
+    lam = np.full(m, 1e-3)
+    active = np.ones(m, dtype=bool)
+    r = (_dip_phase(p, F, fc, scale, degree) - Y) * W
+    cost = np.sum(r**2, axis=1)
+    eye = np.eye(npar)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        a = np.flatnonzero(active)
+        J = _dip_phase(p[a], F[a], fc[a], scale[a], degree,
+                       jac=True)[1] * W[a][..., None]
+        A = np.einsum('mni,mnj->mij', J, J)
+        g = np.einsum('mni,mn->mi', J, r[a])
+        diag = np.einsum('mii->mi', A)[:, :, None] * eye
+        try:
+            step = -np.linalg.solve(A + lam[a, None, None] * diag,
+                                    g[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            break
+        trial = p[a] + np.clip(step, -5, 5)
+        r_trial = (_dip_phase(trial, F[a], fc[a], scale[a], degree) -
+                   Y[a]) * W[a]
+        cost_trial = np.sum(r_trial**2, axis=1)
+        better = cost_trial < cost[a]
+        ok = a[better]
+        p[ok] = trial[better]
+        r[ok] = r_trial[better]
+        cost[ok] = cost_trial[better]
+        lam[ok] = np.maximum(lam[ok] / 3, 1e-12)
+        lam[a[~better]] *= 4
+        small = np.max(np.abs(step), axis=1) < tol
+        active[a[(better & small) | (lam[a] > 1e12)]] = False
+    J = _dip_phase(p, F, fc, scale, degree, jac=True)[1] * W[..., None]
+    return p, cost, np.einsum('mni,mnj->mij', J, J)
+
+
+def _dip_slope(p, f, delta, fc, scale, degree):
+    '''slope and curvature of the fitted phase at f, and the derivative of
+    the slope with respect to the parameters'''
+    F = f[:, None] + delta[:, None] * np.array([-1.0, 0.0, 1.0])
+    phase, J = _dip_phase(p, F, fc, scale, degree, jac=True)
+    d1 = (phase[:, 2] - phase[:, 0]) / (2 * delta)
+    d2 = (phase[:, 2] - 2 * phase[:, 1] + phase[:, 0]) / delta**2
+    dd1 = (J[:, 2] - J[:, 0]) / (2 * delta[:, None])
+    return d1, d2, dd1
+
+
+def _split(p):
+    p = np.asarray(p, dtype=float)
+    if p.ndim == 2:
+        return p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    return p[0], p[1], p[2]
+
+
+def _stack(freq, y):
+    y = np.asarray(y, dtype=float)
+    single = y.ndim == 1
+    y = np.atleast_2d(y)
+    freq = np.broadcast_to(np.asarray(freq, dtype=float), y.shape)
+    return freq, y, single
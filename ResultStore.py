@@ -0,0 +1,317 @@
+import bisect
+import glob
+import json
+import os
+import re
+import time
+from datetime import datetime
+import numpy as np
+from Calibration import read_C2F
+
+CHUNK_ROWS = 4096  # rows preallocated at a time
+
+
+class ResultStore:
+    """Append-only binary store of fixed-width result rows.
+
+    A store is a directory holding ``records.f8``, the rows of all passes
+    as little-endian float64 records preallocated in chunks, and
+    ``passes.jsonl``, one line of metadata per pass (row offset and count,
+    timestamp, remark, ``para_C2F``, ...). A pass is committed by its
+    metadata line, written after its rows, so an interrupted append leaves
+    the store consistent. Readers get memory-mapped NumPy views.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store, created if missing.
+    width : int, optional
+        Values per row; required to create a store. An existing store
+        takes rows up to its own width, shorter rows are padded with NaN;
+        see ``open_store`` for rows wider than the store.
+    """
+
+    def __init__(self, path, width=None):
+        self.path = path
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if width is not None and width > meta['width']:
+                raise ValueError(f'{path} holds rows of width '
+                                 f'{meta["width"]}, not {width}')
+            width = meta['width']
+        elif width is None:
+            raise ValueError(f'{path} is not a result store')
+        else:
+            os.makedirs(path, exist_ok=True)
+            with open(meta_path, 'w') as f:
+                json.dump({'width': int(width), 'dtype': '<f8'}, f)
+        self.width = int(width)
+        self.data_path = os.path.join(path, 'records.f8')
+        self.index_path = os.path.join(path, 'passes.jsonl')
+        self.index = []
+        self._times = []
+        self._remarks = {}
+        self._map = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        self._add(json.loads(line))
+        self.rows_used = (self.index[-1]['offset'] +
+                          self.index[-1]['rows']) if self.index else 0
+
+    def append(self,
+               rows,
+               remark='',
+               t1=None,
+               t2=None,
+               para_C2F=None,
+               timestamp=None,
+               **extra):
+        """Appends the rows of one pass.
+
+        Parameters
+        ----------
+        rows : array_like
+            Rows of the pass, at most ``width`` values each.
+        remark : str
+            Remark of the pass, as in the file names.
+        t1, t2 : float, optional
+            Start and stop ``perf_counter`` of the pass.
+        para_C2F : array_like, optional
+            Calibration used for the pass.
+        timestamp : float, optional
+            Epoch time of the pass, now if omitted.
+        **extra
+            Further JSON-serializable metadata.
+
+        Returns
+        -------
+        int
+            Id of the pass.
+        """
+        rows = np.atleast_2d(np.asarray(rows, dtype='<f8'))
+        if rows.shape[1] > self.width:
+            raise ValueError(f'rows of width {rows.shape[1]} do not fit '
+                             f'the store width {self.width}')
+        if rows.shape[1] < self.width:
+            pad = np.full((len(rows), self.width - rows.shape[1]), np.nan)
+            rows = np.hstack([rows, pad])
+        offset = self.rows_used
+        self._reserve(offset + len(rows))
+        with open(self.data_path, 'r+b') as f:
+            f.seek(offset * self.width * 8)
+            f.write(np.ascontiguousarray(rows, dtype='<f8').tobytes())
+        entry = {
+            'pass': len(self.index),
+            'offset': offset,
+            'rows': len(rows),
+            'timestamp': time.time() if timestamp is None else timestamp,
+            'remark': remark,
+            't1': t1,
+            't2': t2,
+            'para_C2F': None if para_C2F is None else
+            [float(v) for v in para_C2F]
+        }
+        entry.update(extra)
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self._add(entry)
+        self.rows_used = offset + len(rows)
+        return entry['pass']
+
+    def view(self, pass_id):
+        '''read-only memory-mapped rows of one pass'''
+        entry = self.index[pass_id]
+        return self.rows()[entry['offset']:entry['offset'] + entry['rows']]
+
+    def rows(self):
+        '''read-only memory-mapped rows of all passes'''
+        if self.rows_used == 0:
+            return np.zeros((0, self.width))
+        if self._map is None or len(self._map) < self.rows_used:
+            self._map = np.memmap(self.data_path,
+                                  dtype='<f8',
+                                  mode='r',
+                                  shape=(self.rows_used, self.width))
+        return self._map[:self.rows_used]
+
+    def passes(self, remark=None, since=None, until=None):
+        """Metadata of the passes matching a remark and a time range.
+
+        Parameters
+        ----------
+        remark : str, optional
+            Exact remark of the passes.
+        since, until : float or datetime, optional
+            Time range of the passes, inclusive.
+
+        Returns
+        -------
+        list of dict
+        """
+        lo = 0 if since is None else bisect.bisect_left(
+            self._times, _epoch(since))
+        hi = len(self.index) if until is None else bisect.bisect_right(
+            self._times, _epoch(until))
+        if remark is None:
+            return self.index[lo:hi]
+        ids = self._remarks.get(remark, [])
+        return [
+            self.index[k]
+            for k in ids[bisect.bisect_left(ids, lo):bisect.bisect_left(
+                ids, hi)]
+        ]
+
+    def _add(self, entry):
+        # Passes are appended in time order; a clock step back only makes
+        # the time lookup approximate around it
+        self.index.append(entry)
+        self._times.append(max(entry['timestamp'], self._times[-1])
+                           if self._times else entry['timestamp'])
+        self._remarks.setdefault(entry['remark'], []).append(entry['pass'])
+        return
+
+    def _reserve(self, rows):
+        size = os.path.getsize(self.data_path) if os.path.exists(
+            self.data_path) else 0
+        needed = rows * self.width * 8
+        if size < needed:
+            chunk = CHUNK_ROWS * self.width * 8
+            with open(self.data_path, 'ab') as f:
+                f.truncate(-(-needed // chunk) * chunk)
+        return
+
+
+def _epoch(t):
+    return t.timestamp() if isinstance(t, datetime) else float(t)
+
+
+# <C2F|F2I>_<mm-dd_HH[-MM-SS.ffffff]>[_remark].txt, see saveFileStr
+_NAME = re.compile(r'(C2F|F2I)_(\d\d-\d\d_\d\d(?:-\d\d-\d\d\.\d+)?)'
+                   r'(?:_(.*))?\.txt$')
+
+
+def open_store(path, width):
+    """Opens the store of a setting for rows of up to ``width`` values.
+
+    A narrower existing store is kept for its passes and the rows go to
+    the width-suffixed store ``<path>_w<width>`` next to it.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store, e.g. ``RESULT_STORE``.
+    width : int
+        Values per row.
+
+    Returns
+    -------
+    ResultStore
+    """
+    path = os.path.normpath(path)
+    meta_path = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            stored = json.load(f)['width']
+        if stored < width:
+            print(f'Warning: {path} holds rows of width {stored}, the rows '
+                  f'of width {width} go to {path}_w{width}!')
+            path = f'{path}_w{width}'
+    return ResultStore(path, width)
+
+
+def parse_result_name(path):
+    """Kind, remark and time of a text result from its file name.
+
+    The year is not in the name, it is taken from the file modification
+    time.
+
+    Returns
+    -------
+    tuple or None
+        ``(kind, remark, timestamp)`` with kind ``'C2F'`` or ``'F2I'``,
+        None for other files.
+    """
+    match = _NAME.search(os.path.basename(path))
+    if match is None:
+        return None
+    kind, stamp, remark = match.groups()
+    year = datetime.fromtimestamp(os.path.getmtime(path)).year
+    fmt = '%Y-%m-%d_%H-%M-%S.%f' if '.' in stamp else '%Y-%m-%d_%H'
+    timestamp = datetime.strptime(f'{year}-{stamp}', fmt).timestamp()
+    return kind, remark or '', timestamp
+
+
+def convert_text_results(res_dir, store_dir, width=None):
+    """Imports the ``C2F_*.txt`` and ``F2I_*.txt`` files of a result folder.
+
+    F2I passes go to the ``F2I`` store and calibrations to the ``C2F`` store
+    under ``store_dir``, with the remark and time of their file name (see
+    ``parse_result_name``). Files already imported are skipped.
+
+    Parameters
+    ----------
+    res_dir : str
+        Folder with the text results, e.g. ``./res/``.
+    store_dir : str
+        Folder of the stores.
+    width : int, optional
+        Width of a new F2I store, the widest file if omitted.
+
+    Returns
+    -------
+    int
+        Number of imported files.
+    """
+    files = sorted(glob.glob(os.path.join(res_dir, '*.txt')))
+    parsed = []
+    for path in files:
+        name = parse_result_name(path)
+        if name is None:
+            continue
+        kind, remark, timestamp = name
+        times = (None, None)
+        if kind == 'C2F':
+            para_C2F, rows = read_C2F(path)
+        else:
+            para_C2F, rows = None, np.atleast_2d(np.loadtxt(path))
+            with open(path, 'r') as f:
+                header = f.readline().lstrip('#').split(',')
+            if len(header) == 3 and header[0].strip() == 'time':
+                times = (float(header[1]), float(header[2]))
+        parsed.append((kind, path, remark, timestamp, para_C2F, rows, times))
+    if width is None:
+        width = max([r[5].shape[1] for r in parsed if r[0] == 'F2I'] or [1])
+    stores = {}
+    count = 0
+    for kind, path, remark, timestamp, para_C2F, rows, times in sorted(
+            parsed, key=lambda r: r[3]):
+        if kind not in stores:
+            store_path = os.path.join(store_dir, kind)
+            if os.path.exists(os.path.join(store_path, 'meta.json')):
+                store = ResultStore(store_path)
+            else:
+                store = ResultStore(store_path, 2 if kind == 'C2F' else width)
+            stores[kind] = (store, {p.get('source') for p in store.index})
+        store, imported = stores[kind]
+        source = os.path.basename(path)
+        if source in imported:
+            continue
+        if rows.shape[1] > store.width:
+            print(f'Skip {path}: {rows.shape[1]} columns do not fit the '
+                  f'store width {store.width}')
+            continue
+        store.append(rows,
+                     remark,
+                     t1=times[0],
+                     t2=times[1],
+                     para_C2F=para_C2F,
+                     timestamp=timestamp,
+                     source=source)
+        imported.add(source)
+        count += 1
+    return count
+
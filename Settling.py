@@ -0,0 +1,250 @@
+import json
+import os
+import time
+import numpy as np
+import DACFunctions as dacfunc
+from E4990AFunctions import session, startBasicSweep, fetchBasicSweep
+
+ORDERS = ('ascending', 'serpentine', 'interleaved')
+
+
+class SettlingModel:
+    """Wait needed after a DAC step before the reader has settled.
+
+    The varactor bias follows a step of the DAC exponentially, so the
+    residual of a step of ``|step|`` codes falls below ``tolerance`` codes
+    after::
+
+        wait = dead + tau * ln(|step| / tolerance)
+
+    A step within the tolerance only waits ``dead``, an unchanged code does
+    not wait at all. The constants belong to one board, see
+    ``measure_settling``; ``SettlingModel(dead=0.005)`` is the fixed wait
+    used so far.
+
+    Parameters
+    ----------
+    tau : float
+        Time constant of the bias, in s.
+    tolerance : float
+        Residual of the step tolerated, in LSB.
+    dead : float
+        Wait added to every step, in s.
+    max_wait : float
+        Upper bound of the wait, also used when the code before is unknown.
+    """
+
+    def __init__(self, tau=0.0, tolerance=16.0, dead=0.0, max_wait=0.05):
+        self.tau = float(tau)
+        self.tolerance = float(tolerance)
+        self.dead = float(dead)
+        self.max_wait = float(max_wait)
+
+    def wait(self, step):
+        """Wait after a step, in s.
+
+        Parameters
+        ----------
+        step : int or array_like or None
+            Code difference of the step; ``None`` if the code before is
+            unknown.
+        """
+        if step is None:
+            return max(self.max_wait, self.dead)
+        step = np.abs(np.asarray(step, dtype=float))
+        excess = np.log(np.maximum(step, self.tolerance) / self.tolerance)
+        wait = np.where(
+            step > 0,
+            np.minimum(self.dead + self.tau * excess,
+                       max(self.max_wait, self.dead)), 0.0)
+        return float(wait) if wait.ndim == 0 else wait
+
+    def waits(self, codes, previous=None):
+        '''wait before every code of a sequence, starting from previous'''
+        codes = np.asarray(codes, dtype=float)
+        if len(codes) == 0:
+            return np.zeros(0)
+        first = self.wait(None if previous is None else codes[0] - previous)
+        return np.concatenate([[first], self.wait(np.diff(codes))])
+
+    def to_dict(self):
+        return {
+            'tau': self.tau,
+            'tolerance': self.tolerance,
+            'dead': self.dead,
+            'max_wait': self.max_wait
+        }
+
+    def __repr__(self):
+        return (f'SettlingModel(tau={self.tau:.3g}, '
+                f'tolerance={self.tolerance:.3g}, dead={self.dead:.3g}, '
+                f'max_wait={self.max_wait:.3g})')
+
+
+def as_model(settle):
+    '''a SettlingModel, a fixed wait in s is turned into one'''
+    if isinstance(settle, SettlingModel):
+        return settle
+    return SettlingModel(dead=settle or 0.0, max_wait=settle or 0.0)
+
+
+def sweep_order(n, order='ascending', pass_index=0):
+    """Order in which the points of a pass are measured.
+
+    Parameters
+    ----------
+    n : int
+        Points of the pass, in ascending code order.
+    order : str
+        ``'ascending'`` jumps back to the first code after every pass,
+        ``'serpentine'`` reverses the direction every other pass and
+        ``'interleaved'`` goes up over the even points and down over the
+        odd ones, so every step spans two points and the pass ends next to
+        where it started.
+    pass_index : int
+        Index of the pass, for ``'serpentine'``.
+
+    Returns
+    -------
+    numpy.ndarray
+        Indices of the points in order of measurement.
+    """
+    index = np.arange(n)
+    if order == 'ascending':
+        return index
+    if order == 'serpentine':
+        return index if pass_index % 2 == 0 else index[::-1]
+    if order == 'interleaved':
+        return np.concatenate([index[0::2], index[1::2][::-1]])
+    raise ValueError(f'unknown sweep order {order!r}, expected one of '
+                     f'{ORDERS}')
+
+
+def fit_settling(steps, waits, dead=0.0, max_wait=0.05):
+    """Fits the model to the settling times measured for several steps.
+
+    Parameters
+    ----------
+    steps : array_like
+        Code steps.
+    waits : array_like
+        Time until the step had settled, in s.
+
+    Returns
+    -------
+    SettlingModel
+    """
+    steps = np.abs(np.asarray(steps, dtype=float))
+    waits = np.asarray(waits, dtype=float) - dead
+    valid = (steps > 0) & (waits > 0)
+    if np.count_nonzero(valid) < 2:
+        # Settled within the first point of every step
+        return SettlingModel(0.0, 1.0, dead, max_wait)
+    # wait = tau * ln|step| - tau * ln(tolerance)
+    tau, intercept = np.polyfit(np.log(steps[valid]), waits[valid], 1)
+    if tau <= 0:
+        # No dependence on the step found, wait as long as the slowest one
+        return SettlingModel(0.0, 1.0, dead + waits.max(),
+                             max(max_wait, waits.max() + dead))
+    return SettlingModel(tau, np.exp(-intercept / tau), dead,
+                         max(max_wait, waits.max() + dead))
+
+
+def measure_settling(inst_E,
+                     inst_AD,
+                     code,
+                     steps,
+                     freqs,
+                     n=201,
+                     rest=0.2,
+                     repeats=3,
+                     resolution=20,
+                     isencoding2scomplement=True):
+    """Measures how long the reader takes to settle after DAC steps.
+
+    For every step the DAC rests at ``code``, steps to ``code + step`` and
+    a zero-span sweep at a frequency where the phase depends strongly on
+    the code, e.g. the resonance of the new code, records the phase while
+    the bias settles. The step has settled at the last point outside the
+    noise band of the end of the sweep. Run once per board; the sweep must
+    be long enough for the slowest step to settle.
+
+    Parameters
+    ----------
+    inst_E
+        E4990A VISA resource, measuring ``TZ``.
+    inst_AD
+        Reference to the connection to the ACE Application.
+    code : int
+        Code the steps start from.
+    steps : array_like
+        Code steps to measure.
+    freqs : float or array_like
+        Frequency of the sweep, or one per step.
+    n : int
+        Points of the sweep.
+    rest : float
+        Wait at ``code`` before every step, in s.
+    repeats : int
+        Times every step is measured, the median settling time is kept.
+    resolution, isencoding2scomplement
+        See ``DACFunctions.write_dac_code``.
+
+    Returns
+    -------
+    model : SettlingModel
+        Fitted to the measured steps.
+    rows : numpy.ndarray
+        ``[step, settling time]`` of every step.
+    """
+    steps = np.asarray(steps, dtype=int)
+    freqs = np.broadcast_to(np.asarray(freqs, dtype=float), steps.shape)
+    rows = []
+    for step, freq in zip(np.repeat(steps, repeats),
+                          np.repeat(freqs, repeats)):
+        dacfunc.write_dac_code(inst_AD, int(code), resolution,
+                               isencoding2scomplement)
+        # Sets up the sweep, only the trigger is sent after the step
+        startBasicSweep(inst_E, freq, freq, n)
+        time.sleep(rest)
+        dacfunc.write_dac_code(inst_AD, int(code + step), resolution,
+                               isencoding2scomplement)
+        t_write = time.perf_counter()
+        startBasicSweep(inst_E, freq, freq, n)
+        t_done = time.perf_counter()
+        phase, _ = fetchBasicSweep(inst_E, freq, freq, n)
+        sweep_time = float(session(inst_E).query('SENS1:SWE:TIME?'))
+        # The last quarter of the sweep is taken as settled
+        tail = phase[-max(n // 4, 2):]
+        band = max(4 * np.std(tail), 1e-9)
+        outside = np.flatnonzero(np.abs(phase - np.median(tail)) > band)
+        settled = 0 if len(outside) == 0 else outside[-1] + 1
+        # From the write, the sweep ended when *OPC? returned
+        start = max(t_done - sweep_time - t_write, 0.0)
+        rows.append([step, start + settled * sweep_time / n])
+    rows = np.array(rows, dtype=float).reshape(-1, repeats, 2)
+    rows = np.column_stack([rows[:, 0, 0], np.median(rows[:, :, 1], axis=1)])
+    return fit_settling(rows[:, 0], rows[:, 1]), rows
+
+
+def load_settling(path, board):
+    '''SettlingModel of a board from the JSON file, None if not measured'''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        models = json.load(f)
+    if board not in models:
+        return None
+    return SettlingModel(**models[board])
+
+
+def save_settling(path, board, model):
+    '''stores the SettlingModel of a board in the JSON file'''
+    models = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            models = json.load(f)
+    models[board] = model.to_dict()
+    with open(path, 'w') as f:
+        json.dump(models, f, indent=1)
+    return
@@ -0,0 +1,233 @@
+import functools
+import json
+import math
+import threading
+import time
+import numpy as np
+
+# Log-spaced histogram bins from 100 ns to 1000 s, the quantiles are
+# resolved to about 4 %
+BIN_MIN = 1e-7
+BINS_PER_DECADE = 32
+BIN_COUNT = 10 * BINS_PER_DECADE
+
+
+class Histogram:
+    """Fixed-size histogram of durations with log-spaced bins.
+
+    Adding a value is O(1) and the memory does not grow with the number of
+    values, so it can stay enabled in the measurement loop.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (BIN_COUNT + 2)  # under- and overflow at the ends
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds > BIN_MIN:
+            k = min(int(math.log10(seconds / BIN_MIN) * BINS_PER_DECADE) + 1,
+                    BIN_COUNT + 1)
+        else:
+            k = 0
+        self.counts[k] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        return
+
+    def quantile(self, q):
+        '''approximate q-quantile, the geometric center of its bin'''
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+        k = int(np.searchsorted(np.cumsum(self.counts), rank, side='right'))
+        if k == 0:
+            return self.min
+        if k > BIN_COUNT:
+            return self.max
+        center = BIN_MIN * 10**((k - 0.5) / BINS_PER_DECADE)
+        return min(max(center, self.min), self.max)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else math.nan,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'max': self.max
+        }
+
+
+class Timings:
+    """Named duration histograms fed by spans.
+
+    Parameters
+    ----------
+    enabled : bool
+        Record the spans; a disabled registry still times them but drops
+        the values without locking.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        '''adds one duration to the histogram of a stage'''
+        if not self.enabled:
+            return
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Histogram()
+            stage.add(seconds)
+        return
+
+    def span(self, name):
+        """Context manager timing its block as one value of a stage.
+
+        Parameters
+        ----------
+        name : str
+            Stage, dotted by subsystem, e.g. ``'ace.Run'``.
+        """
+        return _Span(self, name)
+
+    def timed(self, name):
+        '''decorator timing every call of a function as a stage'''
+
+        def decorator(func):
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with _Span(self, name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def summary(self):
+        """Statistics of every stage, in s.
+
+        Returns
+        -------
+        dict
+            ``count``, ``total``, ``mean``, ``p50``, ``p99`` and ``max`` of
+            each stage, by stage name.
+        """
+        with self._lock:
+            return {
+                name: stage.summary()
+                for name, stage in sorted(self.stages.items())
+            }
+
+    def report(self):
+        '''summary as a text table, durations in ms'''
+        lines = [
+            f'{"stage":<24}{"count":>8}{"total":>11}{"p50":>10}{"p99":>10}'
+            f'{"max":>10}'
+        ]
+        for name, s in self.summary().items():
+            lines.append(f'{name:<24}{s["count"]:>8}{s["total"] * 1e3:>11.1f}'
+                         f'{s["p50"] * 1e3:>10.3f}{s["p99"] * 1e3:>10.3f}'
+                         f'{s["max"] * 1e3:>10.3f}')
+        return '\n'.join(lines)
+
+    def export(self, path, **meta):
+        """Appends the summary as one JSON line.
+
+        Parameters
+        ----------
+        path : str
+            JSON lines file, created if missing.
+        **meta
+            Further fields of the line, e.g. the remark of the pass.
+        """
+        line = {'timestamp': time.time()}
+        line.update(meta)
+        line['stages'] = self.summary()
+        with open(path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+        return
+
+    def reset(self):
+        '''clears the histograms, e.g. at the start of a pass'''
+        with self._lock:
+            self.stages = {}
+        return
+
+
+class _Span:
+
+    __slots__ = ('timings', 'name', 't')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.t = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timings.record(self.name, time.perf_counter() - self.t)
+        return False
+
+
+class TimedResource:
+    """VISA resource proxy timing the SCPI calls.
+
+    ``write``, ``read``, ``read_raw``, ``query`` and
+    ``query_binary_values`` are recorded as ``scpi.<method>``; everything
+    else, attributes included, goes to the resource unchanged.
+
+    Parameters
+    ----------
+    resource
+        VISA resource, e.g. of ``pyvisa.ResourceManager.open_resource``.
+    timings : Timings, optional
+        Registry of the spans, ``TIMINGS`` if omitted.
+    """
+
+    _TIMED = ('write', 'read', 'read_raw', 'query', 'query_binary_values')
+
+    def __init__(self, resource, timings=None):
+        object.__setattr__(self, 'resource', resource)
+        object.__setattr__(self, 'timings',
+                           TIMINGS if timings is None else timings)
+
+    def __getattr__(self, name):
+        attr = getattr(self.resource, name)
+        if name not in self._TIMED:
+            return attr
+        timings, stage = self.timings, 'scpi.' + name
+
+        def call(*args, **kwargs):
+            with _Span(timings, stage):
+                return attr(*args, **kwargs)
+
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self.resource, name, value)
+
+
+TIMINGS = Timings()  # registry used by the modules of the reader
+
+
+def span(name):
+    '''span of the shared registry, see ``Timings.span``'''
+    return TIMINGS.span(name)
+
+
+def record(name, seconds):
+    '''duration of the shared registry, see ``Timings.record``'''
+    TIMINGS.record(name, seconds)
+    return